@@ -0,0 +1,347 @@
+"""
+SmartX alert engine
+Alerts are evaluated once per reading at ingest by a small state machine per
+device and rule. A rule raises only after its metric has been past the raise
+threshold for raise_after seconds, and clears only after the metric has
+been back past the clear threshold for clear_after seconds. The gap
+between the two thresholds is the hysteresis, so a value hovering around a
+limit raises one alert instead of one per reading. Open alerts are kept in
+an in-memory index. Openings and closings are queued per alert and written
+to alert_events in one bulk write per flush, so a storm costs at most one
+write per alert per flush.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+ALERTS_COLLECTION = "alert_events"
+
+# Raise past `above`/`below`, clear once back past `clear`
+DEFAULT_RULES = (
+    {"id": "high_temperature", "metric": "temperature", "above": 85, "clear": 83,
+     "message": "High Temperature Alert"},
+    {"id": "high_pressure", "metric": "pressure", "above": 2.0, "clear": 1.95,
+     "message": "Pressure Warning"},
+    {"id": "high_vibration", "metric": "vibration", "above": 0.8, "clear": 0.75,
+     "message": "Excessive Vibration"},
+    {"id": "low_humidity", "metric": "humidity", "below": 35, "clear": 37,
+     "message": "Humidity Out of Range"},
+    {"id": "high_humidity", "metric": "humidity", "above": 65, "clear": 63,
+     "message": "Humidity Out of Range"},
+    {"id": "high_rpm", "metric": "rpm", "above": 2800, "clear": 2700,
+     "message": "High RPM Warning"},
+)
+
+ALERT_TRANSITIONS = registry.counter(
+    "smartx_alert_transitions_total", "Alerts opened and closed", ("rule", "transition"))
+ALERT_FLUSHES = registry.counter(
+    "smartx_alert_flushes_total", "Alert event flushes to MongoDB", ("result",))
+
+PENDING = "pending"
+OPEN = "open"
+CLEARING = "clearing"
+
+
+class Rule:
+    """One threshold with hysteresis and debounce times"""
+    __slots__ = ("id", "metric", "above", "threshold", "clear", "message", "raise_after", "clear_after", "order")
+
+    def __init__(self, spec, raise_after, clear_after, order=0):
+        if ("above" in spec) == ("below" in spec):
+            raise ValueError(f"Alert rule {spec.get('id')!r} needs exactly one of above/below")
+        self.id = spec["id"]
+        self.metric = spec["metric"]
+        self.above = "above" in spec
+        self.threshold = float(spec["above"] if self.above else spec["below"])
+        self.clear = float(spec.get("clear", self.threshold))
+        if (self.clear > self.threshold) if self.above else (self.clear < self.threshold):
+            raise ValueError(f"Alert rule {self.id!r} clears on the wrong side of its threshold")
+        self.message = spec.get("message", self.id)
+        self.raise_after = float(spec.get("raise_after", raise_after))
+        self.clear_after = float(spec.get("clear_after", clear_after))
+        self.order = order
+
+    def breached(self, value):
+        return value > self.threshold if self.above else value < self.threshold
+
+    def cleared(self, value):
+        return value < self.clear if self.above else value > self.clear
+
+
+class _State:
+    """Where one device/rule pair is between clear and open; clear pairs keep no state"""
+    __slots__ = ("phase", "since", "alert")
+
+    def __init__(self, phase, since, alert=None):
+        self.phase = phase
+        self.since = since
+        self.alert = alert
+
+
+def _number(data, name):
+    value = data.get(name)
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+        return value
+    return None
+
+
+def _alert_id(device_id, rule_id, opened):
+    return f"{device_id}:{rule_id}@{opened.isoformat(timespec='microseconds')}"
+
+
+class AlertEngine:
+    """Per-device, per-rule alert state machines with an index of open alerts"""
+
+    def __init__(self, mongo, rules=DEFAULT_RULES, app=None):
+        self.mongo = mongo
+        self.specs = rules
+        self.enabled = True
+        self.raise_after = 10.0
+        self.clear_after = 30.0
+        self.flush_interval = 2.0
+        self.last_flush = None
+        self.last_error = None
+        self.rules = {}
+        self._states = {}
+        # device_id -> {rule_id: alert}
+        self._open = {}
+        # alert _id -> alert, written at the next flush
+        self._dirty = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._indexed = False
+        self._pid = None
+        self._build_rules()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("ALERTS_ENABLED", True)
+        app.config.setdefault("ALERT_RAISE_AFTER", 10.0)
+        app.config.setdefault("ALERT_CLEAR_AFTER", 30.0)
+        app.config.setdefault("ALERT_FLUSH_INTERVAL", 2.0)
+        self.enabled = bool(app.config["ALERTS_ENABLED"])
+        self.raise_after = float(app.config["ALERT_RAISE_AFTER"])
+        self.clear_after = float(app.config["ALERT_CLEAR_AFTER"])
+        self.flush_interval = float(app.config["ALERT_FLUSH_INTERVAL"])
+        self._build_rules()
+        app.extensions['smartx_alerts'] = self
+
+    def _build_rules(self):
+        self.rules = {spec["id"]: Rule(spec, self.raise_after, self.clear_after, order)
+                      for order, spec in enumerate(self.specs)}
+
+    @property
+    def running(self):
+        """True in a process that ingests, where the open-alert index is live"""
+        return self._pid == os.getpid()
+
+    def observe(self, device_id, timestamp, data):
+        """Step every rule of one reading; returns the device's open alert count"""
+        if not self.enabled or not isinstance(data, dict):
+            return 0
+        with self._lock:
+            for rule in self.rules.values():
+                value = _number(data, rule.metric)
+                # A reading without the metric leaves the rule where it was
+                if value is not None:
+                    self._step(device_id, rule, value, timestamp)
+            return len(self._open.get(device_id, ()))
+
+    def _step(self, device_id, rule, value, timestamp):
+        key = (device_id, rule.id)
+        state = self._states.get(key)
+        if state is None:
+            if not rule.breached(value):
+                return
+            state = self._states[key] = _State(PENDING, timestamp)
+        if state.phase == PENDING:
+            if not rule.breached(value):
+                # Didn't last long enough: debounced away without a trace
+                del self._states[key]
+            elif (timestamp - state.since).total_seconds() >= rule.raise_after:
+                self._raise(device_id, rule, state, value, timestamp)
+            return
+        alert = state.alert
+        alert["last_value"] = value
+        if (value > alert["peak"]) if rule.above else (value < alert["peak"]):
+            alert["peak"] = value
+        if not rule.cleared(value):
+            # Anything short of the clear threshold keeps (or puts back) the alert open
+            state.phase = OPEN
+            return
+        if state.phase == OPEN:
+            state.phase, state.since = CLEARING, timestamp
+        if (timestamp - state.since).total_seconds() >= rule.clear_after:
+            self._close(device_id, rule, state, timestamp)
+
+    def _raise(self, device_id, rule, state, value, timestamp):
+        alert = {
+            "_id": _alert_id(device_id, rule.id, timestamp),
+            "device_id": device_id,
+            "rule": rule.id,
+            "metric": rule.metric,
+            "message": rule.message,
+            "threshold": rule.threshold,
+            "clear": rule.clear,
+            "started": state.since,
+            "opened": timestamp,
+            "closed": None,
+            "peak": value,
+            "last_value": value
+        }
+        state.phase, state.since, state.alert = OPEN, timestamp, alert
+        self._open.setdefault(device_id, {})[rule.id] = alert
+        self._dirty[alert["_id"]] = alert
+        ALERT_TRANSITIONS.labels(rule.id, "opened").inc()
+
+    def _close(self, device_id, rule, state, timestamp):
+        alert = state.alert
+        alert["closed"] = timestamp
+        alert["duration"] = (timestamp - alert["opened"]).total_seconds()
+        del self._states[(device_id, rule.id)]
+        device_alerts = self._open.get(device_id, {})
+        device_alerts.pop(rule.id, None)
+        if not device_alerts:
+            self._open.pop(device_id, None)
+        self._dirty[alert["_id"]] = alert
+        ALERT_TRANSITIONS.labels(rule.id, "closed").inc()
+
+    def open_alerts(self, device_id=None):
+        """Open alerts (of one device), O(open alerts)"""
+        with self._lock:
+            if device_id is not None:
+                alerts = list(self._open.get(device_id, {}).values())
+            else:
+                alerts = [alert for device_alerts in self._open.values() for alert in device_alerts.values()]
+            return [dict(alert) for alert in alerts]
+
+    def messages(self, alerts):
+        """Distinct messages of some alerts, in rule order"""
+        last = len(self.rules)
+        ordered = sorted(alerts, key=lambda alert: self.rules[alert["rule"]].order
+                         if alert["rule"] in self.rules else last)
+        return list(dict.fromkeys(alert["message"] for alert in ordered))
+
+    def open_count(self, device_id):
+        return len(self._open.get(device_id, ()))
+
+    def start(self):
+        """Load open alerts, then flush transitions from a background thread (once per process)"""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._states, self._open, self._dirty, self._loaded = {}, {}, {}, False
+        threading.Thread(target=self._run, name="alert-events", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if not self.mongo.available:
+                continue
+            if not self._loaded:
+                self.load()
+            self.flush()
+
+    def ensure_indexes(self, db):
+        db[ALERTS_COLLECTION].create_index([("closed", 1), ("device_id", 1)])
+        db[ALERTS_COLLECTION].create_index([("device_id", 1), ("opened", -1)])
+        db[ALERTS_COLLECTION].create_index([("opened", -1)])
+
+    def load(self):
+        """Resume the alerts a previous run left open, so a restart doesn't raise them again"""
+        try:
+            stored = list(self.mongo.db[ALERTS_COLLECTION].find({"closed": None}))
+        except Exception as e:
+            self.mongo.mark_failed(e)
+            return False
+        with self._lock:
+            for alert in stored:
+                rule = self.rules.get(alert["rule"])
+                key = (alert["device_id"], alert["rule"])
+                state = self._states.get(key)
+                if rule is None or (state is not None and state.phase != PENDING):
+                    # Rule retired, or raised again since this process started
+                    alert["closed"] = state.alert["opened"] if state is not None else datetime.utcnow()
+                    alert["duration"] = (alert["closed"] - alert["opened"]).total_seconds()
+                    self._dirty[alert["_id"]] = alert
+                    continue
+                self._states[key] = _State(OPEN, alert["opened"], alert)
+                self._open.setdefault(alert["device_id"], {})[alert["rule"]] = alert
+            self._loaded = True
+        return True
+
+    def flush(self):
+        """Write the alerts that opened or closed since the last flush; returns how many"""
+        from pymongo import ReplaceOne
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            operations = [ReplaceOne({"_id": alert_id}, dict(alert), upsert=True)
+                          for alert_id, alert in dirty.items()]
+        if not operations:
+            return 0
+        try:
+            db = self.mongo.db
+            if not self._indexed:
+                self.ensure_indexes(db)
+                self._indexed = True
+            db[ALERTS_COLLECTION].bulk_write(operations, ordered=False)
+        except Exception as e:
+            with self._lock:
+                # Alerts changed again meanwhile are already queued with their newer state
+                for alert_id, alert in dirty.items():
+                    self._dirty.setdefault(alert_id, alert)
+            self.last_error = str(e)
+            ALERT_FLUSHES.labels("error").inc()
+            self.mongo.mark_failed(e)
+            return 0
+        self.last_flush = datetime.utcnow()
+        self.last_error = None
+        ALERT_FLUSHES.labels("ok").inc()
+        return len(operations)
+
+    def status(self):
+        with self._lock:
+            open_alerts = sum(len(device_alerts) for device_alerts in self._open.values())
+            queued_writes = len(self._dirty)
+        return {
+            "enabled": self.enabled,
+            "running": self.running,
+            "rules": len(self.rules),
+            "open_alerts": open_alerts,
+            "queued_writes": queued_writes,
+            "last_flush": self.last_flush.isoformat() if self.last_flush else None,
+            "last_error": self.last_error
+        }
+
+
+def stored_open_alerts(db, device_id=None):
+    """Open alerts as last flushed by the ingest processes"""
+    query = {"closed": None}
+    if device_id is not None:
+        query["device_id"] = device_id
+    return list(db[ALERTS_COLLECTION].find(query, sort=[("opened", -1)]))
+
+
+def alert_history(db, since, device_id=None, limit=200):
+    """Alerts open at any point since `since`, newest first"""
+    query = {"$or": [{"closed": None}, {"closed": {"$gt": since}}]}
+    if device_id is not None:
+        query["device_id"] = device_id
+    return list(db[ALERTS_COLLECTION].find(query, sort=[("opened", -1)]).limit(limit))
+
+
+def serialize(alert):
+    """JSON form of an alert document"""
+    return {**{name: value for name, value in alert.items() if name != "_id"},
+            "id": alert["_id"],
+            "started": alert["started"].isoformat(),
+            "opened": alert["opened"].isoformat(),
+            "closed": alert["closed"].isoformat() if alert.get("closed") else None}
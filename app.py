@@ -1,50 +1,224 @@
 
 import os
 import json
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask import Flask, Blueprint, render_template, request, jsonify, redirect, url_for, flash, g, Response, current_app, send_file, stream_with_context
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-from flask_pymongo import PyMongo
-import paho.mqtt.client as mqtt
 import random
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import logging
+import tempfile
 import threading
 import time
+import history_export
+from metrics import registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+import alerts
+from alerts import AlertEngine
+from devices import DeviceDirectory
+import fleet
+from fleet import FleetIndex
+from historian import IngestCompressor, RuleBook, resample
+from model_serving import ModelServer, ModelUnavailable
+from profiler import RequestProfiler
+from quantiles import SketchStore
+from rate_control import ALARM_STATUSES, RateController
+from retention import RetentionManager, read_archive
+import risk
+from spool import DEFAULT_DIRECTORY as DEFAULT_SPOOL_DIR, DurableSpool, try_lock
+import status_events
+from status_events import StatusTracker
+from reading_codec import CONTENT_TYPE as BINARY_READINGS_TYPE, decode_readings, is_encoded
+from storage import MongoStorage
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
-
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key")
-
-# MongoDB Configuration (optional for prototype)
-try:
-    app.config["MONGO_URI"] = os.environ.get("MONGO_URI", "mongodb://localhost:27017/smartx_iot")
-    mongo = PyMongo(app)
-    # Test connection
-    mongo.db.list_collection_names()
-    MONGODB_AVAILABLE = True
-    app.logger.info("MongoDB connected successfully")
-except Exception as e:
-    app.logger.warning(f"MongoDB not available, using fallback mode: {str(e)}")
-    mongo = None
-    MONGODB_AVAILABLE = False
+# Same logger as app.logger, usable outside an app context (e.g. MQTT callbacks)
+logger = logging.getLogger(__name__)
+
+# Process roles: web serves pages and APIs, ingest receives device data, all does both
+ROLES = ("all", "web", "ingest")
+
+def default_config():
+    """Configuration read from the environment"""
+    return {
+        "SECRET_KEY": os.environ.get("SESSION_SECRET", "dev-secret-key"),
+        "SMARTX_ROLE": os.environ.get("SMARTX_ROLE", "all"),
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "DEBUG"),
+        # On-demand request profiling (admin-only; nothing is wrapped when disabled)
+        "PROFILER_ENABLED": os.environ.get("SMARTX_PROFILER", "").lower() in ("1", "true", "yes"),
+        "PROFILER_SAMPLE_RATE": float(os.environ.get("PROFILER_SAMPLE_RATE", "0")),
+        "PROFILER_KEEP": int(os.environ.get("PROFILER_KEEP", "20")),
+        # MongoDB Configuration (optional for prototype)
+        "MONGO_URI": os.environ.get("MONGO_URI", "mongodb://localhost:27017/smartx_iot"),
+        "MONGO_TIMEOUT_MS": int(os.environ.get("MONGO_TIMEOUT_MS", "1500")),
+        "MONGO_HEALTH_INTERVAL": float(os.environ.get("MONGO_HEALTH_INTERVAL", "5")),
+        # MQTT Configuration
+        "MQTT_BROKER": os.environ.get("MQTT_BROKER", "localhost"),
+        "MQTT_PORT": int(os.environ.get("MQTT_PORT", "1883")),
+        "MQTT_USERNAME": os.environ.get("MQTT_USERNAME", ""),
+        "MQTT_PASSWORD": os.environ.get("MQTT_PASSWORD", ""),
+        # Only the process holding this lock subscribes, so each reading is ingested once per host
+        "MQTT_LOCK_FILE": os.environ.get("MQTT_LOCK_FILE", os.path.join(tempfile.gettempdir(), "smartx_mqtt.lock")),
+        # Optional model bundle scored by /api/predict (needs numpy and joblib)
+        "MODEL_PATH": os.environ.get("MODEL_PATH", ""),
+        # Directory /api/models/reload may load other bundles from; empty allows only MODEL_PATH
+        "MODEL_DIR": os.environ.get("MODEL_DIR", ""),
+        "MODEL_MAX_BATCH": int(os.environ.get("MODEL_MAX_BATCH", "256")),
+        # Finished exports kept on disk so interrupted downloads can resume with Range
+        "EXPORT_SPOOL_DIR": os.environ.get("EXPORT_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "smartx_exports")),
+        "EXPORT_SPOOL_TTL": int(os.environ.get("EXPORT_SPOOL_TTL", "3600")),
+        "EXPORT_BATCH_SIZE": int(os.environ.get("EXPORT_BATCH_SIZE", "5000")),
+        # Retention tiers: raw days, 1-minute rollup days (0 keeps forever); hourly rollups are kept
+        "RETENTION_ENABLED": os.environ.get("RETENTION_ENABLED", "true").lower() in ("1", "true", "yes"),
+        "RETENTION_RAW_DAYS": float(os.environ.get("RETENTION_RAW_DAYS", "30")),
+        "RETENTION_MINUTE_DAYS": float(os.environ.get("RETENTION_MINUTE_DAYS", "180")),
+        "RETENTION_INTERVAL": float(os.environ.get("RETENTION_INTERVAL", "300")),
+        # Archive block codec: gorilla-1 (columnar, needs numpy) or json-zlib-1; empty picks the best available
+        "RETENTION_ARCHIVE_CODEC": os.environ.get("RETENTION_ARCHIVE_CODEC", ""),
+        # Write-ahead spool for readings that arrive while MongoDB is failing
+        "SPOOL_ENABLED": os.environ.get("SPOOL_ENABLED", "true").lower() in ("1", "true", "yes"),
+        "SPOOL_DIR": os.environ.get("SPOOL_DIR", DEFAULT_SPOOL_DIR),
+        "SPOOL_SEGMENT_MB": float(os.environ.get("SPOOL_SEGMENT_MB", "16")),
+        "SPOOL_FSYNC_INTERVAL": float(os.environ.get("SPOOL_FSYNC_INTERVAL", "1.0")),
+        "SPOOL_REPLAY_RATE": float(os.environ.get("SPOOL_REPLAY_RATE", "5000")),
+        "SPOOL_REPLAY_BATCH": int(os.environ.get("SPOOL_REPLAY_BATCH", "1000")),
+        # Deadband/swinging-door compression at ingest; a point is stored at least every max interval
+        "HISTORIAN_ENABLED": os.environ.get("HISTORIAN_ENABLED", "true").lower() in ("1", "true", "yes"),
+        "HISTORIAN_MAX_INTERVAL": float(os.environ.get("HISTORIAN_MAX_INTERVAL", "300")),
+        "HISTORIAN_RULES_REFRESH": float(os.environ.get("HISTORIAN_RULES_REFRESH", "60")),
+        # Device locations and types are reloaded from connected_devices this often
+        "DEVICE_DIRECTORY_REFRESH": float(os.environ.get("DEVICE_DIRECTORY_REFRESH", "60")),
+        # Hourly quantile sketches per device and metric, flushed every few seconds
+        "SKETCH_ENABLED": os.environ.get("SKETCH_ENABLED", "true").lower() in ("1", "true", "yes"),
+        "SKETCH_FLUSH_INTERVAL": float(os.environ.get("SKETCH_FLUSH_INTERVAL", "10")),
+        # Status-transition events: silence longer than this counts as offline
+        "STATUS_OFFLINE_AFTER": float(os.environ.get("STATUS_OFFLINE_AFTER", "300")),
+        "STATUS_FLUSH_INTERVAL": float(os.environ.get("STATUS_FLUSH_INTERVAL", "5")),
+        # Fleet aggregates per location and device type; silent devices count as offline
+        "FLEET_ENABLED": os.environ.get("FLEET_ENABLED", "true").lower() in ("1", "true", "yes"),
+        "FLEET_STALE_AFTER": float(os.environ.get("FLEET_STALE_AFTER", "300")),
+        "FLEET_PUBLISH_INTERVAL": float(os.environ.get("FLEET_PUBLISH_INTERVAL", "5")),
+        # Alerts raise after a breach lasts ALERT_RAISE_AFTER seconds and clear after ALERT_CLEAR_AFTER
+        "ALERTS_ENABLED": os.environ.get("ALERTS_ENABLED", "true").lower() in ("1", "true", "yes"),
+        "ALERT_RAISE_AFTER": float(os.environ.get("ALERT_RAISE_AFTER", "10")),
+        "ALERT_CLEAR_AFTER": float(os.environ.get("ALERT_CLEAR_AFTER", "30")),
+        "ALERT_FLUSH_INTERVAL": float(os.environ.get("ALERT_FLUSH_INTERVAL", "2")),
+        # Publish-rate control: devices get set_interval messages as ingest load moves past its targets
+        "CONTROL_ENABLED": os.environ.get("CONTROL_ENABLED", "true").lower() in ("1", "true", "yes"),
+        "CONTROL_INTERVAL": float(os.environ.get("CONTROL_INTERVAL", "5")),
+        "CONTROL_TARGET_UTILIZATION": float(os.environ.get("CONTROL_TARGET_UTILIZATION", "0.7")),
+        "CONTROL_TARGET_LATENCY": float(os.environ.get("CONTROL_TARGET_LATENCY", "0.05")),
+        "CONTROL_BACKLOG_LIMIT": int(os.environ.get("CONTROL_BACKLOG_LIMIT", "10000")),
+        "CONTROL_ALARM_INTERVAL": float(os.environ.get("CONTROL_ALARM_INTERVAL", "1")),
+        "CONTROL_MIN_INTERVAL": float(os.environ.get("CONTROL_MIN_INTERVAL", "0.5")),
+        "CONTROL_MAX_INTERVAL": float(os.environ.get("CONTROL_MAX_INTERVAL", "300")),
+        "CONTROL_MAX_SCALE": float(os.environ.get("CONTROL_MAX_SCALE", "20")),
+        "CONTROL_MAX_MESSAGES": int(os.environ.get("CONTROL_MAX_MESSAGES", "1000")),
+    }
+
+# Connection and health checks run in a background thread, so startup never
+# blocks on the database; mongo.available flips as the server comes and goes.
+mongo = MongoStorage()
+
+# Loaded on first prediction and swapped atomically on reload
+models = ModelServer()
+
+# Rollups, archiving and TTLs; compacts in the background once started
+retention = RetentionManager(mongo)
+
+# Readings written while MongoDB is down; replayed at a capped rate on recovery
+spool = DurableSpool(mongo)
+
+# Location and device type per device, reloaded in the background for ingest and queries
+device_directory = DeviceDirectory(mongo)
+
+# Drops readings that interpolation can rebuild; rules per device type
+historian = IngestCompressor(RuleBook(mongo, device_directory))
+
+# p95/p99 per device and hour without reading raw history
+sketches = SketchStore(mongo)
+
+# Status transitions per device; uptime, MTBF and OEE come from these events
+status_tracker = StatusTracker(mongo)
+
+# Alert state machines per device and rule; open alerts are indexed in memory
+alert_engine = AlertEngine(mongo)
+
+# Slows steady devices and speeds up alarming ones as ingest load changes
+rate_controller = RateController()
+
+# Per-node fleet aggregates, updated in O(depth) per reading
+fleet_index = FleetIndex(mongo, device_directory)
 
 # Initialize Flask-Login
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'start_page'
+login_manager.login_view = 'web.start_page'
+
+# Pages and dashboard APIs; device ingest lives on its own blueprint so an
+# ingest-only process doesn't serve the UI
+web = Blueprint('web', __name__)
+ingest = Blueprint('ingest', __name__)
+
+# Fields every device reading must carry
+REQUIRED_FIELDS = ['temperature', 'pressure', 'vibration', 'humidity', 'status', 'efficiency']
 
-# MQTT Configuration
-MQTT_BROKER = os.environ.get("MQTT_BROKER", "localhost")
-MQTT_PORT = int(os.environ.get("MQTT_PORT", "1883"))
 MQTT_TOPIC = "smartx/sensors/+"
-MQTT_USERNAME = os.environ.get("MQTT_USERNAME", "")
-MQTT_PASSWORD = os.environ.get("MQTT_PASSWORD", "")
+CONTROL_TOPIC = "smartx/control/{}"
 
 # Global MQTT client
 mqtt_client = None
+# Held open by the one process that subscribes to MQTT_TOPIC
+mqtt_lock_file = None
+_mqtt_ingest_pid = None
+# Serializes access to the JSON fallback file between ingest and draining
+_file_lock = threading.Lock()
 latest_sensor_data = {}
+# Wall-clock time each device last reported, used for liveness metrics
+latest_seen = {}
+
+# Readings kept in the JSON fallback file while MongoDB is unreachable
+FALLBACK_MAX_RECORDS = int(os.environ.get("FALLBACK_MAX_RECORDS", "100"))
+
+# A device counts as live if it reported within this many seconds
+LIVE_DEVICE_WINDOW = int(os.environ.get("LIVE_DEVICE_WINDOW", "300"))
+
+# Metrics
+READINGS_TOTAL = registry.counter(
+    "smartx_readings_total", "Sensor readings ingested", ("source", "device_id"))
+INSERT_SECONDS = registry.histogram(
+    "smartx_storage_insert_seconds", "Time spent storing one reading", ("backend",))
+MQTT_MESSAGE_SECONDS = registry.histogram(
+    "smartx_mqtt_message_seconds", "Time spent processing one MQTT message")
+REQUEST_SECONDS = registry.histogram(
+    "smartx_http_request_seconds", "HTTP request latency by route", ("method", "route"))
+MQTT_RECONNECTS = registry.counter(
+    "smartx_mqtt_reconnects_total", "Successful MQTT reconnections after the first connect")
+MQTT_DISCONNECTS = registry.counter(
+    "smartx_mqtt_disconnects_total", "MQTT disconnections")
+LIVE_DEVICES = registry.gauge(
+    "smartx_live_devices", "Devices that reported within the liveness window")
+FRESHEST_AGE = registry.gauge(
+    "smartx_freshest_reading_age_seconds", "Age of the most recent reading from any device")
+STALEST_AGE = registry.gauge(
+    "smartx_stalest_reading_age_seconds", "Age of the latest reading from the least recently seen device")
+MONGODB_UP = registry.gauge(
+    "smartx_mongodb_available", "1 while MongoDB is reachable, 0 while using fallback storage")
+OPEN_ALERTS = registry.gauge(
+    "smartx_open_alerts", "Alerts currently open in this process")
+
+def _live_device_count():
+    cutoff = time.time() - LIVE_DEVICE_WINDOW
+    return sum(1 for seen in list(latest_seen.values()) if seen >= cutoff)
+
+def _reading_age(pick):
+    seen = list(latest_seen.values())
+    if not seen:
+        return float('nan')
+    return time.time() - pick(seen)
+
+LIVE_DEVICES.set_function(_live_device_count)
+FRESHEST_AGE.set_function(lambda: _reading_age(max))
+STALEST_AGE.set_function(lambda: _reading_age(min))
+MONGODB_UP.set_function(lambda: 1 if mongo.available else 0)
+OPEN_ALERTS.set_function(lambda: alert_engine.status()["open_alerts"])
+_mqtt_connected_once = False
 
 # User class for Flask-Login
 class User(UserMixin):
@@ -68,40 +242,102 @@ def load_user(user_id):
 
 # MQTT Functions
 def on_connect(client, userdata, flags, rc):
+    global _mqtt_connected_once
     if rc == 0:
-        app.logger.info("Connected to MQTT broker")
+        logger.info("Connected to MQTT broker")
+        if _mqtt_connected_once:
+            MQTT_RECONNECTS.inc()
+        _mqtt_connected_once = True
         client.subscribe(MQTT_TOPIC)
     else:
-        app.logger.error(f"Failed to connect to MQTT broker: {rc}")
+        logger.error(f"Failed to connect to MQTT broker: {rc}")
+
+def on_disconnect(client, userdata, rc):
+    MQTT_DISCONNECTS.inc()
+    logger.warning(f"Disconnected from MQTT broker: {rc}")
 
 def on_message(client, userdata, msg):
-    try:
-        topic = msg.topic
-        payload = json.loads(msg.payload.decode())
-        
-        # Extract device ID from topic (e.g., smartx/sensors/device01)
-        device_id = topic.split('/')[-1]
-        
-        # Add metadata
-        sensor_data = {
-            'device_id': device_id,
-            'timestamp': datetime.utcnow(),
-            'data': payload
-        }
-        
-        # Store in MongoDB if available, otherwise use JSON file
-        if MONGODB_AVAILABLE and mongo:
-            mongo.db.sensor_data.insert_one(sensor_data)
-        else:
+    started = time.perf_counter()
+    with MQTT_MESSAGE_SECONDS.time():
+        try:
+            topic = msg.topic
+            # Packed binary carries a magic byte no JSON document can start with
+            if is_encoded(msg.payload):
+                payload = decode_readings(msg.payload)
+            else:
+                payload = json.loads(msg.payload.decode())
+            
+            # Extract device ID from topic (e.g., smartx/sensors/device01)
+            device_id = topic.split('/')[-1]
+            
+            if isinstance(payload, list):
+                for reading in payload:
+                    ingest_reading(reading.get('device_id', device_id), reading, 'mqtt')
+            else:
+                ingest_reading(device_id, payload, 'mqtt')
+            
+            logger.info(f"Received MQTT data from {device_id}: {payload}")
+            
+        except Exception as e:
+            logger.error(f"Error processing MQTT message: {str(e)}")
+    rate_controller.record_busy(time.perf_counter() - started)
+
+def ingest_reading(device_id, payload, source):
+    """Store one reading and update the latest-data cache"""
+    # Add metadata
+    sensor_data = {
+        'device_id': device_id,
+        'timestamp': datetime.utcnow(),
+        'data': payload
+    }
+    
+    # Sketches see every reading, including those compression drops
+    sketches.add(device_id, sensor_data['timestamp'], payload)
+    status_tracker.observe(device_id, sensor_data['timestamp'], payload)
+    open_alerts = alert_engine.observe(device_id, sensor_data['timestamp'], payload)
+    fleet_index.observe(device_id, sensor_data['timestamp'], payload,
+                        open_alerts if alert_engine.enabled else None)
+    # Only MQTT devices listen on the control topic
+    if source == 'mqtt':
+        alarm = isinstance(payload, dict) and payload.get('status') in ALARM_STATUSES
+        rate_controller.observe(device_id, bool(open_alerts) or alarm)
+    
+    # Only readings outside the compression corridor (or heartbeats) are kept
+    for doc in historian.offer(sensor_data):
+        store_reading(doc)
+    
+    # Update latest data cache
+    latest_sensor_data[device_id] = payload
+    latest_seen[device_id] = time.time()
+    READINGS_TOTAL.labels(source, device_id).inc()
+    
+    return sensor_data
+
+def store_reading(sensor_data):
+    """Persist one sensor_data document"""
+    # Store in MongoDB if available, otherwise spool to disk for replay.
+    # A failed insert_one has already set _id, so a replay of a write that
+    # did reach the server is dropped as a duplicate.
+    stored = False
+    started = time.perf_counter()
+    if mongo.available:
+        try:
+            with INSERT_SECONDS.labels('mongodb').time():
+                mongo.db.sensor_data.insert_one(sensor_data)
+            stored = True
+        except Exception as e:
+            mongo.mark_failed(e)
+    if not stored:
+        try:
+            with INSERT_SECONDS.labels('spool').time():
+                stored = spool.append(sensor_data)
+        except OSError as e:
+            logger.error(f"Error writing reading to spool: {str(e)}")
+    if not stored:
+        sensor_data.pop('_id', None)
+        with INSERT_SECONDS.labels('file').time():
             store_data_to_file(sensor_data)
-        
-        # Update latest data cache
-        latest_sensor_data[device_id] = payload
-        
-        app.logger.info(f"Received MQTT data from {device_id}: {payload}")
-        
-    except Exception as e:
-        app.logger.error(f"Error processing MQTT message: {str(e)}")
+    rate_controller.record_storage(time.perf_counter() - started)
 
 def store_data_to_file(sensor_data):
     """Store sensor data to JSON file as fallback"""
@@ -110,24 +346,51 @@ def store_data_to_file(sensor_data):
         data_to_store = sensor_data.copy()
         data_to_store['timestamp'] = sensor_data['timestamp'].isoformat()
         
-        # Read existing data
+        with _file_lock:
+            # Read existing data
+            try:
+                with open('sensor_data.json', 'r') as f:
+                    existing_data = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                existing_data = []
+            
+            # Add new data and keep only the most recent records
+            existing_data.append(data_to_store)
+            if len(existing_data) > FALLBACK_MAX_RECORDS:
+                existing_data = existing_data[-FALLBACK_MAX_RECORDS:]
+            
+            # Save back to file
+            with open('sensor_data.json', 'w') as f:
+                json.dump(existing_data, f, indent=2)
+            
+    except Exception as e:
+        logger.error(f"Error storing data to file: {str(e)}")
+
+@mongo.on_recovery
+def replay_spool():
+    """Wake the spool replayer once MongoDB is reachable again"""
+    spool.wake()
+
+@mongo.on_recovery
+def drain_file_to_mongo():
+    """Move readings stored in the fallback file into MongoDB once it is back"""
+    with _file_lock:
         try:
             with open('sensor_data.json', 'r') as f:
-                existing_data = json.load(f)
+                records = json.load(f)
         except (FileNotFoundError, json.JSONDecodeError):
-            existing_data = []
-        
-        # Add new data and keep only last 100 records
-        existing_data.append(data_to_store)
-        if len(existing_data) > 100:
-            existing_data = existing_data[-100:]
+            return
+        if not records:
+            return
         
-        # Save back to file
-        with open('sensor_data.json', 'w') as f:
-            json.dump(existing_data, f, indent=2)
-            
-    except Exception as e:
-        app.logger.error(f"Error storing data to file: {str(e)}")
+        docs = []
+        for record in records:
+            doc = dict(record)
+            doc['timestamp'] = datetime.fromisoformat(record['timestamp'])
+            docs.append(doc)
+        mongo.db.sensor_data.insert_many(docs, ordered=False)
+        os.remove('sensor_data.json')
+    logger.info(f"Drained {len(docs)} fallback readings into MongoDB")
 
 def get_data_from_file():
     """Get latest sensor data from JSON file"""
@@ -140,26 +403,71 @@ def get_data_from_file():
         pass
     return None
 
-def initialize_mqtt():
+def publish_control(device_id, message):
+    """Send one control message to a device; dropped while the broker is unreachable"""
+    if mqtt_client is not None and mqtt_client.is_connected():
+        mqtt_client.publish(CONTROL_TOPIC.format(device_id), json.dumps(message), qos=1)
+
+def start_mqtt_ingest(config):
+    """Subscribe from whichever process claims the MQTT lock; the others stand by"""
+    global _mqtt_ingest_pid
+    if _mqtt_ingest_pid == os.getpid():
+        return
+    _mqtt_ingest_pid = os.getpid()
+    threading.Thread(target=claim_mqtt_subscriber, args=(config,), name="mqtt-subscriber", daemon=True).start()
+
+def claim_mqtt_subscriber(config):
+    global mqtt_lock_file
+    # Every subscribed worker would get its own copy of each reading. The lock
+    # is released when its holder exits, and a standby worker takes over.
+    while mqtt_lock_file is None:
+        mqtt_lock_file = try_lock(config["MQTT_LOCK_FILE"])
+        if mqtt_lock_file is None:
+            time.sleep(5)
+    logger.info(f"Process {os.getpid()} is the MQTT subscriber")
+    initialize_mqtt(config)
+    # Control messages go out from the process that sees the MQTT load
+    rate_controller.start(publish_control, lambda: spool.pending)
+
+def initialize_mqtt(config):
     global mqtt_client
     try:
+        # Imported here so web-only processes never load the broker client
+        import paho.mqtt.client as mqtt
+        
         mqtt_client = mqtt.Client()
         mqtt_client.on_connect = on_connect
+        mqtt_client.on_disconnect = on_disconnect
         mqtt_client.on_message = on_message
         
-        if MQTT_USERNAME and MQTT_PASSWORD:
-            mqtt_client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+        if config["MQTT_USERNAME"] and config["MQTT_PASSWORD"]:
+            mqtt_client.username_pw_set(config["MQTT_USERNAME"], config["MQTT_PASSWORD"])
         
-        mqtt_client.connect(MQTT_BROKER, MQTT_PORT, 60)
+        # Connect from paho's network thread so a slow or missing broker never
+        # blocks startup; paho keeps retrying with backoff until it connects
+        mqtt_client.reconnect_delay_set(min_delay=1, max_delay=30)
+        mqtt_client.connect_async(config["MQTT_BROKER"], config["MQTT_PORT"], 60)
         mqtt_client.loop_start()
         
     except Exception as e:
-        app.logger.error(f"Failed to initialize MQTT: {str(e)}")
+        logger.error(f"Failed to initialize MQTT: {str(e)}")
 
 # Helper functions for data management
-def get_latest_sensor_data():
-    """Get the latest sensor data from MongoDB, file, or cache"""
+def get_latest_sensor_data(device_id=None):
+    """Get the latest sensor data from MongoDB, file, or cache
+
+    With `device_id`, only that device's latest reading (cache, then MongoDB).
+    """
     try:
+        if device_id:
+            if device_id in latest_sensor_data:
+                return latest_sensor_data[device_id]
+            if mongo.available:
+                latest_doc = mongo.db.sensor_data.find_one({'device_id': device_id}, sort=[('timestamp', -1)])
+                if latest_doc:
+                    return latest_doc['data']
+            return None
+        
         # Try to get from cache first
         if latest_sensor_data:
             # Get the most recent device data
@@ -168,7 +476,7 @@ def get_latest_sensor_data():
             return latest_sensor_data[latest_device]
         
         # Try MongoDB if available
-        if MONGODB_AVAILABLE and mongo:
+        if mongo.available:
             latest_doc = mongo.db.sensor_data.find_one(sort=[('timestamp', -1)])
             if latest_doc:
                 return latest_doc['data']
@@ -179,7 +487,7 @@ def get_latest_sensor_data():
             return file_data
             
     except Exception as e:
-        app.logger.error(f"Error getting sensor data: {str(e)}")
+        logger.error(f"Error getting sensor data: {str(e)}")
     
     return None
 
@@ -195,21 +503,61 @@ def get_fallback_data():
         "timestamp": datetime.now().isoformat()
     }
 
-def get_historical_data(hours=24):
-    """Get historical sensor data from MongoDB"""
+def get_historical_data(hours=24, device_id=None):
+    """Get historical sensor data from MongoDB, including archived days"""
     try:
-        since = datetime.utcnow() - timedelta(hours=hours)
-        cursor = mongo.db.sensor_data.find(
-            {'timestamp': {'$gte': since}},
-            sort=[('timestamp', 1)]
-        )
+        now = datetime.utcnow()
+        since = now - timedelta(hours=hours)
+        query = {'timestamp': {'$gte': since}}
+        if device_id:
+            query['device_id'] = device_id
+        cursor = mongo.db.sensor_data.find(query, sort=[('timestamp', 1)])
+        # Days past raw retention live in compressed archive blocks
+        cutoff = retention.raw_cutoff if retention.enabled else None
+        if cutoff is not None and since < cutoff:
+            devices = [device_id] if device_id else None
+            return read_archive(mongo.db, since, cutoff, devices) + list(cursor)
         return list(cursor)
     except Exception as e:
-        app.logger.error(f"Error getting historical data: {str(e)}")
+        logger.error(f"Error getting historical data: {str(e)}")
         return []
 
+def naive_utc(stamp):
+    """Naive UTC datetime for comparing with stored timestamps; offsets are converted, not dropped"""
+    if stamp.tzinfo is not None:
+        stamp = stamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return stamp
+
+def get_open_alerts(device_id=None):
+    """Open alerts from this process's index, or as last flushed by the ingest processes"""
+    if alert_engine.running:
+        return alert_engine.open_alerts(device_id)
+    if mongo.available:
+        try:
+            return alerts.stored_open_alerts(mongo.db, device_id)
+        except Exception as e:
+            mongo.mark_failed(e)
+    return []
+
+# Request instrumentation
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    # Starts the storage health checker in whichever process serves requests
+    mongo.start()
+
+def record_request_latency(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.labels(request.method, route).observe(time.perf_counter() - start)
+    return response
+
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(registry.render(), content_type=METRICS_CONTENT_TYPE)
+
 # Authentication routes
-@app.route("/login", methods=["GET", "POST"])
+@web.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         username = request.form.get("username")
@@ -219,40 +567,40 @@ def login():
             user = User(username, users[username]['role'])
             login_user(user)
             flash(f"Welcome, {username}!", "success")
-            return redirect(url_for('home'))
+            return redirect(url_for('web.home'))
         else:
             flash("Invalid username or password", "error")
     
     return render_template("login.html")
 
-@app.route("/logout")
+@web.route("/logout")
 @login_required
 def logout():
     logout_user()
     flash("You have been logged out", "info")
-    return redirect(url_for('start_page'))
+    return redirect(url_for('web.start_page'))
 
-@app.route("/back-to-features")
+@web.route("/back-to-features")
 @login_required
 def back_to_features():
     """Route to go back to main features page"""
-    return redirect(url_for('home'))
+    return redirect(url_for('web.home'))
 
-@app.route("/")
+@web.route("/")
 def start_page():
     return render_template("start.html")
 
-@app.route("/home")
+@web.route("/home")
 @login_required
 def home():
     return render_template("index.html")
 
-@app.route("/dashboard")
+@web.route("/dashboard")
 @login_required
 def dashboard_page():
     return render_template("dashboard.html")
 
-@app.route("/api/dashboard")
+@web.route("/api/dashboard")
 @login_required
 def dashboard_api():
     """API endpoint for real-time dashboard data"""
@@ -262,12 +610,25 @@ def dashboard_api():
     
     return jsonify(data)
 
-@app.route("/api/historical-data")
+@web.route("/api/historical-data")
 @login_required
 def historical_data_api():
     """API endpoint for historical data charts"""
     hours = request.args.get('hours', 24, type=int)
-    data = get_historical_data(hours)
+    device_id = request.args.get('device_id')
+    # sensor_data holds compressed points. One device's chart gets a rebuilt
+    # series by default (about 1440 points); resampling is pure Python, so the
+    # whole fleet gets the stored points (step=0) and can't ask for more
+    step = request.args.get('step', type=float)
+    if step is None:
+        step = max(60.0, hours * 3600 / 1440) if device_id else 0
+    if step and not device_id:
+        return jsonify({"error": "Resampling (step) needs a device_id"}), 400
+    data = get_historical_data(hours, device_id)
+    if step:
+        # Regular series rebuilt from the compressed points
+        until = datetime.utcnow()
+        data = resample(data, until - timedelta(hours=hours), until, max(step, 1.0), historian.rules.for_device)
     
     # Format data for charts
     formatted_data = []
@@ -280,51 +641,109 @@ def historical_data_api():
     
     return jsonify(formatted_data)
 
+@web.route("/api/export")
+@login_required
+def export_history():
+    """Stream a device/time/field selection as CSV, NDJSON, Arrow or Parquet"""
+    try:
+        selection = history_export.parse_selection(request.args)
+        history_export.check_available(selection)
+    except history_export.ExportError as e:
+        return jsonify({"error": str(e)}), 400
+    if not mongo.available:
+        return jsonify({"error": "MongoDB is not available"}), 503
+    
+    key = history_export.export_key(selection)
+    filename = history_export.export_filename(selection)
+    mimetype = history_export.media_type(selection)
+    spool = history_export.ExportSpool(current_app.config["EXPORT_SPOOL_DIR"], current_app.config["EXPORT_SPOOL_TTL"])
+    batch_size = current_app.config["EXPORT_BATCH_SIZE"]
+    # Days past raw retention are read from the archive
+    cutoff = retention.raw_cutoff if retention.enabled else None
+    
+    # Range requests (resumed downloads) are answered from the finished spool file
+    if request.range is not None or spool.ready(key):
+        try:
+            if not spool.ready(key):
+                spool.build(key, history_export.export_stream(mongo.db.sensor_data, selection, batch_size, cutoff))
+            return send_file(spool.path(key), mimetype=mimetype, as_attachment=True,
+                             download_name=filename, conditional=True, etag=key)
+        except Exception as e:
+            logger.error(f"Export error: {str(e)}")
+            return jsonify({"error": "Export failed"}), 500
+    
+    chunks = history_export.export_stream(mongo.db.sensor_data, selection, batch_size, cutoff)
+    # Pin `until` so a resumed request selects exactly the same rows
+    pinned = request.args.to_dict()
+    pinned["until"] = selection["until"].isoformat()
+    response = Response(stream_with_context(spool.tee(key, chunks)), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    response.headers["Content-Location"] = url_for('web.export_history', **pinned)
+    response.headers["Accept-Ranges"] = "bytes"
+    response.set_etag(key)
+    return response
+
 # MQTT Data Receiver (still keep for direct HTTP posts)
-@app.route("/api/device-data", methods=["POST"])
+@ingest.route("/api/device-data", methods=["POST"])
 def receive_device_data():
     """API endpoint to receive sensor data from IoT devices via HTTP"""
     try:
-        data = request.get_json()
         device_id = request.headers.get('Device-ID', 'http_device')
         
-        # Validate required fields
-        required_fields = ['temperature', 'pressure', 'vibration', 'humidity', 'status', 'efficiency']
-        if not all(field in data for field in required_fields):
-            return jsonify({"error": "Missing required fields"}), 400
+        # Accept one JSON reading, a JSON list of readings, or packed binary readings
+        if request.mimetype == BINARY_READINGS_TYPE:
+            data = decode_readings(request.get_data())
+        else:
+            data = request.get_json()
         
-        # Store in MongoDB or file
-        sensor_data = {
-            'device_id': device_id,
-            'timestamp': datetime.utcnow(),
-            'data': data
-        }
+        if isinstance(data, list):
+            return receive_device_batch(device_id, data)
         
-        if MONGODB_AVAILABLE and mongo:
-            mongo.db.sensor_data.insert_one(sensor_data)
-        else:
-            store_data_to_file(sensor_data)
+        # Validate required fields
+        if not all(field in data for field in REQUIRED_FIELDS):
+            return jsonify({"error": "Missing required fields"}), 400
         
-        # Update cache
-        latest_sensor_data[device_id] = data
+        # Store in MongoDB or file and update cache
+        sensor_data = ingest_reading(device_id, data, 'http')
         
-        app.logger.info(f"Received HTTP device data from {device_id}: {data}")
+        logger.info(f"Received HTTP device data from {device_id}: {data}")
         return jsonify({"message": "Data received successfully", "timestamp": sensor_data['timestamp'].isoformat()}), 200
             
     except Exception as e:
-        app.logger.error(f"Device data error: {str(e)}")
+        logger.error(f"Device data error: {str(e)}")
         return jsonify({"error": "Invalid data format"}), 400
 
-@app.route("/twin")
+def receive_device_batch(default_device_id, readings):
+    """Ingest a batch of readings; each may carry its own device_id"""
+    if not readings:
+        return jsonify({"error": "Empty batch"}), 400
+    if not all(isinstance(reading, dict) and all(field in reading for field in REQUIRED_FIELDS)
+               for reading in readings):
+        return jsonify({"error": "Missing required fields"}), 400
+    
+    sensor_data = None
+    for reading in readings:
+        sensor_data = ingest_reading(reading.get('device_id', default_device_id), reading, 'http')
+    
+    logger.info(f"Received HTTP batch of {len(readings)} readings")
+    return jsonify({
+        "message": "Data received successfully",
+        "count": len(readings),
+        "timestamp": sensor_data['timestamp'].isoformat()
+    }), 200
+
+@web.route("/twin")
 @login_required
 def twin_page():
     return render_template("twin.html")
 
-@app.route("/api/twin-data")
+@web.route("/api/twin-data")
 @login_required
 def twin_data():
     """API endpoint for 3D twin sensor data"""
-    stored_data = get_latest_sensor_data()
+    # Values, uptime and alerts all describe one device: the requested or most recently seen one
+    device_id = request.args.get("device_id") or (max(latest_seen, key=latest_seen.get) if latest_seen else None)
+    stored_data = get_latest_sensor_data(device_id)
     
     if stored_data:
         data = {
@@ -382,33 +801,38 @@ def twin_data():
             "power": round(power, 1),
             "status": status,
             "alerts": [],
-            "efficiency": max(60, min(98, 95 - (temperature - 75) * 0.5 - (vibration - 0.3) * 10)),
-            "uptime": f"{random.randint(12, 168)}h {random.randint(0, 59)}m"
+            "efficiency": max(60, min(98, 95 - (temperature - 75) * 0.5 - (vibration - 0.3) * 10))
         }
     
-    # Add alerts based on conditions
-    alerts = []
-    if data["temperature"] > 85:
-        alerts.append("High Temperature Alert")
-    if data["pressure"] > 2.0:
-        alerts.append("Pressure Warning")
-    if data["vibration"] > 0.8:
-        alerts.append("Excessive Vibration")
-    if data["humidity"] < 35 or data["humidity"] > 65:
-        alerts.append("Humidity Out of Range")
-    if data["rpm"] > 2800:
-        alerts.append("High RPM Warning")
+    # Uptime comes from the status-transition events of the device on show
+    data["device_id"] = device_id
+    data["uptime"] = None
+    data["availability_24h"] = None
+    if device_id and mongo.available:
+        try:
+            now = datetime.utcnow()
+            data["uptime"] = status_events.format_duration(status_events.current_uptime(mongo.db, device_id, now))
+            summary = status_events.summarize(mongo.db, now - timedelta(hours=24), now, [device_id],
+                                              status_tracker.offline_after, now)
+            if summary:
+                data["availability_24h"] = summary[0]["availability"]
+        except Exception as e:
+            mongo.mark_failed(e)
     
-    data["alerts"] = alerts
+    # Open alerts of the device on show; simulated data falls back to the plain thresholds
+    if stored_data and device_id:
+        data["alerts"] = alert_engine.messages(get_open_alerts(device_id))
+    else:
+        data["alerts"] = risk.reading_alerts(data)
     
     return jsonify(data)
 
-@app.route("/predict")
+@web.route("/predict")
 @login_required
 def predict_page():
     return render_template("predict.html")
 
-@app.route("/api/predict", methods=["POST"])
+@web.route("/api/predict", methods=["POST"])
 @login_required
 def predict_api():
     """API endpoint for predictive analytics"""
@@ -427,104 +851,358 @@ def predict_api():
         vibration = float(data.get("vibration", 0.5))
         humidity = float(data.get("humidity", 50))
         
-        # Enhanced prediction logic with machine learning concepts
-        risk_score = 0
-        risk_factors = []
-        maintenance_recommendations = []
-        
-        # Temperature analysis
-        if temperature > 90:
-            risk_score += 40
-            risk_factors.append("Critical temperature levels")
-            maintenance_recommendations.append("Immediate cooling system inspection required")
-        elif temperature > 85:
-            risk_score += 25
-            risk_factors.append("High temperature detected")
-            maintenance_recommendations.append("Check cooling system within 24 hours")
-        elif temperature > 75:
-            risk_score += 10
-            risk_factors.append("Elevated temperature")
-            
-        # Pressure analysis
-        if pressure > 2.2:
-            risk_score += 35
-            risk_factors.append("Critical pressure levels")
-            maintenance_recommendations.append("Pressure relief system check required")
-        elif pressure > 2.0:
-            risk_score += 20
-            risk_factors.append("High pressure levels")
-            maintenance_recommendations.append("Monitor pressure trends closely")
-        elif pressure > 1.8:
-            risk_score += 10
-            risk_factors.append("Moderate pressure increase")
-            
-        # Vibration analysis
-        if vibration > 0.9:
-            risk_score += 30
-            risk_factors.append("Severe vibration detected")
-            maintenance_recommendations.append("Bearing and alignment inspection needed")
-        elif vibration > 0.7:
-            risk_score += 20
-            risk_factors.append("High vibration levels")
-            maintenance_recommendations.append("Schedule vibration analysis")
-        elif vibration > 0.5:
-            risk_score += 10
-            risk_factors.append("Elevated vibration")
-            
-        # Humidity analysis
-        if humidity > 70 or humidity < 30:
-            risk_score += 15
-            risk_factors.append("Humidity outside optimal range")
-            maintenance_recommendations.append("Check environmental controls")
-        
-        # Determine risk level and overall recommendation
-        if risk_score >= 60:
-            risk_level = "Critical Risk"
-            overall_recommendation = "Stop operation immediately - maintenance required"
-            predicted_failure_time = "< 4 hours"
-        elif risk_score >= 40:
-            risk_level = "High Risk"
-            overall_recommendation = "Schedule immediate maintenance"
-            predicted_failure_time = "12-24 hours"
-        elif risk_score >= 20:
-            risk_level = "Medium Risk"
-            overall_recommendation = "Schedule maintenance within 48 hours"
-            predicted_failure_time = "2-7 days"
-        else:
-            risk_level = "Low Risk"
-            overall_recommendation = "Normal operation - continue monitoring"
-            predicted_failure_time = "> 30 days"
+        # Threshold rules shared with the fleet aggregates
+        assessment = risk.assess(temperature, pressure, vibration, humidity)
         
         # Calculate confidence based on data completeness
         confidence = min(100, 70 + (10 if temperature else 0) + (10 if pressure else 0) + 
                         (10 if vibration else 0) + (10 if humidity else 0))
         
-        return jsonify({
+        result = {
             "temperature": temperature,
             "pressure": pressure,
             "vibration": vibration,
             "humidity": humidity,
-            "risk_score": risk_score,
-            "risk_level": risk_level,
-            "risk_factors": risk_factors,
-            "maintenance_recommendations": maintenance_recommendations,
-            "overall_recommendation": overall_recommendation,
-            "predicted_failure_time": predicted_failure_time,
+            **assessment,
             "confidence": confidence,
             "timestamp": datetime.now().isoformat()
-        })
+        }
+        
+        # Model scoring is additive; the rule-based result stands without it
+        if models.enabled:
+            try:
+                result["ml"] = models.predict({
+                    "temperature": temperature,
+                    "pressure": pressure,
+                    "vibration": vibration,
+                    "humidity": humidity,
+                    "timestamp": data.get("timestamp")
+                })
+            except Exception as e:
+                logger.warning(f"Model scoring unavailable: {str(e)}")
+        
+        return jsonify(result)
         
     except Exception as e:
-        app.logger.error(f"Prediction error: {str(e)}")
+        logger.error(f"Prediction error: {str(e)}")
         return jsonify({"error": "Invalid input data"}), 400
 
-@app.route("/nocode")
+@web.route("/api/predict/batch", methods=["POST"])
+@login_required
+def predict_batch_api():
+    """Score a list of readings with the served model in one pass"""
+    try:
+        readings = request.get_json()
+        if not isinstance(readings, list) or not all(isinstance(r, dict) for r in readings):
+            return jsonify({"error": "Expected a JSON list of readings"}), 400
+        return jsonify({"predictions": models.predict_many(readings) if readings else []})
+    except ModelUnavailable as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        logger.error(f"Batch prediction error: {str(e)}")
+        return jsonify({"error": "Invalid input data"}), 400
+
+@web.route("/api/models")
+@login_required
+def models_status():
+    """Model serving status"""
+    return jsonify(models.status())
+
+@web.route("/api/models/reload", methods=["POST"])
+@login_required
+def reload_model():
+    """Load a model bundle and swap it in for new requests (admin only)"""
+    if current_user.role != 'admin':
+        return jsonify({"error": "Admin access required"}), 403
+    try:
+        path = (request.get_json(silent=True) or {}).get("path")
+        # Never unpickle an arbitrary file named in the request
+        version = models.load(models.resolve(path) if path else None)
+        return jsonify({"status": "loaded", "version": version, "path": models.path})
+    except ModelUnavailable as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Model reload error: {str(e)}")
+        return jsonify({"error": f"Model could not be loaded: {str(e)}"}), 500
+
+# Admin backfills started from the UI, by job id
+import_jobs = {}
+
+def run_backfill(job_id, job, path):
+    """Import an uploaded file in this process, then rebuild derived data"""
+    try:
+        import backfill
+        job.run(collection=mongo.db.sensor_data)
+        backfill.rebuild_derived(mongo.db, job)
+        if retention.enabled:
+            backfill.archive_aged(mongo.db, job, retention.raw_cutoff, retention.codec, rollups=False)
+        # Newer imported readings become the devices' latest values
+        for device_id, (timestamp, data) in job.latest.items():
+            seen = timestamp.replace(tzinfo=timezone.utc).timestamp()
+            if seen > latest_seen.get(device_id, 0):
+                latest_sensor_data[device_id] = data
+                latest_seen[device_id] = seen
+        logger.info(f"Backfill {job_id} finished: {job.summary()}")
+    except Exception as e:
+        job.state = "failed"
+        job.error = str(e)
+        logger.error(f"Backfill {job_id} failed: {str(e)}")
+    finally:
+        os.remove(path)
+
+@web.route("/api/admin/import", methods=["POST"])
+@login_required
+def start_backfill():
+    """Stream an uploaded NDJSON, CSV or JSON history file into MongoDB (admin only)"""
+    if current_user.role != 'admin':
+        return jsonify({"error": "Admin access required"}), 403
+    if not mongo.available:
+        return jsonify({"error": "MongoDB is not available"}), 503
+    file = request.files.get('file')
+    if file is None or file.filename == '':
+        return jsonify({"error": "No file provided"}), 400
+    try:
+        import backfill
+        fmt = request.form.get('format') or backfill.detect_format(file.filename)
+        suffix = ".gz" if file.filename.endswith(".gz") else ""
+        handle, path = tempfile.mkstemp(prefix="smartx_import_", suffix=suffix)
+        with os.fdopen(handle, "wb") as f:
+            file.save(f)
+        job = backfill.ImportJob(path, fmt, device_id=request.form.get('device_id') or None, name=file.filename)
+    except Exception as e:
+        logger.error(f"Backfill setup error: {str(e)}")
+        return jsonify({"error": f"Import could not start: {str(e)}"}), 400
+    
+    job_id = f"import_{int(time.time() * 1000)}"
+    import_jobs[job_id] = job
+    threading.Thread(target=run_backfill, args=(job_id, job, path), daemon=True).start()
+    return jsonify({"job_id": job_id, "status": job.state}), 202
+
+@web.route("/api/admin/import/<job_id>")
+@login_required
+def backfill_status(job_id):
+    """Progress of an admin backfill"""
+    if current_user.role != 'admin':
+        return jsonify({"error": "Admin access required"}), 403
+    job = import_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown import job"}), 404
+    return jsonify({"job_id": job_id, **job.summary()})
+
+@web.route("/api/retention")
+@login_required
+def retention_status():
+    """Retention tiers and the last compaction pass"""
+    return jsonify(retention.status())
+
+@web.route("/api/compression")
+@login_required
+def compression_status():
+    """Ingest compression ratio and the default rules"""
+    return jsonify({**historian.status(), "default_rules": historian.rules.defaults})
+
+@web.route("/api/compression/rules/<device_type>", methods=["GET", "PUT"])
+@login_required
+def compression_rules(device_type):
+    """Effective compression rules for a device type; PUT replaces its overrides (admin only)"""
+    if request.method == "GET":
+        return jsonify({"device_type": device_type, **historian.rules.for_type(device_type)})
+    if current_user.role != 'admin':
+        return jsonify({"error": "Admin access required"}), 403
+    if not mongo.available:
+        return jsonify({"error": "MongoDB is not available"}), 503
+    try:
+        rules = historian.rules.save(device_type, request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"device_type": device_type, **rules})
+
+@web.route("/api/quantiles")
+@login_required
+def quantiles_api():
+    """Quantiles of one metric over a window, merged from hourly sketches per device or group"""
+    metric = request.args.get("metric", "")
+    if not metric or "." in metric or metric.startswith("$"):
+        return jsonify({"error": "metric is required"}), 400
+    try:
+        qs = [float(q) for q in request.args.get("q", "0.5,0.95,0.99").split(",")]
+        until = (datetime.fromisoformat(request.args["until"]) if request.args.get("until")
+                 else datetime.utcnow())
+        since = (datetime.fromisoformat(request.args["since"]) if request.args.get("since")
+                 else until - timedelta(hours=float(request.args.get("hours", 24))))
+    except ValueError:
+        return jsonify({"error": "q, hours, since and until must be numbers or ISO timestamps"}), 400
+    if any(not 0 <= q <= 1 for q in qs):
+        return jsonify({"error": "Quantiles must be between 0 and 1"}), 400
+    group_by = request.args.get("group_by", "device")
+    groupings = {"device": None, "all": lambda device_id: "all", "device_type": historian.rules.device_type}
+    if group_by not in groupings:
+        return jsonify({"error": f"group_by must be one of {', '.join(groupings)}"}), 400
+    if not mongo.available:
+        return jsonify({"error": "MongoDB is not available"}), 503
+    devices = [d.strip() for d in request.args.get("devices", "").split(",") if d.strip()]
+    try:
+        groups, buckets = sketches.query(metric, naive_utc(since), naive_utc(until),
+                                         qs, devices, groupings[group_by])
+    except Exception as e:
+        mongo.mark_failed(e)
+        logger.error(f"Quantile query failed: {str(e)}")
+        return jsonify({"error": "Quantile query failed"}), 500
+    return jsonify({
+        "metric": metric,
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+        "group_by": group_by,
+        "buckets": buckets,
+        "groups": groups
+    })
+
+@web.route("/api/uptime")
+@login_required
+def uptime_api():
+    """Uptime, availability, MTBF/MTTR and OEE per device for a window, from status events"""
+    try:
+        until = (datetime.fromisoformat(request.args["until"]) if request.args.get("until")
+                 else datetime.utcnow())
+        since = (datetime.fromisoformat(request.args["since"]) if request.args.get("since")
+                 else until - timedelta(hours=float(request.args.get("hours", 24))))
+    except ValueError:
+        return jsonify({"error": "hours, since and until must be numbers or ISO timestamps"}), 400
+    since, until = naive_utc(since), naive_utc(until)
+    if since >= until:
+        return jsonify({"error": "since must be before until"}), 400
+    if not mongo.available:
+        return jsonify({"error": "MongoDB is not available"}), 503
+    devices = [d.strip() for d in request.args.get("devices", "").split(",") if d.strip()]
+    try:
+        performance = status_events.performance_from_rollups(mongo.db, since, until, devices)
+        results = status_events.summarize(mongo.db, since, until, devices, status_tracker.offline_after,
+                                          performance=performance)
+    except Exception as e:
+        mongo.mark_failed(e)
+        logger.error(f"Uptime query failed: {str(e)}")
+        return jsonify({"error": "Uptime query failed"}), 500
+    return jsonify({
+        "since": since.isoformat(),
+        "until": until.isoformat(),
+        "devices": results,
+        "fleet": status_events.fleet_summary(results)
+    })
+
+@web.route("/api/status-events")
+@login_required
+def status_events_api():
+    """Status transitions of one device, newest first"""
+    device_id = request.args.get("device_id")
+    if not device_id:
+        return jsonify({"error": "device_id is required"}), 400
+    if not mongo.available:
+        return jsonify({"error": "MongoDB is not available"}), 503
+    hours = request.args.get("hours", 24, type=float)
+    limit = min(request.args.get("limit", 200, type=int), 1000)
+    since = datetime.utcnow() - timedelta(hours=hours)
+    cursor = mongo.db[status_events.EVENTS_COLLECTION].find(
+        {"device_id": device_id, "$or": [{"end": None}, {"end": {"$gt": since}}]},
+        {"_id": 0}, sort=[("start", -1)]).limit(limit)
+    events = [{**event, "start": event["start"].isoformat(),
+               "end": event["end"].isoformat() if event.get("end") else None} for event in cursor]
+    return jsonify({"device_id": device_id, "lifetime": status_events.lifetime(mongo.db, device_id),
+                    "events": events})
+
+@web.route("/api/fleet/summary")
+@login_required
+def fleet_summary_api():
+    """Aggregates per hierarchy node: plant root, location prefixes or device types"""
+    group_by = request.args.get("group_by", "location")
+    if group_by not in fleet.HIERARCHIES:
+        return jsonify({"error": f"group_by must be one of {', '.join(fleet.HIERARCHIES)}"}), 400
+    depth = request.args.get("depth", type=int)
+    if fleet_index.running:
+        nodes, source = fleet_index.raw_nodes(group_by), "live"
+    elif mongo.available:
+        # Web-only processes serve what the ingest processes last published
+        try:
+            nodes = fleet.read_snapshots(mongo.db, group_by, 3 * fleet_index.publish_interval)
+        except Exception as e:
+            mongo.mark_failed(e)
+            return jsonify({"error": "MongoDB is not available"}), 503
+        source = "snapshot"
+    else:
+        return jsonify({"error": "MongoDB is not available"}), 503
+    nodes = [fleet.render(node) for node in nodes]
+    if depth is not None:
+        nodes = [node for node in nodes if node["depth"] == depth]
+    nodes.sort(key=lambda node: (node["depth"], node["node"]))
+    return jsonify({"group_by": group_by, "source": source, "nodes": nodes})
+
+@web.route("/api/top")
+@login_required
+def top_devices_api():
+    """Devices with the highest current risk score or metric value"""
+    metric = request.args.get("metric", fleet.RISK)
+    k = request.args.get("k", 20, type=int)
+    if not 1 <= k <= fleet.TOP_MAX:
+        return jsonify({"error": f"k must be between 1 and {fleet.TOP_MAX}"}), 400
+    if fleet_index.running:
+        entries, source = fleet_index.top(metric, k), "live"
+    elif mongo.available:
+        try:
+            entries = fleet.read_top(mongo.db, metric, k, 3 * fleet_index.publish_interval)
+        except Exception as e:
+            mongo.mark_failed(e)
+            return jsonify({"error": "MongoDB is not available"}), 503
+        source = "snapshot"
+    else:
+        return jsonify({"error": "MongoDB is not available"}), 503
+    return jsonify({"metric": metric, "k": k, "source": source, "devices": fleet.render_top(entries, metric)})
+
+@web.route("/api/alerts")
+@login_required
+def alerts_api():
+    """Open alerts, optionally of one device"""
+    device_id = request.args.get("device_id")
+    if not alert_engine.running and not mongo.available:
+        return jsonify({"error": "MongoDB is not available"}), 503
+    open_alerts = sorted(get_open_alerts(device_id), key=lambda alert: alert["opened"], reverse=True)
+    return jsonify({"source": "live" if alert_engine.running else "stored",
+                    "count": len(open_alerts),
+                    "alerts": [alerts.serialize(alert) for alert in open_alerts]})
+
+@web.route("/api/alerts/history")
+@login_required
+def alert_history_api():
+    """Alerts open at any point in the last `hours`, newest first"""
+    if not mongo.available:
+        return jsonify({"error": "MongoDB is not available"}), 503
+    hours = request.args.get("hours", 24, type=float)
+    limit = min(request.args.get("limit", 200, type=int), 1000)
+    since = datetime.utcnow() - timedelta(hours=hours)
+    try:
+        history = alerts.alert_history(mongo.db, since, request.args.get("device_id"), limit)
+    except Exception as e:
+        mongo.mark_failed(e)
+        return jsonify({"error": "MongoDB is not available"}), 503
+    return jsonify({"alerts": [alerts.serialize(alert) for alert in history]})
+
+@web.route("/api/rate-control")
+@login_required
+def rate_control_status():
+    """Publish-rate controller load, scale and devices under control"""
+    return jsonify(rate_controller.status())
+
+@web.route("/api/spool")
+@login_required
+def spool_status():
+    """Readings waiting in the write-ahead spool for MongoDB"""
+    return jsonify(spool.status())
+
+@web.route("/nocode")
 @login_required
 def nocode():
     return render_template("blockly.html")
 
 # Device Connection Routes
-@app.route("/api/device-connection/qr-setup", methods=["POST"])
+@web.route("/api/device-connection/qr-setup", methods=["POST"])
 @login_required
 def qr_setup():
     """Handle QR code device setup"""
@@ -554,10 +1232,10 @@ def qr_setup():
         }), 200
         
     except Exception as e:
-        app.logger.error(f"QR setup error: {str(e)}")
+        logger.error(f"QR setup error: {str(e)}")
         return jsonify({"error": "QR setup failed"}), 500
 
-@app.route("/api/device-connection/wifi-setup", methods=["POST"])
+@web.route("/api/device-connection/wifi-setup", methods=["POST"])
 @login_required
 def wifi_setup():
     """Handle WiFi device setup"""
@@ -590,10 +1268,10 @@ def wifi_setup():
         }), 200
         
     except Exception as e:
-        app.logger.error(f"WiFi setup error: {str(e)}")
+        logger.error(f"WiFi setup error: {str(e)}")
         return jsonify({"error": "WiFi setup failed"}), 500
 
-@app.route("/api/device-connection/mqtt-setup", methods=["POST"])
+@web.route("/api/device-connection/mqtt-setup", methods=["POST"])
 @login_required
 def mqtt_setup():
     """Handle MQTT device setup"""
@@ -609,8 +1287,8 @@ def mqtt_setup():
             "device_id": device_id,
             "setup_method": "mqtt",
             "mqtt_topic": mqtt_topic,
-            "mqtt_broker": MQTT_BROKER,
-            "mqtt_port": MQTT_PORT,
+            "mqtt_broker": current_app.config["MQTT_BROKER"],
+            "mqtt_port": current_app.config["MQTT_PORT"],
             "status": "connected",
             "timestamp": datetime.now().isoformat()
         }
@@ -630,10 +1308,10 @@ def mqtt_setup():
         }), 200
         
     except Exception as e:
-        app.logger.error(f"MQTT setup error: {str(e)}")
+        logger.error(f"MQTT setup error: {str(e)}")
         return jsonify({"error": "MQTT setup failed"}), 500
 
-@app.route("/api/device-connection/bulk-import", methods=["POST"])
+@web.route("/api/device-connection/bulk-import", methods=["POST"])
 @login_required
 def bulk_import():
     """Handle bulk device import via CSV"""
@@ -684,10 +1362,10 @@ def bulk_import():
         }), 200
         
     except Exception as e:
-        app.logger.error(f"Bulk import error: {str(e)}")
+        logger.error(f"Bulk import error: {str(e)}")
         return jsonify({"error": "Bulk import failed"}), 500
 
-@app.route("/api/connected-devices")
+@web.route("/api/connected-devices")
 @login_required
 def get_connected_devices():
     """Get list of all connected devices"""
@@ -699,967 +1377,113 @@ def get_connected_devices():
         }), 200
         
     except Exception as e:
-        app.logger.error(f"Get devices error: {str(e)}")
+        logger.error(f"Get devices error: {str(e)}")
         return jsonify({"error": "Failed to retrieve devices"}), 500
 
-@app.route("/api/generate-code", methods=["POST"])
+@web.route("/api/generate-code", methods=["POST"])
 @login_required
 def generate_code():
     """Generate Python code from enhanced block configurations"""
     try:
-        data = request.get_json()
-        blocks_config = data.get("blocks", [])
-        code_type = data.get("type", "monitoring")
-        
-        # Enhanced code generation based on block types
-        if code_type == "iot_automation":
-            generated_code = generate_iot_automation_code(blocks_config)
-        elif code_type == "data_processing":
-            generated_code = generate_data_processing_code(blocks_config)
-        elif code_type == "ml_prediction":
-            generated_code = generate_ml_code(blocks_config)
-        elif code_type == "mqtt_handler":
-            generated_code = generate_mqtt_code(blocks_config)
-        else:
-            generated_code = generate_basic_monitoring_code(blocks_config)
+        # Templates are loaded on first use so other processes never import them
+        from codegen import build_artifact, cached_artifact, BlockGraphError
+        body = request.get_data()
+        artifact = cached_artifact(body)
+        cached = artifact is not None
+        if not cached:
+            data = request.get_json()
+            blocks_config = data.get("blocks", [])
+            code_type = data.get("type")
+            try:
+                artifact, cached = build_artifact(code_type, blocks_config, raw=body)
+            except BlockGraphError as e:
+                return jsonify({"error": str(e)}), 400
+        code_type = artifact["type"]
         
         return jsonify({
-            "code": generated_code,
+            "code": artifact["code"],
             "filename": f"smartx_{code_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.py",
-            "type": code_type
+            "type": code_type,
+            "hash": artifact["hash"],
+            "cached": cached,
+            "syntax_ok": artifact["syntax_ok"],
+            "syntax_error": artifact["syntax_error"]
         })
         
     except Exception as e:
-        app.logger.error(f"Code generation error: {str(e)}")
+        logger.error(f"Code generation error: {str(e)}")
         return jsonify({"error": "Code generation failed"}), 400
 
-def generate_iot_automation_code(blocks):
-    return """#!/usr/bin/env python3
-\"\"\"
-SmartX IoT Automation Code
-Generated automatically from visual blocks
-\"\"\"
-import paho.mqtt.client as mqtt
-import json
-import time
-from datetime import datetime
-import logging
-
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
-class IoTAutomationSystem:
-    def __init__(self, broker_host="localhost", broker_port=1883):
-        self.broker_host = broker_host
-        self.broker_port = broker_port
-        self.client = mqtt.Client()
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
-        self.thresholds = {
-            'temperature': {'min': 60, 'max': 85},
-            'pressure': {'min': 1.0, 'max': 2.0},
-            'vibration': {'min': 0.1, 'max': 0.7},
-            'humidity': {'min': 40, 'max': 60}
-        }
-        
-    def on_connect(self, client, userdata, flags, rc):
-        if rc == 0:
-            logger.info("Connected to MQTT broker")
-            client.subscribe("smartx/sensors/+")
-            client.subscribe("smartx/control/+")
-        else:
-            logger.error(f"Connection failed: {rc}")
-    
-    def on_message(self, client, userdata, msg):
-        try:
-            topic_parts = msg.topic.split('/')
-            device_id = topic_parts[-1]
-            data = json.loads(msg.payload.decode())
-            
-            logger.info(f"Received data from {device_id}: {data}")
-            
-            # Process automation rules
-            self.process_automation_rules(device_id, data)
-            
-        except Exception as e:
-            logger.error(f"Error processing message: {e}")
-    
-    def process_automation_rules(self, device_id, data):
-        \"\"\"Process automation rules based on sensor data\"\"\"
-        alerts = []
-        actions = []
-        
-        # Temperature control
-        if 'temperature' in data:
-            temp = data['temperature']
-            if temp > self.thresholds['temperature']['max']:
-                alerts.append(f"High temperature alert: {temp}°F")
-                actions.append("activate_cooling_system")
-            elif temp < self.thresholds['temperature']['min']:
-                alerts.append(f"Low temperature alert: {temp}°F")
-                actions.append("activate_heating_system")
-        
-        # Pressure control
-        if 'pressure' in data:
-            pressure = data['pressure']
-            if pressure > self.thresholds['pressure']['max']:
-                alerts.append(f"High pressure alert: {pressure} bar")
-                actions.append("open_pressure_relief_valve")
-        
-        # Vibration monitoring
-        if 'vibration' in data:
-            vibration = data['vibration']
-            if vibration > self.thresholds['vibration']['max']:
-                alerts.append(f"Excessive vibration: {vibration}")
-                actions.append("reduce_machine_speed")
-        
-        # Execute actions
-        for action in actions:
-            self.execute_action(device_id, action)
-        
-        # Send alerts
-        if alerts:
-            self.send_alerts(device_id, alerts)
-    
-    def execute_action(self, device_id, action):
-        \"\"\"Execute automation action\"\"\"
-        control_topic = f"smartx/control/{device_id}"
-        control_message = {
-            'action': action,
-            'timestamp': datetime.now().isoformat(),
-            'source': 'automation_system'
-        }
-        
-        self.client.publish(control_topic, json.dumps(control_message))
-        logger.info(f"Executed action: {action} for device {device_id}")
-    
-    def send_alerts(self, device_id, alerts):
-        \"\"\"Send alert notifications\"\"\"
-        alert_topic = f"smartx/alerts/{device_id}"
-        alert_message = {
-            'alerts': alerts,
-            'timestamp': datetime.now().isoformat(),
-            'device_id': device_id
-        }
-        
-        self.client.publish(alert_topic, json.dumps(alert_message))
-        logger.warning(f"Alerts sent for {device_id}: {alerts}")
-    
-    def start(self):
-        \"\"\"Start the automation system\"\"\"
-        logger.info("Starting IoT Automation System...")
-        self.client.connect(self.broker_host, self.broker_port, 60)
-        self.client.loop_forever()
-
-if __name__ == "__main__":
-    system = IoTAutomationSystem()
-    system.start()
-"""
-
-def generate_data_processing_code(blocks):
-    return """#!/usr/bin/env python3
-\"\"\"
-SmartX Data Processing Pipeline
-Generated automatically from visual blocks
-\"\"\"
-import pandas as pd
-import numpy as np
-from datetime import datetime, timedelta
-import json
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-class DataProcessor:
-    def __init__(self):
-        self.data_buffer = []
-        self.analysis_results = {}
-        
-    def load_sensor_data(self, source_type="mongodb", **kwargs):
-        \"\"\"Load sensor data from various sources\"\"\"
-        if source_type == "mongodb":
-            return self.load_from_mongodb(**kwargs)
-        elif source_type == "csv":
-            return self.load_from_csv(**kwargs)
-        elif source_type == "json":
-            return self.load_from_json(**kwargs)
-        else:
-            raise ValueError(f"Unsupported source type: {source_type}")
-    
-    def load_from_mongodb(self, collection_name="sensor_data", hours=24):
-        \"\"\"Load data from MongoDB\"\"\"
-        try:
-            from pymongo import MongoClient
-            client = MongoClient('mongodb://localhost:27017/')
-            db = client['smartx_iot']
-            collection = db[collection_name]
-            
-            since = datetime.utcnow() - timedelta(hours=hours)
-            cursor = collection.find({'timestamp': {'$gte': since}})
-            
-            data = []
-            for record in cursor:
-                record['_id'] = str(record['_id'])
-                data.append(record)
-            
-            return pd.DataFrame(data)
-        except Exception as e:
-            print(f"Error loading from MongoDB: {e}")
-            return pd.DataFrame()
-    
-    def clean_data(self, df):
-        \"\"\"Clean and preprocess sensor data\"\"\"
-        # Remove duplicates
-        df = df.drop_duplicates()
-        
-        # Handle missing values
-        numeric_columns = df.select_dtypes(include=[np.number]).columns
-        df[numeric_columns] = df[numeric_columns].fillna(df[numeric_columns].mean())
-        
-        # Remove outliers using IQR method
-        for column in numeric_columns:
-            Q1 = df[column].quantile(0.25)
-            Q3 = df[column].quantile(0.75)
-            IQR = Q3 - Q1
-            lower_bound = Q1 - 1.5 * IQR
-            upper_bound = Q3 + 1.5 * IQR
-            df = df[(df[column] >= lower_bound) & (df[column] <= upper_bound)]
-        
-        return df
-    
-    def calculate_statistics(self, df):
-        \"\"\"Calculate comprehensive statistics\"\"\"
-        stats = {}
-        
-        numeric_columns = df.select_dtypes(include=[np.number]).columns
-        for column in numeric_columns:
-            stats[column] = {
-                'mean': df[column].mean(),
-                'median': df[column].median(),
-                'std': df[column].std(),
-                'min': df[column].min(),
-                'max': df[column].max(),
-                'q25': df[column].quantile(0.25),
-                'q75': df[column].quantile(0.75)
-            }
-        
-        return stats
-    
-    def detect_anomalies(self, df, threshold=2):
-        \"\"\"Detect anomalies using statistical methods\"\"\"
-        anomalies = {}
-        
-        numeric_columns = df.select_dtypes(include=[np.number]).columns
-        for column in numeric_columns:
-            mean = df[column].mean()
-            std = df[column].std()
-            
-            # Z-score method
-            z_scores = np.abs((df[column] - mean) / std)
-            anomaly_indices = df.index[z_scores > threshold].tolist()
-            
-            anomalies[column] = {
-                'count': len(anomaly_indices),
-                'indices': anomaly_indices,
-                'values': df.loc[anomaly_indices, column].tolist()
-            }
-        
-        return anomalies
-    
-    def generate_trends(self, df):
-        \"\"\"Generate trend analysis\"\"\"
-        trends = {}
-        
-        if 'timestamp' in df.columns:
-            df['timestamp'] = pd.to_datetime(df['timestamp'])
-            df = df.sort_values('timestamp')
-            
-            numeric_columns = df.select_dtypes(include=[np.number]).columns
-            for column in numeric_columns:
-                # Calculate moving averages
-                df[f'{column}_ma_5'] = df[column].rolling(window=5).mean()
-                df[f'{column}_ma_10'] = df[column].rolling(window=10).mean()
-                
-                # Calculate trend slope
-                x = np.arange(len(df))
-                slope = np.polyfit(x, df[column].dropna(), 1)[0]
-                
-                trends[column] = {
-                    'slope': slope,
-                    'direction': 'increasing' if slope > 0 else 'decreasing',
-                    'magnitude': abs(slope)
-                }
-        
-        return trends
-    
-    def generate_report(self, df):
-        \"\"\"Generate comprehensive analysis report\"\"\"
-        report = {
-            'timestamp': datetime.now().isoformat(),
-            'data_summary': {
-                'total_records': len(df),
-                'date_range': {
-                    'start': df['timestamp'].min() if 'timestamp' in df.columns else None,
-                    'end': df['timestamp'].max() if 'timestamp' in df.columns else None
-                }
-            },
-            'statistics': self.calculate_statistics(df),
-            'anomalies': self.detect_anomalies(df),
-            'trends': self.generate_trends(df)
-        }
-        
-        return report
-    
-    def export_results(self, report, format='json'):
-        \"\"\"Export analysis results\"\"\"
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        
-        if format == 'json':
-            filename = f'smartx_analysis_{timestamp}.json'
-            with open(filename, 'w') as f:
-                json.dump(report, f, indent=2, default=str)
-        
-        elif format == 'csv':
-            filename = f'smartx_analysis_{timestamp}.csv'
-            # Convert nested dict to flat structure for CSV
-            flat_data = []
-            for metric, stats in report['statistics'].items():
-                for stat_name, value in stats.items():
-                    flat_data.append({
-                        'metric': metric,
-                        'statistic': stat_name,
-                        'value': value
-                    })
-            
-            pd.DataFrame(flat_data).to_csv(filename, index=False)
-        
-        return filename
-
-def main():
-    processor = DataProcessor()
-    
-    # Load and process data
-    df = processor.load_sensor_data(source_type="mongodb", hours=24)
-    
-    if not df.empty:
-        # Clean data
-        df_clean = processor.clean_data(df)
-        
-        # Generate analysis report
-        report = processor.generate_report(df_clean)
-        
-        # Export results
-        filename = processor.export_results(report, format='json')
-        print(f"Analysis complete. Results saved to: {filename}")
-    else:
-        print("No data available for processing")
-
-if __name__ == "__main__":
-    main()
-"""
-
-def generate_ml_code(blocks):
-    return """#!/usr/bin/env python3
-\"\"\"
-SmartX Machine Learning Prediction System
-Generated automatically from visual blocks
-\"\"\"
-import numpy as np
-import pandas as pd
-from sklearn.ensemble import RandomForestRegressor, IsolationForest
-from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import mean_squared_error, r2_score
-import joblib
-from datetime import datetime, timedelta
-import warnings
-warnings.filterwarnings('ignore')
-
-class SmartXMLSystem:
-    def __init__(self):
-        self.models = {}
-        self.scalers = {}
-        self.feature_importance = {}
-        
-    def prepare_features(self, df):
-        \"\"\"Prepare features for machine learning\"\"\"
-        features = []
-        
-        # Basic sensor readings
-        sensor_cols = ['temperature', 'pressure', 'vibration', 'humidity']
-        for col in sensor_cols:
-            if col in df.columns:
-                features.append(col)
-        
-        # Time-based features
-        if 'timestamp' in df.columns:
-            df['timestamp'] = pd.to_datetime(df['timestamp'])
-            df['hour'] = df['timestamp'].dt.hour
-            df['day_of_week'] = df['timestamp'].dt.dayofweek
-            features.extend(['hour', 'day_of_week'])
-        
-        # Rolling statistics (if enough data)
-        if len(df) > 10:
-            for col in sensor_cols:
-                if col in df.columns:
-                    df[f'{col}_rolling_mean'] = df[col].rolling(window=5, min_periods=1).mean()
-                    df[f'{col}_rolling_std'] = df[col].rolling(window=5, min_periods=1).std()
-                    features.extend([f'{col}_rolling_mean', f'{col}_rolling_std'])
-        
-        # Lag features
-        for col in sensor_cols:
-            if col in df.columns and len(df) > 5:
-                df[f'{col}_lag1'] = df[col].shift(1)
-                df[f'{col}_lag2'] = df[col].shift(2)
-                features.extend([f'{col}_lag1', f'{col}_lag2'])
-        
-        return df[features].fillna(method='forward').fillna(0)
-    
-    def train_failure_prediction(self, df):
-        \"\"\"Train model to predict equipment failure\"\"\"
-        try:
-            # Prepare features
-            X = self.prepare_features(df)
-            
-            # Create failure labels (simplified logic)
-            y = (
-                (df['temperature'] > 85) |
-                (df['pressure'] > 2.0) |
-                (df['vibration'] > 0.8)
-            ).astype(int)
-            
-            # Split data
-            X_train, X_test, y_train, y_test = train_test_split(
-                X, y, test_size=0.2, random_state=42, stratify=y
-            )
-            
-            # Scale features
-            scaler = StandardScaler()
-            X_train_scaled = scaler.fit_transform(X_train)
-            X_test_scaled = scaler.transform(X_test)
-            
-            # Train model
-            model = RandomForestRegressor(
-                n_estimators=100,
-                random_state=42,
-                max_depth=10
-            )
-            model.fit(X_train_scaled, y_train)
-            
-            # Evaluate
-            y_pred = model.predict(X_test_scaled)
-            mse = mean_squared_error(y_test, y_pred)
-            r2 = r2_score(y_test, y_pred)
-            
-            # Store model and scaler
-            self.models['failure_prediction'] = model
-            self.scalers['failure_prediction'] = scaler
-            self.feature_importance['failure_prediction'] = dict(
-                zip(X.columns, model.feature_importances_)
-            )
-            
-            return {
-                'model_type': 'failure_prediction',
-                'mse': mse,
-                'r2_score': r2,
-                'feature_importance': self.feature_importance['failure_prediction']
-            }
-            
-        except Exception as e:
-            print(f"Error training failure prediction model: {e}")
-            return None
-    
-    def train_anomaly_detection(self, df):
-        \"\"\"Train anomaly detection model\"\"\"
-        try:
-            # Prepare features
-            X = self.prepare_features(df)
-            
-            # Scale features
-            scaler = StandardScaler()
-            X_scaled = scaler.fit_transform(X)
-            
-            # Train isolation forest
-            model = IsolationForest(
-                contamination=0.1,
-                random_state=42,
-                n_estimators=100
-            )
-            model.fit(X_scaled)
-            
-            # Store model and scaler
-            self.models['anomaly_detection'] = model
-            self.scalers['anomaly_detection'] = scaler
-            
-            # Detect anomalies in training data
-            anomaly_scores = model.decision_function(X_scaled)
-            anomalies = model.predict(X_scaled)
-            
-            return {
-                'model_type': 'anomaly_detection',
-                'anomaly_count': sum(anomalies == -1),
-                'anomaly_percentage': (sum(anomalies == -1) / len(anomalies)) * 100
-            }
-            
-        except Exception as e:
-            print(f"Error training anomaly detection model: {e}")
-            return None
-    
-    def predict_failure_probability(self, sensor_data):
-        \"\"\"Predict failure probability for new sensor data\"\"\"
-        try:
-            if 'failure_prediction' not in self.models:
-                return None
-            
-            # Convert to DataFrame
-            df = pd.DataFrame([sensor_data])
-            
-            # Prepare features
-            X = self.prepare_features(df)
-            
-            # Scale features
-            X_scaled = self.scalers['failure_prediction'].transform(X)
-            
-            # Predict
-            probability = self.models['failure_prediction'].predict(X_scaled)[0]
-            
-            # Convert to risk level
-            if probability > 0.8:
-                risk_level = "Critical"
-            elif probability > 0.6:
-                risk_level = "High"
-            elif probability > 0.4:
-                risk_level = "Medium"
-            else:
-                risk_level = "Low"
-            
-            return {
-                'failure_probability': float(probability),
-                'risk_level': risk_level,
-                'confidence': min(100, max(60, probability * 100)),
-                'timestamp': datetime.now().isoformat()
-            }
-            
-        except Exception as e:
-            print(f"Error predicting failure: {e}")
-            return None
-    
-    def detect_anomaly(self, sensor_data):
-        \"\"\"Detect if sensor data is anomalous\"\"\"
-        try:
-            if 'anomaly_detection' not in self.models:
-                return None
-            
-            # Convert to DataFrame
-            df = pd.DataFrame([sensor_data])
-            
-            # Prepare features
-            X = self.prepare_features(df)
-            
-            # Scale features
-            X_scaled = self.scalers['anomaly_detection'].transform(X)
-            
-            # Predict
-            is_anomaly = self.models['anomaly_detection'].predict(X_scaled)[0] == -1
-            anomaly_score = self.models['anomaly_detection'].decision_function(X_scaled)[0]
-            
-            return {
-                'is_anomaly': bool(is_anomaly),
-                'anomaly_score': float(anomaly_score),
-                'severity': 'High' if anomaly_score < -0.5 else 'Medium' if anomaly_score < 0 else 'Low',
-                'timestamp': datetime.now().isoformat()
-            }
-            
-        except Exception as e:
-            print(f"Error detecting anomaly: {e}")
-            return None
-    
-    def save_models(self, filepath_prefix="smartx_ml_models"):
-        \"\"\"Save trained models to disk\"\"\"
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        
-        for model_name, model in self.models.items():
-            model_file = f"{filepath_prefix}_{model_name}_{timestamp}.joblib"
-            scaler_file = f"{filepath_prefix}_{model_name}_scaler_{timestamp}.joblib"
-            
-            joblib.dump(model, model_file)
-            joblib.dump(self.scalers[model_name], scaler_file)
-            
-            print(f"Saved {model_name} model: {model_file}")
-            print(f"Saved {model_name} scaler: {scaler_file}")
-    
-    def load_models(self, model_files):
-        \"\"\"Load pre-trained models from disk\"\"\"
-        for model_name, files in model_files.items():
-            self.models[model_name] = joblib.load(files['model'])
-            self.scalers[model_name] = joblib.load(files['scaler'])
-            print(f"Loaded {model_name} model")
-
-def main():
-    # Example usage
-    ml_system = SmartXMLSystem()
-    
-    # Generate sample data for demonstration
-    np.random.seed(42)
-    n_samples = 1000
-    
-    sample_data = pd.DataFrame({
-        'temperature': np.random.normal(75, 10, n_samples),
-        'pressure': np.random.normal(1.5, 0.3, n_samples),
-        'vibration': np.random.exponential(0.3, n_samples),
-        'humidity': np.random.normal(50, 8, n_samples),
-        'timestamp': pd.date_range(start='2024-01-01', periods=n_samples, freq='H')
-    })
-    
-    # Add some anomalies
-    anomaly_indices = np.random.choice(n_samples, size=50, replace=False)
-    sample_data.loc[anomaly_indices, 'temperature'] += 20
-    sample_data.loc[anomaly_indices, 'pressure'] += 1.0
-    
-    print("Training ML models...")
-    
-    # Train models
-    failure_results = ml_system.train_failure_prediction(sample_data)
-    anomaly_results = ml_system.train_anomaly_detection(sample_data)
-    
-    if failure_results:
-        print(f"Failure Prediction Model - R2 Score: {failure_results['r2_score']:.3f}")
-    
-    if anomaly_results:
-        print(f"Anomaly Detection Model - Anomalies Found: {anomaly_results['anomaly_count']}")
-    
-    # Test prediction on new data
-    test_data = {
-        'temperature': 95,
-        'pressure': 2.5,
-        'vibration': 0.9,
-        'humidity': 45
-    }
-    
-    failure_pred = ml_system.predict_failure_probability(test_data)
-    anomaly_pred = ml_system.detect_anomaly(test_data)
-    
-    if failure_pred:
-        print(f"Failure Prediction: {failure_pred}")
-    
-    if anomaly_pred:
-        print(f"Anomaly Detection: {anomaly_pred}")
-    
-    # Save models
-    ml_system.save_models()
-
-if __name__ == "__main__":
-    main()
-"""
-
-def generate_mqtt_code(blocks):
-    return """#!/usr/bin/env python3
-\"\"\"
-SmartX MQTT Device Simulator
-Generated automatically from visual blocks
-\"\"\"
-import paho.mqtt.client as mqtt
-import json
-import time
-import random
-from datetime import datetime
-import threading
+def create_app(config=None):
+    """Build the Flask app for the configured role
 
-class MQTTDeviceSimulator:
-    def __init__(self, broker_host="localhost", broker_port=1883, device_id="smartx_device_01"):
-        self.broker_host = broker_host
-        self.broker_port = broker_port
-        self.device_id = device_id
-        self.client = mqtt.Client()
-        self.client.on_connect = self.on_connect
-        self.client.on_message = self.on_message
-        self.running = False
-        
-    def on_connect(self, client, userdata, flags, rc):
-        if rc == 0:
-            print(f"Device {self.device_id} connected to MQTT broker")
-            # Subscribe to control messages
-            client.subscribe(f"smartx/control/{self.device_id}")
-        else:
-            print(f"Connection failed: {rc}")
-    
-    def on_message(self, client, userdata, msg):
-        try:
-            control_data = json.loads(msg.payload.decode())
-            print(f"Received control message: {control_data}")
-            self.handle_control_message(control_data)
-        except Exception as e:
-            print(f"Error processing control message: {e}")
-    
-    def handle_control_message(self, control_data):
-        \"\"\"Handle control messages from the system\"\"\"
-        action = control_data.get('action')
-        
-        if action == "activate_cooling_system":
-            print("Activating cooling system...")
-        elif action == "activate_heating_system":
-            print("Activating heating system...")
-        elif action == "open_pressure_relief_valve":
-            print("Opening pressure relief valve...")
-        elif action == "reduce_machine_speed":
-            print("Reducing machine speed...")
-        else:
-            print(f"Unknown action: {action}")
-    
-    def generate_sensor_data(self):
-        \"\"\"Generate realistic sensor data\"\"\"
-        base_temp = 75
-        base_pressure = 1.5
-        base_vibration = 0.3
-        base_humidity = 50
-        
-        # Add some realistic variation
-        temperature = base_temp + random.gauss(0, 5)
-        pressure = base_pressure + random.gauss(0, 0.2)
-        vibration = max(0.1, base_vibration + random.gauss(0, 0.1))
-        humidity = max(30, min(70, base_humidity + random.gauss(0, 3)))
-        
-        # Occasionally simulate issues
-        if random.random() < 0.05:  # 5% chance of high temperature
-            temperature += random.uniform(10, 20)
-        
-        if random.random() < 0.03:  # 3% chance of high pressure
-            pressure += random.uniform(0.5, 1.0)
-        
-        if random.random() < 0.04:  # 4% chance of high vibration
-            vibration += random.uniform(0.3, 0.6)
-        
-        # Determine status based on readings
-        if temperature > 85 or pressure > 2.0 or vibration > 0.8:
-            status = "Warning"
-        elif temperature > 90 or pressure > 2.2 or vibration > 1.0:
-            status = "Critical"
-        else:
-            status = "Running"
-        
-        # Calculate efficiency (decreases with problems)
-        efficiency = 95
-        if temperature > 80:
-            efficiency -= (temperature - 80) * 2
-        if pressure > 1.8:
-            efficiency -= (pressure - 1.8) * 10
-        if vibration > 0.6:
-            efficiency -= (vibration - 0.6) * 20
-        
-        efficiency = max(60, min(100, efficiency))
-        
-        return {
-            "device_id": self.device_id,
-            "temperature": round(temperature, 1),
-            "pressure": round(pressure, 2),
-            "vibration": round(vibration, 2),
-            "humidity": round(humidity, 1),
-            "status": status,
-            "efficiency": round(efficiency, 1),
-            "timestamp": datetime.now().isoformat()
-        }
+    Nothing here opens a socket: MongoDB and MQTT are started later by
+    start_background_services(), which runs per process after any fork.
+    """
+    app = Flask(__name__)
+    app.config.update(default_config())
+    if config:
+        app.config.update(config)
+    role = app.config["SMARTX_ROLE"]
+    if role not in ROLES:
+        raise ValueError(f"Unknown SMARTX_ROLE {role!r}, expected one of {', '.join(ROLES)}")
     
-    def publish_sensor_data(self):
-        \"\"\"Publish sensor data to MQTT topic\"\"\"
-        data = self.generate_sensor_data()
-        topic = f"smartx/sensors/{self.device_id}"
-        
-        try:
-            self.client.publish(topic, json.dumps(data))
-            print(f"Published data: {json.dumps(data, indent=2)}")
-        except Exception as e:
-            print(f"Error publishing data: {e}")
+    # Configure logging
+    logging.basicConfig(level=app.config["LOG_LEVEL"])
     
-    def start_simulation(self, interval=5):
-        \"\"\"Start the device simulation\"\"\"
-        print(f"Starting MQTT device simulation for {self.device_id}")
-        self.running = True
-        
-        # Connect to broker
-        try:
-            self.client.connect(self.broker_host, self.broker_port, 60)
-            self.client.loop_start()
-        except Exception as e:
-            print(f"Failed to connect to MQTT broker: {e}")
-            return
-        
-        # Publish data at regular intervals
-        while self.running:
-            self.publish_sensor_data()
-            time.sleep(interval)
-    
-    def stop_simulation(self):
-        \"\"\"Stop the device simulation\"\"\"
-        self.running = False
-        self.client.loop_stop()
-        self.client.disconnect()
-        print(f"Stopped simulation for {self.device_id}")
-
-class MultiDeviceSimulator:
-    def __init__(self, broker_host="localhost", broker_port=1883):
-        self.broker_host = broker_host
-        self.broker_port = broker_port
-        self.devices = []
-        self.threads = []
-    
-    def add_device(self, device_id, interval=5):
-        \"\"\"Add a device to the simulation\"\"\"
-        device = MQTTDeviceSimulator(
-            self.broker_host, 
-            self.broker_port, 
-            device_id
-        )
-        self.devices.append((device, interval))
-        print(f"Added device: {device_id}")
-    
-    def start_all_devices(self):
-        \"\"\"Start simulation for all devices\"\"\"
-        print(f"Starting simulation for {len(self.devices)} devices...")
-        
-        for device, interval in self.devices:
-            thread = threading.Thread(
-                target=device.start_simulation,
-                args=(interval,)
-            )
-            thread.daemon = True
-            thread.start()
-            self.threads.append(thread)
-        
-        try:
-            # Keep the main thread alive
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            print("\\nStopping all device simulations...")
-            for device, _ in self.devices:
-                device.stop_simulation()
-
-def main():
-    # Single device simulation
-    print("SmartX MQTT Device Simulator")
-    print("Choose simulation mode:")
-    print("1. Single device")
-    print("2. Multiple devices")
-    
-    choice = input("Enter choice (1 or 2): ").strip()
+    mongo.init_app(app)
+    models.init_app(app)
+    retention.init_app(app)
+    spool.init_app(app)
+    device_directory.init_app(app)
+    historian.init_app(app)
+    sketches.init_app(app)
+    status_tracker.init_app(app)
+    alert_engine.init_app(app)
+    fleet_index.init_app(app)
+    rate_controller.init_app(app)
+    login_manager.init_app(app)
     
-    if choice == "1":
-        device_id = input("Enter device ID (default: smartx_device_01): ").strip()
-        if not device_id:
-            device_id = "smartx_device_01"
-        
-        interval = input("Enter data publish interval in seconds (default: 5): ").strip()
-        try:
-            interval = int(interval) if interval else 5
-        except ValueError:
-            interval = 5
-        
-        device = MQTTDeviceSimulator(device_id=device_id)
-        device.start_simulation(interval)
+    if role in ("all", "web"):
+        app.register_blueprint(web)
+    if role in ("all", "ingest"):
+        app.register_blueprint(ingest)
     
-    elif choice == "2":
-        num_devices = input("Enter number of devices (default: 3): ").strip()
-        try:
-            num_devices = int(num_devices) if num_devices else 3
-        except ValueError:
-            num_devices = 3
-        
-        simulator = MultiDeviceSimulator()
-        
-        for i in range(num_devices):
-            device_id = f"smartx_device_{i+1:02d}"
-            interval = random.randint(3, 8)  # Random interval between 3-8 seconds
-            simulator.add_device(device_id, interval)
-        
-        simulator.start_all_devices()
+    app.before_request(start_request_timer)
+    app.after_request(record_request_latency)
+    app.add_url_rule("/metrics", "metrics", metrics_endpoint)
     
-    else:
-        print("Invalid choice. Exiting.")
+    # Must run after every route is registered
+    RequestProfiler(app)
+    return app
 
-if __name__ == "__main__":
-    main()
-"""
-
-def generate_basic_monitoring_code(blocks):
-    return """#!/usr/bin/env python3
-\"\"\"
-SmartX Basic Monitoring System
-Generated automatically from visual blocks
-\"\"\"
-import time
-import random
-import json
-from datetime import datetime
-
-class BasicMonitoringSystem:
-    def __init__(self):
-        self.thresholds = {
-            'temperature': {'min': 60, 'max': 85},
-            'pressure': {'min': 1.0, 'max': 2.0},
-            'vibration': {'min': 0.1, 'max': 0.7},
-            'humidity': {'min': 40, 'max': 60}
-        }
-    
-    def monitor_system(self):
-        \"\"\"Generated monitoring function\"\"\"
-        # Simulate sensor readings
-        temperature = random.randint(60, 100)
-        pressure = round(random.uniform(1.0, 2.5), 2)
-        vibration = round(random.uniform(0.1, 1.0), 2)
-        humidity = random.randint(30, 70)
-        
-        print(f"Temperature: {temperature}°F")
-        print(f"Pressure: {pressure} bar")
-        print(f"Vibration: {vibration}")
-        print(f"Humidity: {humidity}%")
-        
-        # Check thresholds
-        alerts = []
-        
-        if temperature > self.thresholds['temperature']['max']:
-            alerts.append(f"High temperature alert: {temperature}°F")
-        
-        if pressure > self.thresholds['pressure']['max']:
-            alerts.append(f"High pressure alert: {pressure} bar")
-        
-        if vibration > self.thresholds['vibration']['max']:
-            alerts.append(f"Excessive vibration: {vibration}")
-        
-        if humidity < self.thresholds['humidity']['min'] or humidity > self.thresholds['humidity']['max']:
-            alerts.append(f"Humidity out of range: {humidity}%")
-        
-        if alerts:
-            print("🚨 ALERTS:")
-            for alert in alerts:
-                print(f"  - {alert}")
-            return "maintenance_required"
-        else:
-            print("✅ All systems normal")
-            return "normal"
-    
-    def main(self):
-        \"\"\"Main execution function\"\"\"
-        print("Starting SmartX monitoring system...")
-        
-        while True:
-            print(f"\\n--- {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
-            status = self.monitor_system()
-            
-            if status == "maintenance_required":
-                print("⚠️ Initiating maintenance protocol...")
-                # In a real system, this would trigger maintenance workflows
-            
-            time.sleep(5)
+def start_background_services(app):
+    """Start per-process connections: storage health checks and, for ingest roles, spool replay, compaction and MQTT"""
+    mongo.start()
+    # Queries resolve device types too, so every role keeps these current
+    device_directory.start()
+    historian.rules.start()
+    if app.config["SMARTX_ROLE"] in ("all", "ingest"):
+        spool.start()
+        historian.start(store_reading)
+        sketches.start()
+        status_tracker.start()
+        alert_engine.start()
+        fleet_index.start()
+        retention.start()
+        start_mqtt_ingest(app.config)
 
-if __name__ == "__main__":
-    system = BasicMonitoringSystem()
-    try:
-        system.main()
-    except KeyboardInterrupt:
-        print("\\nMonitoring system stopped.")
-"""
+def __getattr__(name):
+    # Keeps `gunicorn app:app` working; the app is only built when asked for
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == "__main__":
-    # Initialize MQTT when app starts
-    initialize_mqtt()
+    app = create_app()
+    # The reloader re-runs this file in a child; only that serving process starts services
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_services(app)
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,260 @@
+"""
+SmartX columnar archive codec (gorilla-1)
+Packs one device-day of readings into per-hour chunks, one column per metric.
+Timestamps are stored as delta-of-deltas, numbers as deltas of decimal-scaled
+integers when they have a fixed number of decimals (sensor values usually do)
+and as XOR of consecutive float64 bit patterns otherwise, as in Gorilla.
+Instead of Gorilla's bit stream, each column is packed at a fixed byte width
+per chunk and the chunk is deflated, so decoding is a handful of numpy calls.
+"""
+import json
+import struct
+import zlib
+from datetime import timedelta
+
+import numpy as np
+
+CODEC = "gorilla-1"
+
+KIND_DECIMAL = 1
+KIND_XOR = 2
+KIND_TEXT = 3
+KIND_JSON = 4
+# Set on the kind byte when the column has missing values and carries a presence bitmap
+HAS_MASK = 0x80
+MAX_SCALE = 6
+
+_HEADER = struct.Struct("<Iq")      # row count, first timestamp (ms since the day)
+_DECIMAL = struct.Struct("<BBq")    # scale, integer flag, first scaled value
+WIDTHS = (0, 1, 2, 4, 8)
+
+
+def _zigzag(values):
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def _unzigzag(values):
+    values = values.astype(np.uint64)
+    return ((values >> np.uint64(1)).view(np.int64) ^ -(values & np.uint64(1)).view(np.int64))
+
+
+def _pack_uints(values):
+    """Width byte followed by the values at the narrowest width that fits"""
+    top = int(values.max()) if len(values) else 0
+    width = next(w for w in WIDTHS if top < 1 << (8 * w)) if top else 0
+    if not width:
+        return bytes([0])
+    return bytes([width]) + values.astype(f"<u{width}").tobytes()
+
+
+def _unpack_uints(buffer, offset, count):
+    width = buffer[offset]
+    offset += 1
+    if not width:
+        return np.zeros(count, dtype=np.uint64), offset
+    end = offset + width * count
+    return np.frombuffer(buffer[offset:end], dtype=f"<u{width}").astype(np.uint64), end
+
+
+def _string(buffer, offset):
+    length = buffer[offset]
+    return bytes(buffer[offset + 1:offset + 1 + length]).decode(), offset + 1 + length
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _decimal_scale(values):
+    """Smallest number of decimals that represents every value exactly, or None"""
+    for scale in range(MAX_SCALE + 1):
+        factor = 10.0 ** scale
+        scaled = np.round(values * factor)
+        if np.abs(scaled).max(initial=0) >= 2 ** 52:
+            return None
+        if np.array_equal(scaled / factor, values):
+            return scale
+    return None
+
+
+def _encode_numbers(values, all_ints):
+    array = np.asarray(values, dtype=np.float64)
+    scale = None if np.isnan(array).any() or np.isinf(array).any() else _decimal_scale(array)
+    if scale is not None:
+        scaled = np.round(array * 10.0 ** scale).astype(np.int64)
+        return KIND_DECIMAL, (_DECIMAL.pack(scale, all_ints and scale == 0, int(scaled[0]))
+                              + _pack_uints(_zigzag(np.diff(scaled))))
+    bits = array.view(np.uint64)
+    xored = bits ^ np.concatenate(([np.uint64(0)], bits[:-1]))
+    # Byte-transposed, so the mostly zero high bytes of each XOR sit together
+    return KIND_XOR, xored.view(np.uint8).reshape(-1, 8).T.tobytes()
+
+
+def _encode_column(values):
+    present = [value is not None for value in values]
+    kept = [value for value in values if value is not None]
+    if not kept:
+        kind, body = KIND_JSON, b"[]"
+    elif all(_is_number(value) for value in kept):
+        kind, body = _encode_numbers(kept, all(isinstance(value, int) for value in kept))
+    elif all(isinstance(value, str) for value in kept):
+        dictionary = sorted(set(kept))
+        index = {value: i for i, value in enumerate(dictionary)}
+        names = json.dumps(dictionary, separators=(",", ":")).encode()
+        kind = KIND_TEXT
+        body = struct.pack("<I", len(names)) + names + _pack_uints(np.array([index[v] for v in kept], dtype=np.uint64))
+    else:
+        kind = KIND_JSON
+        body = json.dumps(kept, separators=(",", ":"), default=str).encode()
+    if all(present):
+        return bytes([kind]) + body
+    return bytes([kind | HAS_MASK]) + np.packbits(np.array(present, dtype=bool)).tobytes() + body
+
+
+def encode_chunk(stamps_ms, columns):
+    """Bytes for one chunk: millisecond offsets and {name: values} of equal length"""
+    stamps = np.asarray(stamps_ms, dtype=np.int64)
+    count = len(stamps)
+    parts = [_HEADER.pack(count, int(stamps[0]) if count else 0),
+             _pack_uints(_zigzag(np.diff(np.diff(stamps), prepend=0))) if count > 1 else bytes([0]),
+             struct.pack("<H", len(columns))]
+    for name, values in columns.items():
+        encoded = name.encode()
+        parts.append(bytes([len(encoded)]) + encoded)
+        column = _encode_column(values)
+        parts.append(struct.pack("<I", len(column)) + column)
+    return zlib.compress(b"".join(parts), 6)
+
+
+def _decode_column(buffer, count):
+    kind = buffer[0]
+    offset = 1
+    present = None
+    if kind & HAS_MASK:
+        kind &= ~HAS_MASK
+        mask_bytes = (count + 7) // 8
+        present = np.unpackbits(np.frombuffer(buffer[offset:offset + mask_bytes], dtype=np.uint8),
+                                count=count).astype(bool)
+        offset += mask_bytes
+    kept = int(present.sum()) if present is not None else count
+    if kind == KIND_DECIMAL:
+        scale, is_int, first = _DECIMAL.unpack_from(buffer, offset)
+        deltas, _ = _unpack_uints(buffer, offset + _DECIMAL.size, kept - 1)
+        scaled = np.concatenate(([first], first + np.cumsum(_unzigzag(deltas)))) if kept else np.zeros(0, np.int64)
+        values = scaled if is_int else scaled / 10.0 ** scale
+    elif kind == KIND_XOR:
+        xored = np.frombuffer(buffer[offset:offset + 8 * kept], dtype=np.uint8).reshape(8, kept).T.copy()
+        values = np.bitwise_xor.accumulate(xored.view(np.uint64).ravel()).view(np.float64)
+    elif kind == KIND_TEXT:
+        (length,) = struct.unpack_from("<I", buffer, offset)
+        dictionary = np.array(json.loads(bytes(buffer[offset + 4:offset + 4 + length])), dtype=object)
+        codes, _ = _unpack_uints(buffer, offset + 4 + length, kept)
+        values = dictionary[codes.astype(np.intp)]
+    elif kind == KIND_JSON:
+        values = np.empty(kept, dtype=object)
+        for i, value in enumerate(json.loads(bytes(buffer[offset:]))):
+            values[i] = value
+    else:
+        raise ValueError(f"Unknown archive column kind {kind}")
+    return values, present
+
+
+def _full(values, present, count):
+    """Column of `count` rows with NaN (numbers) or None (anything else) where missing"""
+    if present is None:
+        return values
+    full = np.full(count, np.nan) if values.dtype.kind in "if" else np.full(count, None, dtype=object)
+    full[present] = values
+    return full
+
+
+def decode_chunk(payload):
+    """(millisecond offsets, {name: (present values, presence mask or None)}) as numpy arrays"""
+    buffer = memoryview(zlib.decompress(payload))
+    count, first = _HEADER.unpack_from(buffer, 0)
+    offset = _HEADER.size
+    dod, offset = _unpack_uints(buffer, offset, max(count - 1, 0))
+    deltas = np.cumsum(_unzigzag(dod))
+    stamps = np.concatenate(([first], first + np.cumsum(deltas))) if count else np.zeros(0, np.int64)
+    (ncolumns,) = struct.unpack_from("<H", buffer, offset)
+    offset += 2
+    columns = {}
+    for _ in range(ncolumns):
+        name, offset = _string(buffer, offset)
+        (length,) = struct.unpack_from("<I", buffer, offset)
+        offset += 4
+        columns[name] = _decode_column(buffer[offset:offset + length], count)
+        offset += length
+    return stamps.astype(np.int64), columns
+
+
+def encode_day(docs, day):
+    """Per-hour chunk documents for one device-day of readings sorted by time"""
+    hours = {}
+    for doc in docs:
+        hours.setdefault(doc["timestamp"].hour, []).append(doc)
+    chunks = []
+    for hour, rows in sorted(hours.items()):
+        names = sorted({name for row in rows for name in row["data"]})
+        stamps = [(row["timestamp"] - day) // timedelta(milliseconds=1) for row in rows]
+        columns = {name: [row["data"].get(name) for row in rows] for name in names}
+        chunks.append({"hour": hour, "count": len(rows), "payload": encode_chunk(stamps, columns)})
+    return chunks
+
+
+def _selected(chunks, day, since, until):
+    for chunk in chunks:
+        start = day + timedelta(hours=chunk["hour"])
+        if (since is None or start + timedelta(hours=1) > since) and (until is None or start <= until):
+            yield chunk
+
+
+def decode_columns(chunks, day, since=None, until=None):
+    """Columns for the chunks overlapping [since, until] as numpy arrays
+
+    Returns {"timestamp": datetime64[ms] array, name: values array}; missing
+    numbers are NaN and missing text is None.
+    """
+    base = np.datetime64(day, "ms")
+    parts = [decode_chunk(chunk["payload"]) for chunk in _selected(chunks, day, since, until)]
+    total = sum(len(stamps) for stamps, _ in parts)
+    names = sorted({name for _, columns in parts for name in columns})
+    result = {"timestamp": base + np.concatenate([stamps for stamps, _ in parts] or [np.zeros(0, np.int64)])}
+    for name in names:
+        pieces = []
+        for stamps, columns in parts:
+            if name in columns:
+                pieces.append(_full(*columns[name], len(stamps)))
+            else:
+                pieces.append(np.full(len(stamps), None, dtype=object))
+        values = np.concatenate(pieces) if pieces else np.zeros(total)
+        result[name] = values
+    if since is not None or until is not None:
+        keep = np.ones(total, dtype=bool)
+        if since is not None:
+            keep &= result["timestamp"] >= np.datetime64(since, "ms")
+        if until is not None:
+            keep &= result["timestamp"] <= np.datetime64(until, "ms")
+        result = {name: values[keep] for name, values in result.items()}
+    return result
+
+
+def decode_readings(chunks, day, device_id, since=None, until=None):
+    """Readings (sensor_data shape, no _id) for the chunks overlapping [since, until]"""
+    readings = []
+    for chunk in _selected(chunks, day, since, until):
+        stamps, columns = decode_chunk(chunk["payload"])
+        times = (np.datetime64(day, "ms") + stamps).astype("datetime64[us]").tolist()
+        rows = [{} for _ in range(len(times))]
+        for name, (values, present) in columns.items():
+            listed = values.tolist()
+            if present is not None:
+                rows_with_value = [row for row, keep in zip(rows, present.tolist()) if keep]
+            else:
+                rows_with_value = rows
+            for row, value in zip(rows_with_value, listed):
+                row[name] = value
+        for stamp, data in zip(times, rows):
+            if (since is None or stamp >= since) and (until is None or stamp <= until):
+                readings.append({"device_id": device_id, "timestamp": stamp, "data": data})
+    return readings
@@ -0,0 +1,477 @@
+"""
+SmartX historical backfill
+
+Streams readings from NDJSON, CSV or the app's own JSON exports into the
+sensor_data collection with unordered insert_many across worker processes,
+checkpointing progress so an interrupted import resumes where it stopped.
+Each reading gets a deterministic _id (device and timestamp), so replaying a
+batch after a crash skips the rows that already landed instead of duplicating
+them. Afterwards the minute and hourly rollups and quantile sketches are
+rebuilt for the imported devices and time range, and days older than raw
+retention go straight into archive blocks instead of waiting for the
+compactor.
+
+Examples:
+    # Import a historian dump with 8 worker processes, resumable
+    python backfill.py history.ndjson.gz --workers 8 --checkpoint history.ckpt
+
+    # CSV with a header row (device_id,timestamp,temperature,...)
+    python backfill.py export.csv --uri mongodb://localhost:27017/smartx_iot
+
+    # Output of /api/historical-data or the JSON fallback file
+    python backfill.py sensor_data.json --format json
+"""
+import argparse
+import concurrent.futures
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("ndjson", "csv", "json")
+# Fields kept as strings; every other data field is stored as a number when it parses as one
+TEXT_FIELDS = ("status",)
+
+
+class RecordError(ValueError):
+    """A record that cannot be turned into a sensor_data document"""
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith(".gz") else path
+    if name.endswith(".csv"):
+        return "csv"
+    if name.endswith(".json"):
+        return "json"
+    return "ndjson"
+
+
+def open_source(path):
+    """Binary stream for path, transparently gunzipped"""
+    if path == "-":
+        return sys.stdin.buffer
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def reading_id(device_id, timestamp):
+    """Deterministic _id for a reading, so re-imports are idempotent"""
+    return f"{device_id}@{timestamp.isoformat(timespec='milliseconds')}"
+
+
+def parse_timestamp(value):
+    """Naive UTC datetime from ISO text, {"$date": ...} or epoch seconds/milliseconds"""
+    if isinstance(value, str) and value:
+        try:
+            stamp = datetime.fromisoformat(value)
+        except ValueError:
+            text = value.strip()
+            try:
+                if text.endswith("Z"):
+                    stamp = datetime.fromisoformat(text[:-1] + "+00:00")
+                else:
+                    return parse_timestamp(float(text))
+            except ValueError:
+                raise RecordError(f"Unparseable timestamp {value!r}")
+    elif isinstance(value, datetime):
+        stamp = value
+    elif isinstance(value, dict) and "$date" in value:
+        return parse_timestamp(value["$date"])
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        # Anything past year 33658 in seconds is really milliseconds
+        stamp = datetime.fromtimestamp(value / 1000 if value > 1e12 else value, timezone.utc)
+    else:
+        raise RecordError("Missing timestamp")
+    if stamp.tzinfo is not None:
+        stamp = stamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return stamp
+
+
+def _numbers(data):
+    """Convert numeric strings (CSV cells, quoted exports) in place"""
+    for name, value in data.items():
+        if value.__class__ is str and name not in TEXT_FIELDS:
+            try:
+                data[name] = float(value)
+            except ValueError:
+                pass
+    return data
+
+
+def normalize(record, default_device=None, dedupe=True):
+    """Turn a nested ({device_id, timestamp, data}) or flat record into a sensor_data document
+
+    The record is consumed: its dicts are reused for the document.
+    """
+    device_id = record.get("device_id") or default_device
+    if not device_id:
+        raise RecordError("Missing device_id")
+    timestamp = parse_timestamp(record.get("timestamp"))
+    data = record.get("data")
+    if data.__class__ is not dict:
+        data = {name: value for name, value in record.items()
+                if name not in ("_id", "device_id", "timestamp") and value not in ("", None)}
+    doc = {"device_id": device_id, "timestamp": timestamp, "data": _numbers(data)}
+    if dedupe:
+        doc["_id"] = reading_id(device_id, timestamp)
+    return doc
+
+
+def iter_line_batches(stream, batch_size, start=0):
+    """Yield (lines, end_offset) for a line-oriented stream from byte offset `start`"""
+    if start:
+        stream.seek(start)
+    offset = start
+    lines = []
+    for line in stream:
+        offset += len(line)
+        if line.strip():
+            lines.append(line)
+            if len(lines) >= batch_size:
+                yield lines, offset
+                lines = []
+    if lines:
+        yield lines, offset
+
+
+def iter_json_records(stream, chunk_size=1 << 20):
+    """Stream the elements of a top-level JSON array without loading it whole"""
+    decoder = json.JSONDecoder()
+    reader = io.TextIOWrapper(stream, encoding="utf-8")
+    buffer = reader.read(chunk_size).lstrip()
+    if not buffer.startswith("["):
+        raise RecordError("Expected a JSON array of readings")
+    buffer = buffer[1:]
+    while True:
+        buffer = buffer.lstrip().lstrip(",").lstrip()
+        if buffer.startswith("]"):
+            return
+        try:
+            record, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            more = reader.read(chunk_size)
+            if not more:
+                raise RecordError("Truncated JSON array")
+            buffer += more
+            continue
+        yield record
+        buffer = buffer[end:]
+        if len(buffer) < 4096:
+            buffer += reader.read(chunk_size)
+
+
+def parse_batch(fmt, payload, header=None, default_device=None, dedupe=True):
+    """(docs, error_count) for one batch of raw lines or already-decoded records"""
+    if fmt == "csv":
+        payload = [dict(zip(header, row)) for row in csv.reader(line.decode("utf-8") for line in payload)]
+    docs = []
+    errors = 0
+    for record in payload:
+        try:
+            if fmt == "ndjson":
+                record = json.loads(record)
+            docs.append(normalize(record, default_device, dedupe))
+        except (RecordError, AttributeError, TypeError, ValueError):
+            errors += 1
+    return docs, errors
+
+
+def insert_docs(collection, docs):
+    """Unordered insert_many; returns (inserted, duplicates)"""
+    from pymongo.errors import BulkWriteError
+    if not docs:
+        return 0, 0
+    try:
+        return len(collection.insert_many(docs, ordered=False).inserted_ids), 0
+    except BulkWriteError as e:
+        details = e.details
+        # Duplicate keys are rows an earlier (interrupted) run already wrote
+        others = [error for error in details.get("writeErrors", []) if error.get("code") != 11000]
+        if others:
+            raise
+        return details.get("nInserted", 0), len(details.get("writeErrors", []))
+
+
+def batch_summary(docs):
+    """Time range and newest reading per device, merged by the caller"""
+    latest = {}
+    for doc in docs:
+        current = latest.get(doc["device_id"])
+        if current is None or doc["timestamp"] > current[0]:
+            latest[doc["device_id"]] = (doc["timestamp"], doc["data"])
+    if not docs:
+        return None, None, latest
+    stamps = [doc["timestamp"] for doc in docs]
+    return min(stamps), max(stamps), latest
+
+
+# Per-process collection for worker batches, opened by the first batch
+_worker_collection = None
+
+
+def _worker_batch(task):
+    global _worker_collection
+    number, fmt, payload, header, options = task
+    if _worker_collection is None:
+        from pymongo import MongoClient
+        client = MongoClient(options["uri"])
+        _worker_collection = client.get_default_database()[options["collection"]]
+    return _run_batch(_worker_collection, number, fmt, payload, header, options)
+
+
+def _run_batch(collection, number, fmt, payload, header, options):
+    docs, errors = parse_batch(fmt, payload, header, options.get("device_id"), options.get("dedupe", True))
+    inserted, duplicates = insert_docs(collection, docs)
+    return number, inserted, duplicates, errors, batch_summary(docs)
+
+
+class ImportJob:
+    """One streamed import with progress, checkpointing and derived-data rebuild
+
+    Batches are numbered as they are read; they may finish out of order, so
+    the checkpoint records the end of the longest run of finished batches and
+    a resumed import restarts from there.
+    """
+
+    def __init__(self, path, fmt=None, batch_size=5000, workers=4, checkpoint=None,
+                 device_id=None, dedupe=True, uri=None, collection="sensor_data", name=None):
+        self.path = path
+        self.name = name or os.path.basename(path)
+        self.fmt = fmt or detect_format(path)
+        if self.fmt not in FORMATS:
+            raise ValueError(f"Unknown format {self.fmt!r}, expected one of {', '.join(FORMATS)}")
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.options = {"uri": uri, "collection": collection, "device_id": device_id, "dedupe": dedupe}
+        self.state = "pending"
+        self.error = None
+        self.read = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.archived = 0
+        self.since = None
+        self.until = None
+        self.devices = set()
+        self.latest = {}
+        self.started = None
+        self.finished = None
+        self.position = 0
+        self._header = None
+        self._done = {}
+        self._next = 0
+
+    def _load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return
+        with open(self.checkpoint) as f:
+            saved = json.load(f)
+        if saved.get("path") != os.path.abspath(self.path) or saved.get("format") != self.fmt:
+            raise ValueError(f"Checkpoint {self.checkpoint} belongs to a different import")
+        self.position = saved["position"]
+        self.inserted = saved.get("inserted", 0)
+        self.since = parse_timestamp(saved["since"]) if saved.get("since") else None
+        self.until = parse_timestamp(saved["until"]) if saved.get("until") else None
+        self.devices.update(saved.get("devices", []))
+        logger.info(f"Resuming {self.path} from position {self.position}")
+
+    def _save_checkpoint(self):
+        if not self.checkpoint:
+            return
+        temporary = self.checkpoint + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({
+                "path": os.path.abspath(self.path),
+                "format": self.fmt,
+                "position": self.position,
+                "inserted": self.inserted,
+                "since": self.since.isoformat() if self.since else None,
+                "until": self.until.isoformat() if self.until else None,
+                "devices": sorted(self.devices)
+            }, f)
+        os.replace(temporary, self.checkpoint)
+
+    def _batches(self, stream):
+        """Yield (payload, end_position) from the current position"""
+        if self.fmt == "json":
+            # Positions count records; skip the ones a previous run finished
+            batch = []
+            index = 0
+            for index, record in enumerate(iter_json_records(stream), 1):
+                if index <= self.position:
+                    continue
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    yield batch, index
+                    batch = []
+            if batch:
+                yield batch, index
+            return
+        start = self.position
+        if self.fmt == "csv":
+            header_line = stream.readline()
+            self._header = next(csv.reader([header_line.decode("utf-8-sig")]))
+            start = max(start, len(header_line))
+        yield from iter_line_batches(stream, self.batch_size, start)
+
+    def _finish_batch(self, result, ends):
+        number, inserted, duplicates, errors, (since, until, latest) = result
+        self.inserted += inserted
+        self.duplicates += duplicates
+        self.rejected += errors
+        if since is not None:
+            self.since = since if self.since is None else min(self.since, since)
+            self.until = until if self.until is None else max(self.until, until)
+        self.devices.update(latest)
+        for device_id, entry in latest.items():
+            current = self.latest.get(device_id)
+            if current is None or entry[0] > current[0]:
+                self.latest[device_id] = entry
+        self._done[number] = ends.pop(number)
+        # Advance the checkpoint over every batch finished in sequence
+        while self._next in self._done:
+            self.position = self._done.pop(self._next)
+            self._next += 1
+        self._save_checkpoint()
+
+    def run(self, collection=None):
+        """Import everything; `collection` runs batches in this process instead of workers"""
+        self.state = "running"
+        self.started = time.time()
+        self._load_checkpoint()
+        ends = {}
+        try:
+            with open_source(self.path) as stream:
+                if collection is not None or self.workers <= 0:
+                    if collection is None:
+                        from pymongo import MongoClient
+                        collection = MongoClient(self.options["uri"]).get_default_database()[self.options["collection"]]
+                    for number, (payload, end) in enumerate(self._batches(stream)):
+                        self.read += len(payload)
+                        ends[number] = end
+                        self._finish_batch(
+                            _run_batch(collection, number, self.fmt, payload, self._header, self.options), ends)
+                else:
+                    self._run_pool(stream, ends)
+            self.state = "finished"
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            raise
+        finally:
+            self.finished = time.time()
+        return self.summary()
+
+    def _run_pool(self, stream, ends):
+        # Keep a bounded number of batches in flight so memory stays flat
+        limit = self.workers * 2
+        with concurrent.futures.ProcessPoolExecutor(self.workers) as pool:
+            pending = set()
+            for number, (payload, end) in enumerate(self._batches(stream)):
+                self.read += len(payload)
+                ends[number] = end
+                pending.add(pool.submit(_worker_batch, (number, self.fmt, payload, self._header, self.options)))
+                if len(pending) >= limit:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        self._finish_batch(future.result(), ends)
+            for future in concurrent.futures.as_completed(pending):
+                self._finish_batch(future.result(), ends)
+
+    def summary(self):
+        elapsed = (self.finished or time.time()) - self.started if self.started else 0
+        return {
+            "source": self.name,
+            "format": self.fmt,
+            "state": self.state,
+            "error": self.error,
+            "read": self.read,
+            "inserted": self.inserted,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "archived": self.archived,
+            "devices": len(self.devices),
+            "since": self.since.isoformat() if self.since else None,
+            "until": self.until.isoformat() if self.until else None,
+            "seconds": round(elapsed, 2),
+            "readings_per_second": round(self.read / elapsed) if elapsed else None
+        }
+
+
+def ensure_indexes(db, collection="sensor_data"):
+    # The timestamp (TTL) index belongs to retention.RetentionManager
+    db[collection].create_index([("device_id", 1), ("timestamp", 1)])
+
+
+def rebuild_derived(db, job, collection="sensor_data"):
+    """Rebuild rollups and quantile sketches touched by a finished import"""
+    from quantiles import rebuild_sketches
+    from retention import rebuild_rollups
+    ensure_indexes(db, collection)
+    devices = list(job.devices)
+    rebuild_rollups(db, job.since, job.until, devices, collection=collection)
+    rebuild_sketches(db, job.since, job.until, devices, collection=collection)
+
+
+def archive_aged(db, job, cutoff, codec=None, collection="sensor_data", rollups=True):
+    """Move imported device-days older than `cutoff` into archive blocks; returns the readings moved
+
+    Pass `rollups=False` once rebuild_derived has rolled the import up.
+    """
+    from retention import aged_days, archive_day, default_codec
+    if cutoff is None or job.since is None or job.since >= cutoff:
+        return 0
+    codec = codec or default_codec()
+    for device_id, day in list(aged_days(db, cutoff, job.devices, job.since, collection=collection)):
+        job.archived += archive_day(db, device_id, day, collection, codec, rollups)
+    return job.archived
+
+
+def build_parser():
+    from retention import CODECS
+    parser = argparse.ArgumentParser(description="Bulk-import historical SmartX readings into MongoDB")
+    parser.add_argument("path", help="NDJSON, CSV or JSON array file (optionally .gz), or - for stdin")
+    parser.add_argument("--format", choices=FORMATS, help="default: from the file extension")
+    parser.add_argument("--uri", default=os.environ.get("MONGO_URI", "mongodb://localhost:27017/smartx_iot"))
+    parser.add_argument("--collection", default="sensor_data")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="parse/insert processes (0 runs in this process)")
+    parser.add_argument("--batch-size", type=int, default=5000, help="readings per insert_many")
+    parser.add_argument("--checkpoint", help="progress file; rerun with the same file to resume")
+    parser.add_argument("--device-id", help="device_id for records that carry none")
+    parser.add_argument("--no-dedupe", action="store_true",
+                        help="let MongoDB assign _ids (faster, but re-imports duplicate rows)")
+    parser.add_argument("--raw-days", type=float, default=float(os.environ.get("RETENTION_RAW_DAYS", "30")),
+                        help="archive imported days older than this straight away (0 keeps them raw)")
+    parser.add_argument("--codec", choices=CODECS, default=os.environ.get("RETENTION_ARCHIVE_CODEC") or None,
+                        help="archive block codec (default: gorilla-1 when numpy is installed)")
+    parser.add_argument("--skip-derived", action="store_true", help="don't rebuild rollups and sketches")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    job = ImportJob(args.path, args.format, args.batch_size, args.workers, args.checkpoint,
+                    args.device_id, not args.no_dedupe, args.uri, args.collection)
+    job.run()
+    from pymongo import MongoClient
+    from retention import raw_cutoff
+    db = MongoClient(args.uri).get_default_database()
+    if not args.skip_derived:
+        rebuild_derived(db, job, args.collection)
+    archive_aged(db, job, raw_cutoff(args.raw_days), args.codec, args.collection, rollups=args.skip_derived)
+    print(json.dumps(job.summary(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+"""
+SmartX microbenchmarks for the platform's hot functions
+
+Usage:
+    python benchmark.py                                  # run everything, print a table
+    python benchmark.py --filter predict                 # only matching benchmarks
+    python benchmark.py --save-baseline bench_baseline.json
+    python benchmark.py --compare bench_baseline.json --threshold 0.15
+
+With --compare the process exits with status 1 when any benchmark's median
+time is slower than the baseline by more than the threshold.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app as smartx  # noqa: E402
+
+# Per-reading log lines would dominate every measurement
+logging.disable(logging.CRITICAL)
+
+CODE_TYPES = ["iot_automation", "data_processing", "ml_prediction", "mqtt_handler", "monitoring"]
+
+
+def sample_reading(i=0):
+    return {
+        "temperature": random.randint(60, 100),
+        "pressure": round(random.uniform(1.0, 2.5), 2),
+        "vibration": round(random.uniform(0.1, 1.0), 2),
+        "humidity": random.randint(30, 70),
+        "status": random.choice(["Running", "Maintenance", "Idle"]),
+        "efficiency": random.randint(75, 95),
+        "timestamp": (datetime(2024, 1, 1) + timedelta(seconds=i)).isoformat()
+    }
+
+
+class _Cursor(list):
+    """List that ignores cursor-only calls such as batch_size"""
+
+    def batch_size(self, size):
+        return self
+
+
+class InMemoryCollection:
+    """Just enough of a pymongo collection for the benchmarked code paths"""
+
+    def __init__(self, docs=None):
+        self.docs = list(docs or [])
+
+    def insert_one(self, doc):
+        self.docs.append(doc)
+
+    def insert_many(self, docs, ordered=True):
+        self.docs.extend(docs)
+
+    def find(self, query=None, projection=None, sort=None, **kwargs):
+        # Only plain equality conditions are applied
+        equal = {k: v for k, v in (query or {}).items() if not isinstance(v, dict)}
+        if not equal:
+            return _Cursor(self.docs)
+        return _Cursor([doc for doc in self.docs if all(doc.get(k) == v for k, v in equal.items())])
+
+    def find_one(self, query=None, sort=None, **kwargs):
+        return self.docs[-1] if self.docs else None
+
+
+class InMemoryDB:
+    def __init__(self):
+        self.collections = {}
+
+    def __getattr__(self, name):
+        return self[name]
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, InMemoryCollection())
+
+    def list_collection_names(self):
+        return list(self.collections)
+
+
+class InMemoryMongo:
+    available = True
+
+    def __init__(self):
+        self.db = InMemoryDB()
+
+    def start(self):
+        pass
+
+    def mark_failed(self, error):
+        pass
+
+
+class use_mongo:
+    """Temporarily point the app at an in-memory Mongo stand-in"""
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def __enter__(self):
+        self.saved = smartx.mongo
+        smartx.mongo = self.fake
+        return self.fake
+
+    def __exit__(self, *exc):
+        smartx.mongo = self.saved
+        return False
+
+
+def measure(func, setup=None, rounds=7, number=None, budget=0.2):
+    """Return the mean per-call time in seconds for each round
+
+    `number` calls are timed per round; when omitted it is calibrated so one
+    round takes about `budget` seconds. `setup` runs untimed before each call.
+    """
+    if number is None:
+        number, elapsed = 1, 0.0
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                if setup:
+                    setup()
+                func()
+            elapsed = time.perf_counter() - start
+            if elapsed >= budget / 4 or number >= 100000:
+                break
+            number *= 4
+        number = max(1, int(number * budget / max(elapsed, 1e-9) / 4) or 1)
+
+    results = []
+    for _ in range(rounds):
+        total = 0.0
+        for _ in range(number):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            func()
+            total += time.perf_counter() - start
+        results.append(total / number)
+    return results, number
+
+
+# Benchmark definitions: each yields (name, func, setup, prepare) where
+# setup runs untimed before every call and prepare runs once beforehand
+def bench_file_storage(workdir):
+    path = os.path.join(workdir, "sensor_data.json")
+
+    def seed(count):
+        records = [{"device_id": f"dev{i % 50}", "timestamp": sample_reading(i)["timestamp"],
+                    "data": sample_reading(i)} for i in range(count)]
+        with open(path, "w") as f:
+            json.dump(records, f, indent=2)
+
+    reading = {"device_id": "bench", "timestamp": datetime.utcnow(), "data": sample_reading()}
+    for size in (10, 100, 1000, 10000):
+        yield (f"get_data_from_file[{size} records]", smartx.get_data_from_file, None, lambda s=size: seed(s))
+    for size in (10, 50, 100):
+        yield (f"store_data_to_file[{size} records]", lambda: smartx.store_data_to_file(reading),
+               lambda s=size: seed(s), None)
+
+
+def bench_latest_sensor_data():
+    for devices in (10, 1000, 10000, 100000):
+        cache = {f"device_{i:06d}": sample_reading(i) for i in range(devices)}
+
+        def setup(cache=cache):
+            smartx.latest_sensor_data.clear()
+            smartx.latest_sensor_data.update(cache)
+
+        yield (f"get_latest_sensor_data[{devices} devices]", smartx.get_latest_sensor_data, None, setup)
+
+
+def bench_predict(client):
+    payloads = [sample_reading(i) for i in range(100)]
+    state = {"i": 0}
+
+    def call():
+        state["i"] = (state["i"] + 1) % len(payloads)
+        response = client.post("/api/predict", json=payloads[state["i"]])
+        assert response.status_code == 200
+
+    yield ("predict_api[test client]", call, None, None)
+
+
+def bench_historical(client):
+    for rows in (1000, 10000, 100000):
+        fake = InMemoryMongo()
+        base = datetime.utcnow() - timedelta(hours=23)
+        fake.db.sensor_data.docs = [
+            {"device_id": f"dev{i % 100}", "timestamp": base + timedelta(seconds=i % 80000), "data": sample_reading(i)}
+            for i in range(rows)
+        ]
+
+        def call(fake=fake):
+            with use_mongo(fake):
+                response = client.get("/api/historical-data?hours=24")
+            assert response.status_code == 200
+
+        def call_device(fake=fake):
+            with use_mongo(fake):
+                response = client.get("/api/historical-data?hours=24&device_id=dev0")
+            assert response.status_code == 200
+
+        yield (f"historical_data_api[{rows} rows]", call, None, None)
+        yield (f"historical_data_api[{rows} rows, one device]", call_device, None, None)
+
+
+def bench_bulk_import(client):
+    for rows in (1000, 10000, 50000):
+        lines = ["device_id,device_type,location,description"]
+        lines += [f"dev_{i:06d},pump,line_{i % 12},Pump {i}" for i in range(rows)]
+        body = "\n".join(lines).encode()
+
+        def call(body=body):
+            with use_mongo(InMemoryMongo()):
+                response = client.post("/api/device-connection/bulk-import",
+                                       data={"file": (io.BytesIO(body), "devices.csv")},
+                                       content_type="multipart/form-data")
+            assert response.status_code == 200
+
+        yield (f"bulk_import[{rows} rows]", call, None, None)
+
+
+def workflow_workspace(rules):
+    """Blockly serialization of `rules` threshold checks chained in sequence"""
+    first = None
+    for i in reversed(range(rules)):
+        block = {
+            "type": "controls_if", "id": f"if{i}",
+            "inputs": {
+                "IF0": {"block": {"type": "logic_compare", "fields": {"OP": "GT"}, "inputs": {
+                    "A": {"block": {"type": "smartx_read_temperature", "fields": {"UNIT": "CELSIUS"}}},
+                    "B": {"block": {"type": "math_number", "fields": {"NUM": 80 + i}}}}}},
+                "DO0": {"block": {"type": "smartx_send_alert", "fields": {"SEVERITY": "HIGH"}, "inputs": {
+                    "MESSAGE": {"block": {"type": "text", "fields": {"TEXT": f"Rule {i} tripped"}}}},
+                    "next": {"block": {"type": "smartx_mqtt_publish", "inputs": {
+                        "TOPIC": {"block": {"type": "text", "fields": {"TEXT": "smartx/alerts"}}},
+                        "MESSAGE": {"block": {"type": "text", "fields": {"TEXT": "overheat"}}}}}}}}
+            }
+        }
+        if first is not None:
+            block["next"] = {"block": first}
+        first = block
+    return {"blocks": {"languageVersion": 0, "blocks": [dict(first, x=20, y=20)]}}
+
+
+def bench_generate_code(client):
+    import codegen
+
+    for code_type in CODE_TYPES:
+        def call(code_type=code_type):
+            response = client.post("/api/generate-code", json={"type": code_type, "blocks": []})
+            assert response.status_code == 200
+
+        yield (f"generate_code[{code_type}]", call, None, None)
+
+    for rules in (1, 10, 100):
+        workspace = workflow_workspace(rules)
+        body = json.dumps({"type": "workflow", "blocks": workspace})
+
+        def call(body=body):
+            response = client.post("/api/generate-code", data=body, content_type="application/json")
+            assert response.status_code == 200
+
+        yield (f"generate_code[workflow {rules} rules, cached]", call, None, None)
+        yield (f"generate_code[workflow {rules} rules, uncached]", call, codegen.artifact_cache.clear, None)
+        yield (f"codegen.build_artifact[{rules} rules, cached]",
+               lambda w=workspace: codegen.build_artifact("workflow", w), None, None)
+
+
+def collect_benchmarks(workdir, client):
+    yield from bench_file_storage(workdir)
+    yield from bench_latest_sensor_data()
+    yield from bench_predict(client)
+    yield from bench_historical(client)
+    yield from bench_bulk_import(client)
+    yield from bench_generate_code(client)
+
+
+def run(args):
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="smartx_bench_")
+    os.chdir(workdir)
+
+    client = smartx.app.test_client()
+    client.post("/login", data={"username": "admin", "password": "admin123"})
+
+    results = {}
+    for name, func, setup, prepare in collect_benchmarks(workdir, client):
+        if args.filter and args.filter not in name:
+            continue
+        if prepare:
+            prepare()
+        times, number = measure(func, setup=setup, rounds=args.rounds, budget=args.budget)
+        results[name] = {
+            "median_us": round(statistics.median(times) * 1e6, 3),
+            "min_us": round(min(times) * 1e6, 3),
+            "stdev_us": round(statistics.pstdev(times) * 1e6, 3),
+            "calls_per_round": number,
+            "rounds": len(times)
+        }
+        print(f"{name:48s} {results[name]['median_us']:>14.2f} us  (min {results[name]['min_us']:.2f}, "
+              f"x{number})", flush=True)
+
+    smartx.latest_sensor_data.clear()
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results
+    }
+
+
+def compare(current, baseline, threshold):
+    """Print a comparison table and return the names that regressed"""
+    regressions = []
+    print(f"\n{'benchmark':48s} {'baseline us':>14s} {'current us':>14s} {'change':>9s}")
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name)
+        if not before:
+            print(f"{name:48s} {'-':>14s} {result['median_us']:>14.2f} {'new':>9s}")
+            continue
+        change = result["median_us"] / before["median_us"] - 1 if before["median_us"] else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:48s} {before['median_us']:>14.2f} {result['median_us']:>14.2f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SmartX microbenchmarks")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this text")
+    parser.add_argument("--rounds", type=int, default=7)
+    parser.add_argument("--budget", type=float, default=0.2, help="target seconds per round")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save-baseline", metavar="PATH", help="write results as the new baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="relative slowdown of the median that counts as a regression")
+    parser.add_argument("--output", metavar="PATH", help="write results JSON here")
+    args = parser.parse_args(argv)
+
+    # Resolve paths before run() changes into its scratch directory
+    paths = {k: os.path.abspath(v) for k, v in
+             (("save", args.save_baseline), ("compare", args.compare), ("output", args.output)) if v}
+    current = run(args)
+
+    for key in ("save", "output"):
+        if key in paths:
+            with open(paths[key], "w") as f:
+                json.dump(current, f, indent=2)
+    if "compare" in paths:
+        with open(paths["compare"]) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print("\nNo regressions")
+
+
+if __name__ == "__main__":
+    main()
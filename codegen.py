@@ -0,0 +1,2327 @@
+"""
+SmartX code generation templates
+Imported lazily by /api/generate-code so processes that never generate code
+don't pay for loading the templates.
+"""
+import hashlib
+import json
+import keyword
+import math
+import re
+import string
+import threading
+from collections import OrderedDict
+
+def generate_iot_automation_code(blocks):
+    return """#!/usr/bin/env python3
+\"\"\"
+SmartX IoT Automation Code
+Generated automatically from visual blocks
+
+Modes:
+  inline  process each message in the MQTT network thread (simple, low volume)
+  queue   hand messages to worker threads, sharded by device so each device's
+          readings stay in order (use for large fleets)
+\"\"\"
+import paho.mqtt.client as mqtt
+import argparse
+import json
+import queue
+import signal
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# metric -> (limit kind, limit, action, alert format)
+RULES = [
+    ('temperature', 'max', 'activate_cooling_system', "High temperature alert: {value}°F"),
+    ('temperature', 'min', 'activate_heating_system', "Low temperature alert: {value}°F"),
+    ('pressure', 'max', 'open_pressure_relief_valve', "High pressure alert: {value} bar"),
+    ('vibration', 'max', 'reduce_machine_speed', "Excessive vibration: {value}"),
+]
+
+class Stats:
+    \"\"\"Counters and a latency window, summarized at shutdown\"\"\"
+
+    def __init__(self, window=100000):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counts = {'received': 0, 'processed': 0, 'dropped': 0, 'errors': 0,
+                       'actions': 0, 'actions_suppressed': 0, 'alerts': 0, 'alert_batches': 0}
+        self.latencies = deque(maxlen=window)
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def processed(self, received_at):
+        with self.lock:
+            self.counts['processed'] += 1
+            self.latencies.append(time.monotonic() - received_at)
+
+    def summary(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            latencies = sorted(self.latencies)
+            counts = dict(self.counts)
+
+        def pct(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+
+        return {
+            'elapsed_s': round(elapsed, 1),
+            'throughput_msg_s': round(counts['processed'] / elapsed, 1),
+            'latency_ms': {'p50': round(pct(0.50), 3), 'p95': round(pct(0.95), 3),
+                           'p99': round(pct(0.99), 3), 'max': round(latencies[-1] * 1000 if latencies else 0.0, 3)},
+            **counts
+        }
+
+class IoTAutomationSystem:
+    def __init__(self, broker_host="localhost", broker_port=1883, mode="inline", workers=4,
+                 queue_size=10000, qos=0, max_inflight=None, debounce=30.0, hysteresis=0.05,
+                 alert_interval=1.0, alert_batch_size=500):
+        self.broker_host = broker_host
+        self.broker_port = broker_port
+        self.mode = mode
+        self.qos = qos
+        self.debounce = debounce
+        self.hysteresis = hysteresis
+        self.alert_interval = alert_interval
+        self.alert_batch_size = alert_batch_size
+        self.client = mqtt.Client()
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        if max_inflight:
+            self.client.max_inflight_messages_set(max_inflight)
+        self.thresholds = {
+            'temperature': {'min': 60, 'max': 85},
+            'pressure': {'min': 1.0, 'max': 2.0},
+            'vibration': {'min': 0.1, 'max': 0.7},
+            'humidity': {'min': 40, 'max': 60}
+        }
+        # (device_id, action) -> time the action was last published; a key
+        # present here means the condition is active
+        self.active = {}
+        self.stats = Stats()
+        self.pending_alerts = []
+        self.alert_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.threads = []
+        # One queue per worker; a device always maps to the same worker, so
+        # its state is only touched by one thread and needs no lock
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers if mode == "queue" else 0)]
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            logger.info("Connected to MQTT broker")
+            client.subscribe("smartx/sensors/+", qos=self.qos)
+        else:
+            logger.error(f"Connection failed: {rc}")
+
+    def on_message(self, client, userdata, msg):
+        received_at = time.monotonic()
+        self.stats.incr('received')
+        if not self.queues:
+            self.handle(msg.topic, msg.payload, received_at)
+            return
+        device_id = msg.topic.rsplit('/', 1)[-1]
+        shard = self.queues[zlib.crc32(device_id.encode()) % len(self.queues)]
+        try:
+            shard.put_nowait((msg.topic, msg.payload, received_at))
+        except queue.Full:
+            # Never block the network thread; shed load and count it
+            self.stats.incr('dropped')
+
+    def worker(self, work):
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            self.handle(*item)
+
+    def handle(self, topic, payload, received_at):
+        try:
+            device_id = topic.rsplit('/', 1)[-1]
+            data = json.loads(payload)
+            if isinstance(data, list):
+                for reading in data:
+                    self.process_automation_rules(device_id, reading)
+            else:
+                self.process_automation_rules(device_id, data)
+            self.stats.processed(received_at)
+        except Exception as e:
+            self.stats.incr('errors')
+            logger.error(f"Error processing message: {e}")
+
+    def breached(self, device_id, metric, kind, action, value):
+        \"\"\"Threshold check with hysteresis
+
+        A condition trips when the value crosses the limit and only clears once
+        it is back inside by the hysteresis band, so readings hovering around
+        the limit don't toggle it.
+        \"\"\"
+        limits = self.thresholds[metric]
+        band = (limits['max'] - limits['min']) * self.hysteresis
+        limit = limits[kind]
+        if (device_id, action) in self.active:
+            return value > limit - band if kind == 'max' else value < limit + band
+        return value > limit if kind == 'max' else value < limit
+
+    def process_automation_rules(self, device_id, data):
+        \"\"\"Process automation rules based on sensor data\"\"\"
+        alerts = []
+        now = time.monotonic()
+
+        for metric, kind, action, message in RULES:
+            value = data.get(metric)
+            if value is None:
+                continue
+            key = (device_id, action)
+            if not self.breached(device_id, metric, kind, action, value):
+                self.active.pop(key, None)
+                continue
+            last = self.active.get(key)
+            # Act when the condition trips, then at most once per debounce
+            # interval while it stays active
+            if last is None or now - last >= self.debounce:
+                self.active[key] = now
+                self.execute_action(device_id, action)
+                alerts.append(message.format(value=value))
+            else:
+                self.stats.incr('actions_suppressed')
+
+        if alerts:
+            self.send_alerts(device_id, alerts)
+
+    def execute_action(self, device_id, action):
+        \"\"\"Execute automation action\"\"\"
+        control_topic = f"smartx/control/{device_id}"
+        control_message = {
+            'action': action,
+            'timestamp': datetime.now().isoformat(),
+            'source': 'automation_system'
+        }
+
+        self.client.publish(control_topic, json.dumps(control_message), qos=self.qos)
+        self.stats.incr('actions')
+        logger.info(f"Executed action: {action} for device {device_id}")
+
+    def send_alerts(self, device_id, alerts):
+        \"\"\"Queue alerts for the next batch\"\"\"
+        alert = {
+            'alerts': alerts,
+            'timestamp': datetime.now().isoformat(),
+            'device_id': device_id
+        }
+        with self.alert_lock:
+            self.pending_alerts.append(alert)
+            full = len(self.pending_alerts) >= self.alert_batch_size
+        self.stats.incr('alerts', len(alerts))
+        if full:
+            self.flush_alerts()
+
+    def flush_alerts(self):
+        \"\"\"Publish queued alerts as one message on smartx/alerts/batch\"\"\"
+        with self.alert_lock:
+            batch, self.pending_alerts = self.pending_alerts, []
+        if not batch:
+            return
+        self.client.publish("smartx/alerts/batch", json.dumps({
+            'alerts': batch,
+            'count': len(batch),
+            'timestamp': datetime.now().isoformat()
+        }), qos=self.qos)
+        self.stats.incr('alert_batches')
+        logger.warning(f"Alert batch sent: {len(batch)} device alerts")
+
+    def alert_flusher(self):
+        while not self.stopping.wait(self.alert_interval):
+            self.flush_alerts()
+
+    def start(self):
+        \"\"\"Start the automation system\"\"\"
+        logger.info(f"Starting IoT Automation System ({self.mode} mode)...")
+        for work in self.queues:
+            thread = threading.Thread(target=self.worker, args=(work,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        flusher = threading.Thread(target=self.alert_flusher, daemon=True)
+        flusher.start()
+        self.client.connect(self.broker_host, self.broker_port, 60)
+        self.client.loop_start()
+
+    def stop(self):
+        \"\"\"Drain workers, flush alerts and print the run summary\"\"\"
+        self.client.unsubscribe("smartx/sensors/+")
+        for work in self.queues:
+            work.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.stopping.set()
+        self.flush_alerts()
+        self.client.loop_stop()
+        self.client.disconnect()
+        summary = self.stats.summary()
+        print(json.dumps(summary, indent=2))
+        return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="SmartX IoT automation service")
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--mode", choices=["inline", "queue"], default="inline")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--queue-size", type=int, default=10000, help="per worker; excess messages are dropped")
+    parser.add_argument("--qos", type=int, choices=[0, 1, 2], default=0)
+    parser.add_argument("--max-inflight", type=int, help="MQTT in-flight window for QoS 1/2")
+    parser.add_argument("--debounce", type=float, default=30.0, help="seconds between repeats of an active action")
+    parser.add_argument("--hysteresis", type=float, default=0.05, help="clear band as a fraction of the threshold range")
+    parser.add_argument("--alert-interval", type=float, default=1.0, help="seconds between alert batches")
+    parser.add_argument("--alert-batch-size", type=int, default=500)
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    args = parser.parse_args()
+
+    system = IoTAutomationSystem(args.broker, args.port, mode=args.mode, workers=args.workers,
+                                 queue_size=args.queue_size, qos=args.qos, max_inflight=args.max_inflight,
+                                 debounce=args.debounce, hysteresis=args.hysteresis,
+                                 alert_interval=args.alert_interval, alert_batch_size=args.alert_batch_size)
+    done = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: done.set())
+    signal.signal(signal.SIGTERM, lambda *_: done.set())
+    system.start()
+    done.wait(args.duration)
+    system.stop()
+
+if __name__ == "__main__":
+    main()
+"""
+
+def generate_data_processing_code(blocks):
+    return """#!/usr/bin/env python3
+\"\"\"
+SmartX Data Processing Pipeline
+Generated automatically from visual blocks
+
+In-memory mode loads the window into one DataFrame. Chunked mode (--chunked)
+streams MongoDB in batch_size chunks and keeps only mergeable accumulators,
+so memory stays bounded however long the window is. With --n-jobs the
+analysis runs per device in a process pool and the device results are merged
+into the fleet report.
+\"\"\"
+import pandas as pd
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+
+NON_METRIC_COLUMNS = ['_id', 'device_id', 'timestamp']
+
+def flatten_records(records):
+    \"\"\"Turn stored readings ({'device_id', 'timestamp', 'data': {...}}) into flat rows\"\"\"
+    rows = []
+    for record in records:
+        row = {'device_id': record.get('device_id'), 'timestamp': record.get('timestamp')}
+        data = record.get('data')
+        if isinstance(data, dict):
+            row.update(data)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def metric_columns(df):
+    return [c for c in df.select_dtypes(include=[np.number]).columns if c not in NON_METRIC_COLUMNS]
+
+class ColumnAccumulator:
+    \"\"\"Count, mean, M2, min/max and a quantile sample for one column
+
+    Chunks are folded in with Chan's parallel update, so accumulators built
+    from separate chunks (or processes) merge into the same result as one pass
+    over all the data. Quantiles come from a fixed-size uniform sample that is
+    merged in proportion to each side's count.
+    \"\"\"
+
+    def __init__(self, sample_size=10000, seed=0):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.sample_size = sample_size
+        self.sample = np.empty(0)
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return self
+        other = ColumnAccumulator(self.sample_size)
+        other.count = values.size
+        other.mean = float(values.mean())
+        other.m2 = float(((values - other.mean) ** 2).sum())
+        other.min = float(values.min())
+        other.max = float(values.max())
+        other.sample = values if values.size <= self.sample_size else \\
+            self.rng.choice(values, self.sample_size, replace=False)
+        return self.merge(other)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / total
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sample = self._merge_samples(other, total)
+        self.count = total
+        return self
+
+    def _merge_samples(self, other, total):
+        if self.sample.size + other.sample.size <= self.sample_size:
+            return np.concatenate([self.sample, other.sample])
+        # Take from each side in proportion to the rows it represents
+        take_self = int(round(self.sample_size * self.count / total))
+        take_self = min(take_self, self.sample.size)
+        take_other = min(self.sample_size - take_self, other.sample.size)
+        return np.concatenate([
+            self.rng.choice(self.sample, take_self, replace=False),
+            self.rng.choice(other.sample, take_other, replace=False)
+        ])
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.m2 / (self.count - 1))) if self.count > 1 else 0.0
+
+    def quantile(self, q):
+        return float(np.quantile(self.sample, q)) if self.sample.size else float('nan')
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'median': self.quantile(0.5),
+            'std': self.std,
+            'min': self.min,
+            'max': self.max,
+            'q25': self.quantile(0.25),
+            'q75': self.quantile(0.75)
+        }
+
+class TrendAccumulator:
+    \"\"\"Running sums for a least-squares slope against row position\"\"\"
+
+    def __init__(self):
+        self.n = 0
+        self.sx = self.sy = self.sxx = self.sxy = 0.0
+
+    def update(self, x, y):
+        mask = ~np.isnan(y)
+        x, y = x[mask], y[mask]
+        self.n += x.size
+        self.sx += float(x.sum())
+        self.sy += float(y.sum())
+        self.sxx += float((x * x).sum())
+        self.sxy += float((x * y).sum())
+        return self
+
+    def merge(self, other):
+        self.n += other.n
+        self.sx += other.sx
+        self.sy += other.sy
+        self.sxx += other.sxx
+        self.sxy += other.sxy
+        return self
+
+    def slope(self):
+        denominator = self.n * self.sxx - self.sx ** 2
+        return (self.n * self.sxy - self.sx * self.sy) / denominator if denominator else 0.0
+
+class StreamingStats:
+    \"\"\"Per-column accumulators fed one DataFrame chunk at a time\"\"\"
+
+    def __init__(self, sample_size=10000):
+        self.sample_size = sample_size
+        self.columns = {}
+        self.trends = {}
+        self.rows = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+
+    def update(self, df):
+        positions = np.arange(self.rows, self.rows + len(df), dtype=float)
+        for column in metric_columns(df):
+            values = df[column].to_numpy(dtype=float)
+            self.columns.setdefault(column, ColumnAccumulator(self.sample_size)).update(values)
+            self.trends.setdefault(column, TrendAccumulator()).update(positions, values)
+        if 'timestamp' in df.columns and len(df):
+            start, end = df['timestamp'].min(), df['timestamp'].max()
+            self.first_timestamp = start if self.first_timestamp is None else min(self.first_timestamp, start)
+            self.last_timestamp = end if self.last_timestamp is None else max(self.last_timestamp, end)
+        self.rows += len(df)
+        return self
+
+    def merge(self, other):
+        for column, accumulator in other.columns.items():
+            self.columns.setdefault(column, ColumnAccumulator(self.sample_size)).merge(accumulator)
+        for column, accumulator in other.trends.items():
+            self.trends.setdefault(column, TrendAccumulator()).merge(accumulator)
+        for stamp in (other.first_timestamp, other.last_timestamp):
+            if stamp is not None:
+                self.first_timestamp = stamp if self.first_timestamp is None else min(self.first_timestamp, stamp)
+                self.last_timestamp = stamp if self.last_timestamp is None else max(self.last_timestamp, stamp)
+        self.rows += other.rows
+        return self
+
+    def statistics(self):
+        return {column: accumulator.summary() for column, accumulator in self.columns.items()}
+
+    def trend_report(self):
+        trends = {}
+        for column, accumulator in self.trends.items():
+            slope = accumulator.slope()
+            trends[column] = {
+                'slope': slope,
+                'direction': 'increasing' if slope > 0 else 'decreasing',
+                'magnitude': abs(slope)
+            }
+        return trends
+
+    def iqr_bounds(self):
+        \"\"\"Outlier bounds per column from the approximate quartiles\"\"\"
+        bounds = {}
+        for column, accumulator in self.columns.items():
+            q1, q3 = accumulator.quantile(0.25), accumulator.quantile(0.75)
+            iqr = q3 - q1
+            bounds[column] = (q1 - 1.5 * iqr, q3 + 1.5 * iqr)
+        return bounds
+
+class DataProcessor:
+    def __init__(self, mongo_uri='mongodb://localhost:27017/', database='smartx_iot', batch_size=5000):
+        self.mongo_uri = mongo_uri
+        self.database = database
+        self.batch_size = batch_size
+        self.data_buffer = []
+        self.analysis_results = {}
+
+    def load_sensor_data(self, source_type="mongodb", **kwargs):
+        \"\"\"Load sensor data from various sources\"\"\"
+        if source_type == "mongodb":
+            return self.load_from_mongodb(**kwargs)
+        elif source_type == "csv":
+            return self.load_from_csv(**kwargs)
+        elif source_type == "json":
+            return self.load_from_json(**kwargs)
+        else:
+            raise ValueError(f"Unsupported source type: {source_type}")
+
+    def load_from_csv(self, path="sensor_data.csv"):
+        \"\"\"Load flat rows from a CSV file\"\"\"
+        return pd.read_csv(path, parse_dates=['timestamp'])
+
+    def load_from_json(self, path="sensor_data.json"):
+        \"\"\"Load records in the platform's JSON fallback format\"\"\"
+        with open(path) as f:
+            df = flatten_records(json.load(f))
+        df['timestamp'] = pd.to_datetime(df['timestamp'])
+        return df
+
+    def list_devices(self, collection_name="sensor_data", hours=24):
+        \"\"\"Device ids with readings in the window\"\"\"
+        from pymongo import MongoClient
+        client = MongoClient(self.mongo_uri)
+        try:
+            since = datetime.utcnow() - timedelta(hours=hours)
+            return sorted(client[self.database][collection_name].distinct('device_id', {'timestamp': {'$gte': since}}))
+        finally:
+            client.close()
+
+    def iter_mongodb_chunks(self, collection_name="sensor_data", hours=24, batch_size=None, device_id=None):
+        \"\"\"Yield the window as flat DataFrames of at most batch_size rows\"\"\"
+        from pymongo import MongoClient
+        batch_size = batch_size or self.batch_size
+        client = MongoClient(self.mongo_uri)
+        try:
+            collection = client[self.database][collection_name]
+            since = datetime.utcnow() - timedelta(hours=hours)
+            query = {'timestamp': {'$gte': since}}
+            if device_id is not None:
+                query['device_id'] = device_id
+            cursor = collection.find(query, {'_id': 0}) \\
+                .sort('timestamp', 1).batch_size(batch_size)
+            chunk = []
+            for record in cursor:
+                chunk.append(record)
+                if len(chunk) >= batch_size:
+                    yield flatten_records(chunk)
+                    chunk = []
+            if chunk:
+                yield flatten_records(chunk)
+        finally:
+            client.close()
+
+    def load_from_mongodb(self, collection_name="sensor_data", hours=24):
+        \"\"\"Load data from MongoDB\"\"\"
+        try:
+            chunks = list(self.iter_mongodb_chunks(collection_name, hours))
+            return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+        except Exception as e:
+            print(f"Error loading from MongoDB: {e}")
+            return pd.DataFrame()
+
+    def outlier_mask(self, df, bounds):
+        \"\"\"Rows whose metrics all sit inside their bounds, as one vectorized mask\"\"\"
+        columns = [c for c in bounds if c in df.columns]
+        if not columns:
+            return np.ones(len(df), dtype=bool)
+        values = df[columns].to_numpy(dtype=float)
+        lower = np.array([bounds[c][0] for c in columns])
+        upper = np.array([bounds[c][1] for c in columns])
+        inside = (values >= lower) & (values <= upper)
+        return (inside | np.isnan(values)).all(axis=1)
+
+    def clean_data(self, df, bounds=None, fill_values=None):
+        \"\"\"Clean and preprocess sensor data
+
+        IQR bounds are computed once on the unfiltered frame (or passed in from
+        streaming statistics) and applied to every column in a single mask.
+        \"\"\"
+        # Remove duplicates
+        df = df.drop_duplicates(subset=[c for c in df.columns if c != '_id'])
+
+        # Handle missing values
+        numeric_columns = metric_columns(df)
+        if fill_values is None:
+            fill_values = df[numeric_columns].mean()
+        df[numeric_columns] = df[numeric_columns].fillna(fill_values)
+
+        # Remove outliers using IQR method
+        if bounds is None:
+            quartiles = df[numeric_columns].quantile([0.25, 0.75])
+            iqr = quartiles.loc[0.75] - quartiles.loc[0.25]
+            bounds = {c: (quartiles.loc[0.25, c] - 1.5 * iqr[c], quartiles.loc[0.75, c] + 1.5 * iqr[c])
+                      for c in numeric_columns}
+        return df[self.outlier_mask(df, bounds)]
+
+    def calculate_statistics(self, df):
+        \"\"\"Calculate comprehensive statistics\"\"\"
+        return StreamingStats().update(df).statistics()
+
+    def detect_anomalies(self, df, threshold=2, stats=None, max_examples=100):
+        \"\"\"Detect anomalies using statistical methods
+
+        Z-scores for all columns are computed together. With `stats` from a
+        streaming pass the global mean/std are used, so chunks can be scored
+        independently.
+        \"\"\"
+        columns = [c for c in metric_columns(df) if stats is None or c in stats]
+        if stats is None:
+            means = df[columns].mean().to_numpy()
+            stds = df[columns].std().to_numpy()
+        else:
+            means = np.array([stats[c]['mean'] for c in columns])
+            stds = np.array([stats[c]['std'] for c in columns])
+        values = df[columns].to_numpy(dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            flagged = np.abs((values - means) / stds) > threshold
+
+        anomalies = {}
+        for i, column in enumerate(columns):
+            rows = np.flatnonzero(flagged[:, i])
+            anomalies[column] = {
+                'count': int(rows.size),
+                'indices': df.index[rows[:max_examples]].tolist(),
+                'values': values[rows[:max_examples], i].tolist()
+            }
+        return anomalies
+
+    def generate_trends(self, df):
+        \"\"\"Generate trend analysis\"\"\"
+        if 'timestamp' not in df.columns:
+            return {}
+        df = df.sort_values('timestamp')
+        return StreamingStats().update(df).trend_report()
+
+    def generate_report(self, df):
+        \"\"\"Generate comprehensive analysis report\"\"\"
+        report = {
+            'timestamp': datetime.now().isoformat(),
+            'data_summary': {
+                'total_records': len(df),
+                'date_range': {
+                    'start': df['timestamp'].min() if 'timestamp' in df.columns else None,
+                    'end': df['timestamp'].max() if 'timestamp' in df.columns else None
+                }
+            },
+            'statistics': self.calculate_statistics(df),
+            'anomalies': self.detect_anomalies(df),
+            'trends': self.generate_trends(df)
+        }
+
+        return report
+
+    def generate_report_chunked(self, chunks, threshold=2, max_examples=100):
+        \"\"\"Build the same report from a re-iterable source of chunks\"\"\"
+        return self.analyze_chunked(chunks, threshold, max_examples)[0]
+
+    def analyze_chunked(self, chunks, threshold=2, max_examples=100):
+        \"\"\"Return (report, cleaned StreamingStats) for a re-iterable chunk source
+
+        `chunks` is called twice: the first pass gathers raw statistics for the
+        fill values and IQR bounds, the second cleans each chunk, accumulates
+        the cleaned statistics and trends and scores anomalies. Only
+        accumulators stay in memory.
+        \"\"\"
+        raw = StreamingStats()
+        for chunk in chunks():
+            raw.update(chunk)
+        raw_stats = raw.statistics()
+        bounds = raw.iqr_bounds()
+        fill_values = pd.Series({c: s['mean'] for c, s in raw_stats.items()})
+        # Anomalies are scored against the cleaned distribution, estimated
+        # from each column's sample so the second pass can score chunk by chunk
+        score_stats = {}
+        for column, accumulator in raw.columns.items():
+            low, high = bounds[column]
+            inside = accumulator.sample[(accumulator.sample >= low) & (accumulator.sample <= high)]
+            score_stats[column] = {'mean': float(inside.mean()) if inside.size else accumulator.mean,
+                                   'std': float(inside.std(ddof=1)) if inside.size > 1 else accumulator.std}
+
+        cleaned = StreamingStats()
+        anomalies = {c: {'count': 0, 'indices': [], 'values': []} for c in raw_stats}
+        for chunk in chunks():
+            chunk = self.clean_data(chunk, bounds=bounds, fill_values=fill_values)
+            chunk.index = pd.RangeIndex(cleaned.rows, cleaned.rows + len(chunk))
+            cleaned.update(chunk)
+            for column, found in self.detect_anomalies(chunk, threshold, score_stats, max_examples).items():
+                entry = anomalies.setdefault(column, {'count': 0, 'indices': [], 'values': []})
+                entry['count'] += found['count']
+                room = max_examples - len(entry['indices'])
+                entry['indices'].extend(found['indices'][:room])
+                entry['values'].extend(found['values'][:room])
+
+        report = {
+            'timestamp': datetime.now().isoformat(),
+            'data_summary': {
+                'total_records': cleaned.rows,
+                'raw_records': raw.rows,
+                'date_range': {'start': cleaned.first_timestamp, 'end': cleaned.last_timestamp}
+            },
+            'statistics': cleaned.statistics(),
+            'anomalies': anomalies,
+            'trends': cleaned.trend_report()
+        }
+        return report, cleaned
+
+    def generate_report_parallel(self, df, n_jobs=None):
+        \"\"\"Clean and analyse each device in a process pool, then merge
+
+        Partitions are submitted largest first so one big device doesn't
+        finish last on an otherwise idle pool.
+        \"\"\"
+        partitions = sorted(((device_id, frame) for device_id, frame in df.groupby('device_id', sort=False)),
+                            key=lambda item: len(item[1]), reverse=True)
+        with ProcessPoolExecutor(max_workers=resolve_jobs(n_jobs)) as pool:
+            results = list(pool.map(_device_report_from_frame, partitions))
+        return self.merge_device_reports(results)
+
+    def generate_report_parallel_mongo(self, hours=24, n_jobs=None, collection_name="sensor_data"):
+        \"\"\"Stream each device's window from MongoDB in its own worker, then merge\"\"\"
+        settings = {'mongo_uri': self.mongo_uri, 'database': self.database, 'batch_size': self.batch_size}
+        tasks = [(device_id, settings, collection_name, hours)
+                 for device_id in self.list_devices(collection_name, hours)]
+        with ProcessPoolExecutor(max_workers=resolve_jobs(n_jobs)) as pool:
+            results = list(pool.map(_device_report_from_mongo, tasks))
+        return self.merge_device_reports(results)
+
+    def merge_device_reports(self, results):
+        \"\"\"Combine (device_id, report, cleaned stats) results into a fleet report\"\"\"
+        fleet = StreamingStats()
+        devices = {}
+        anomalies = {}
+        for device_id, report, stats in results:
+            fleet.merge(stats)
+            devices[device_id] = report
+            for column, found in report['anomalies'].items():
+                anomalies[column] = anomalies.get(column, 0) + found['count']
+
+        return {
+            'timestamp': datetime.now().isoformat(),
+            'data_summary': {
+                'total_records': fleet.rows,
+                'devices': len(devices),
+                'date_range': {'start': fleet.first_timestamp, 'end': fleet.last_timestamp}
+            },
+            'statistics': fleet.statistics(),
+            'anomalies': {column: {'count': count} for column, count in anomalies.items()},
+            'devices': devices
+        }
+
+    def export_results(self, report, format='json'):
+        \"\"\"Export analysis results\"\"\"
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+
+        if format == 'json':
+            filename = f'smartx_analysis_{timestamp}.json'
+            with open(filename, 'w') as f:
+                json.dump(report, f, indent=2, default=str)
+
+        elif format == 'csv':
+            filename = f'smartx_analysis_{timestamp}.csv'
+            # Convert nested dict to flat structure for CSV
+            flat_data = []
+            for metric, stats in report['statistics'].items():
+                for stat_name, value in stats.items():
+                    flat_data.append({
+                        'metric': metric,
+                        'statistic': stat_name,
+                        'value': value
+                    })
+
+            pd.DataFrame(flat_data).to_csv(filename, index=False)
+
+        return filename
+
+def resolve_jobs(n_jobs):
+    \"\"\"Worker count for n_jobs, where None or -1 means one per core\"\"\"
+    if n_jobs in (None, -1):
+        return os.cpu_count() or 1
+    return max(1, n_jobs)
+
+# Pool workers live at module level so they can be pickled
+def _device_report_from_frame(task):
+    device_id, frame = task
+    processor = DataProcessor()
+    cleaned = processor.clean_data(frame)
+    return device_id, processor.generate_report(cleaned), StreamingStats().update(cleaned)
+
+def _device_report_from_mongo(task):
+    device_id, settings, collection_name, hours = task
+    processor = DataProcessor(**settings)
+    report, cleaned = processor.analyze_chunked(
+        lambda: processor.iter_mongodb_chunks(collection_name, hours, device_id=device_id))
+    return device_id, report, cleaned
+
+def main():
+    parser = argparse.ArgumentParser(description="SmartX data processing pipeline")
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--chunked", action="store_true", help="stream MongoDB in bounded memory")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--n-jobs", type=int, help="analyse devices in parallel (-1 = all cores)")
+    parser.add_argument("--format", choices=["json", "csv"], default="json")
+    args = parser.parse_args()
+
+    processor = DataProcessor(batch_size=args.batch_size)
+
+    if args.n_jobs is not None and args.chunked:
+        report = processor.generate_report_parallel_mongo(args.hours, args.n_jobs)
+        if not report['data_summary']['devices']:
+            print("No data available for processing")
+            return
+    elif args.n_jobs is not None:
+        df = processor.load_sensor_data(source_type="mongodb", hours=args.hours)
+        if df.empty:
+            print("No data available for processing")
+            return
+        report = processor.generate_report_parallel(df, args.n_jobs)
+    elif args.chunked:
+        report = processor.generate_report_chunked(lambda: processor.iter_mongodb_chunks(hours=args.hours))
+        if not report['data_summary']['raw_records']:
+            print("No data available for processing")
+            return
+    else:
+        # Load and process data
+        df = processor.load_sensor_data(source_type="mongodb", hours=args.hours)
+        if df.empty:
+            print("No data available for processing")
+            return
+        # Clean data
+        df_clean = processor.clean_data(df)
+        # Generate analysis report
+        report = processor.generate_report(df_clean)
+
+    # Export results
+    filename = processor.export_results(report, format=args.format)
+    print(f"Analysis complete. Results saved to: {filename}")
+
+if __name__ == "__main__":
+    main()
+"""
+
+def generate_ml_code(blocks):
+    return """#!/usr/bin/env python3
+\"\"\"
+SmartX Machine Learning Prediction System
+Generated automatically from visual blocks
+
+train_per_device() trains one model pair per device in a process pool; the
+fleet-wide trainers pass n_jobs through to scikit-learn instead. The *_batch
+methods score many readings per call, and export_serving_bundle() writes the
+models for the SmartX app's /api/predict.
+\"\"\"
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor, IsolationForest
+from sklearn.preprocessing import StandardScaler
+from sklearn.model_selection import train_test_split
+from sklearn.metrics import mean_squared_error, r2_score
+import joblib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import argparse
+import os
+import warnings
+warnings.filterwarnings('ignore')
+
+SENSOR_COLUMNS = ['temperature', 'pressure', 'vibration', 'humidity']
+SERVING_FORMAT = 'smartx-serving-1'
+
+def reading_arrays(readings):
+    \"\"\"Sensor values (n, 4), hours and weekdays for records, a DataFrame or an array\"\"\"
+    if isinstance(readings, np.ndarray):
+        values = np.atleast_2d(readings).astype(float)
+        stamps = None
+    elif isinstance(readings, pd.DataFrame):
+        values = readings.reindex(columns=SENSOR_COLUMNS).to_numpy(dtype=float)
+        stamps = readings['timestamp'] if 'timestamp' in readings.columns else None
+    else:
+        readings = list(readings)
+        values = np.array([[r.get(c, np.nan) for c in SENSOR_COLUMNS] for r in readings], dtype=float)
+        stamps = [r.get('timestamp') for r in readings] if any('timestamp' in r for r in readings) else None
+    if stamps is None:
+        now = datetime.now()
+        hours = np.full(len(values), now.hour, dtype=float)
+        weekdays = np.full(len(values), now.weekday(), dtype=float)
+    else:
+        stamps = pd.DatetimeIndex(pd.to_datetime(stamps)).fillna(pd.Timestamp.now())
+        hours = stamps.hour.to_numpy(dtype=float)
+        weekdays = stamps.dayofweek.to_numpy(dtype=float)
+    return values, hours, weekdays
+
+def feature_matrix(readings, features):
+    \"\"\"Build a model's feature columns for independent readings in one pass
+
+    A reading scored on its own has no history, so rolling means and lags take
+    the current value and rolling deviations are 0.
+    \"\"\"
+    values, hours, weekdays = reading_arrays(readings)
+    out = np.zeros((len(values), len(features)))
+    for j, name in enumerate(features):
+        if name == 'hour':
+            out[:, j] = hours
+        elif name == 'day_of_week':
+            out[:, j] = weekdays
+        elif not name.endswith('_rolling_std'):
+            base = name.replace('_rolling_mean', '').replace('_lag1', '').replace('_lag2', '')
+            out[:, j] = values[:, SENSOR_COLUMNS.index(base)]
+    return np.nan_to_num(out)
+
+def risk_levels(probabilities):
+    return np.select([probabilities > 0.8, probabilities > 0.6, probabilities > 0.4],
+                     ["Critical", "High", "Medium"], "Low")
+
+def average_path_length(n_samples):
+    \"\"\"Expected isolation depth of a node holding n_samples points\"\"\"
+    n = np.asarray(n_samples, dtype=float)
+    result = np.where(n <= 1, 0.0, 1.0)
+    large = n > 2
+    result[large] = 2.0 * (np.log(n[large] - 1.0) + np.euler_gamma) - 2.0 * (n[large] - 1.0) / n[large]
+    return result
+
+def node_depths(tree):
+    depths = np.zeros(tree.node_count)
+    for node in range(tree.node_count):
+        for child in (tree.children_left[node], tree.children_right[node]):
+            if child != -1:
+                depths[child] = depths[node] + 1
+    return depths
+
+def compile_forest(model, isolation=False):
+    \"\"\"Flatten a fitted forest into padded (trees, nodes) arrays
+
+    Leaves point to themselves, so evaluating every tree for a fixed number of
+    steps (the deepest tree's depth) lands each row on its leaf with no
+    per-tree Python loop. Leaf values hold the regression output, or for an
+    isolation forest the path length including the unbuilt-subtree estimate.
+    \"\"\"
+    trees = [estimator.tree_ for estimator in model.estimators_]
+    width = max(tree.node_count for tree in trees)
+    shape = (len(trees), width)
+    forest = {
+        'feature': np.zeros(shape, dtype=np.int32),
+        'threshold': np.full(shape, np.inf),
+        'left': np.zeros(shape, dtype=np.int32),
+        'right': np.zeros(shape, dtype=np.int32),
+        'value': np.zeros(shape),
+        'depth': int(max(tree.max_depth for tree in trees))
+    }
+    feature_sets = getattr(model, 'estimators_features_', None)
+    for i, tree in enumerate(trees):
+        count = tree.node_count
+        nodes = np.arange(count)
+        leaf = tree.children_left == -1
+        feature = np.where(leaf, 0, tree.feature)
+        if feature_sets is not None:
+            feature = np.asarray(feature_sets[i])[feature]
+        forest['feature'][i, :count] = feature
+        forest['threshold'][i, :count] = np.where(leaf, np.inf, tree.threshold)
+        forest['left'][i, :count] = np.where(leaf, nodes, tree.children_left)
+        forest['right'][i, :count] = np.where(leaf, nodes, tree.children_right)
+        if isolation:
+            forest['value'][i, :count] = node_depths(tree) + average_path_length(tree.n_node_samples)
+        else:
+            forest['value'][i, :count] = tree.value[:, 0, 0]
+    return forest
+
+class SmartXMLSystem:
+    def __init__(self, n_jobs=None):
+        self.n_jobs = n_jobs
+        self.models = {}
+        self.scalers = {}
+        self.feature_importance = {}
+        self.feature_names = {}
+        # device_id -> {'models', 'scalers', 'feature_names'} from train_per_device
+        self.device_models = {}
+        
+    def prepare_features(self, df):
+        \"\"\"Prepare features for machine learning\"\"\"
+        features = []
+        
+        # Basic sensor readings
+        sensor_cols = SENSOR_COLUMNS
+        for col in sensor_cols:
+            if col in df.columns:
+                features.append(col)
+        
+        # Time-based features
+        if 'timestamp' in df.columns:
+            df['timestamp'] = pd.to_datetime(df['timestamp'])
+            df['hour'] = df['timestamp'].dt.hour
+            df['day_of_week'] = df['timestamp'].dt.dayofweek
+            features.extend(['hour', 'day_of_week'])
+        
+        # Rolling statistics (if enough data)
+        if len(df) > 10:
+            for col in sensor_cols:
+                if col in df.columns:
+                    df[f'{col}_rolling_mean'] = df[col].rolling(window=5, min_periods=1).mean()
+                    df[f'{col}_rolling_std'] = df[col].rolling(window=5, min_periods=1).std()
+                    features.extend([f'{col}_rolling_mean', f'{col}_rolling_std'])
+        
+        # Lag features
+        for col in sensor_cols:
+            if col in df.columns and len(df) > 5:
+                df[f'{col}_lag1'] = df[col].shift(1)
+                df[f'{col}_lag2'] = df[col].shift(2)
+                features.extend([f'{col}_lag1', f'{col}_lag2'])
+        
+        return df[features].ffill().fillna(0)
+    
+    def train_failure_prediction(self, df):
+        \"\"\"Train model to predict equipment failure\"\"\"
+        try:
+            # Prepare features
+            X = self.prepare_features(df)
+            
+            # Create failure labels (simplified logic)
+            y = (
+                (df['temperature'] > 85) |
+                (df['pressure'] > 2.0) |
+                (df['vibration'] > 0.8)
+            ).astype(int)
+            
+            # Split data
+            X_train, X_test, y_train, y_test = train_test_split(
+                X, y, test_size=0.2, random_state=42,
+                # A device may have too few failures of one class to stratify
+                stratify=y if y.value_counts().min() >= 2 and y.nunique() > 1 else None
+            )
+            
+            # Scale features
+            scaler = StandardScaler()
+            X_train_scaled = scaler.fit_transform(X_train)
+            X_test_scaled = scaler.transform(X_test)
+            
+            # Train model
+            model = RandomForestRegressor(
+                n_estimators=100,
+                random_state=42,
+                max_depth=10,
+                n_jobs=self.n_jobs
+            )
+            model.fit(X_train_scaled, y_train)
+            
+            # Evaluate
+            y_pred = model.predict(X_test_scaled)
+            mse = mean_squared_error(y_test, y_pred)
+            r2 = r2_score(y_test, y_pred)
+            
+            # Store model and scaler
+            self.models['failure_prediction'] = model
+            self.scalers['failure_prediction'] = scaler
+            self.feature_names['failure_prediction'] = list(X.columns)
+            self.feature_importance['failure_prediction'] = dict(
+                zip(X.columns, model.feature_importances_)
+            )
+            
+            return {
+                'model_type': 'failure_prediction',
+                'mse': mse,
+                'r2_score': r2,
+                'feature_importance': self.feature_importance['failure_prediction']
+            }
+            
+        except Exception as e:
+            print(f"Error training failure prediction model: {e}")
+            return None
+    
+    def train_anomaly_detection(self, df):
+        \"\"\"Train anomaly detection model\"\"\"
+        try:
+            # Prepare features
+            X = self.prepare_features(df)
+            
+            # Scale features
+            scaler = StandardScaler()
+            X_scaled = scaler.fit_transform(X)
+            
+            # Train isolation forest
+            model = IsolationForest(
+                contamination=0.1,
+                random_state=42,
+                n_estimators=100,
+                n_jobs=self.n_jobs
+            )
+            model.fit(X_scaled)
+            
+            # Store model and scaler
+            self.models['anomaly_detection'] = model
+            self.scalers['anomaly_detection'] = scaler
+            self.feature_names['anomaly_detection'] = list(X.columns)
+            
+            # Detect anomalies in training data
+            anomaly_scores = model.decision_function(X_scaled)
+            anomalies = model.predict(X_scaled)
+            
+            return {
+                'model_type': 'anomaly_detection',
+                'anomaly_count': sum(anomalies == -1),
+                'anomaly_percentage': (sum(anomalies == -1) / len(anomalies)) * 100
+            }
+            
+        except Exception as e:
+            print(f"Error training anomaly detection model: {e}")
+            return None
+    
+    def scaled_features(self, model_name, readings):
+        \"\"\"Feature matrix for a batch of readings, standardized for model_name\"\"\"
+        scaler = self.scalers[model_name]
+        X = feature_matrix(readings, self.feature_names[model_name])
+        return (X - scaler.mean_) / scaler.scale_
+
+    def predict_failure_batch(self, readings):
+        \"\"\"Failure probabilities for many readings (records, DataFrame or (n, 4) array)\"\"\"
+        return self.models['failure_prediction'].predict(self.scaled_features('failure_prediction', readings))
+
+    def detect_anomaly_batch(self, readings):
+        \"\"\"(is_anomaly, anomaly_score) arrays for many readings\"\"\"
+        scores = self.models['anomaly_detection'].decision_function(
+            self.scaled_features('anomaly_detection', readings))
+        return scores < 0, scores
+
+    def predict_failure_probability(self, sensor_data):
+        \"\"\"Predict failure probability for new sensor data\"\"\"
+        try:
+            if 'failure_prediction' not in self.models:
+                return None
+
+            probability = float(self.predict_failure_batch([sensor_data])[0])
+
+            return {
+                'failure_probability': probability,
+                'risk_level': str(risk_levels(np.array([probability]))[0]),
+                'confidence': min(100, max(60, probability * 100)),
+                'timestamp': datetime.now().isoformat()
+            }
+
+        except Exception as e:
+            print(f"Error predicting failure: {e}")
+            return None
+
+    def detect_anomaly(self, sensor_data):
+        \"\"\"Detect if sensor data is anomalous\"\"\"
+        try:
+            if 'anomaly_detection' not in self.models:
+                return None
+
+            is_anomaly, scores = self.detect_anomaly_batch([sensor_data])
+            anomaly_score = float(scores[0])
+
+            return {
+                'is_anomaly': bool(is_anomaly[0]),
+                'anomaly_score': anomaly_score,
+                'severity': 'High' if anomaly_score < -0.5 else 'Medium' if anomaly_score < 0 else 'Low',
+                'timestamp': datetime.now().isoformat()
+            }
+
+        except Exception as e:
+            print(f"Error detecting anomaly: {e}")
+            return None
+
+    def save_models(self, filepath_prefix="smartx_ml_models"):
+        \"\"\"Save trained models to disk\"\"\"
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        
+        for model_name, model in self.models.items():
+            model_file = f"{filepath_prefix}_{model_name}_{timestamp}.joblib"
+            scaler_file = f"{filepath_prefix}_{model_name}_scaler_{timestamp}.joblib"
+            
+            joblib.dump(model, model_file)
+            joblib.dump(self.scalers[model_name], scaler_file)
+            
+            print(f"Saved {model_name} model: {model_file}")
+            print(f"Saved {model_name} scaler: {scaler_file}")
+    
+    def load_models(self, model_files):
+        \"\"\"Load pre-trained models from disk\"\"\"
+        for model_name, files in model_files.items():
+            self.models[model_name] = joblib.load(files['model'])
+            self.scalers[model_name] = joblib.load(files['scaler'])
+            print(f"Loaded {model_name} model")
+
+    def export_serving_bundle(self, path="smartx_model.joblib"):
+        \"\"\"Write the trained models in the format the SmartX app serves
+
+        Forests are stored as flat arrays and the file is uncompressed, so the
+        app memory-maps it and scores without scikit-learn. Point MODEL_PATH
+        at the file (or POST /api/models/reload) to serve it.
+        \"\"\"
+        bundle = {'format': SERVING_FORMAT, 'created': datetime.now().isoformat(), 'models': {}}
+        for model_name, isolation in (('failure_prediction', False), ('anomaly_detection', True)):
+            if model_name not in self.models:
+                continue
+            model = self.models[model_name]
+            entry = {
+                'features': self.feature_names[model_name],
+                'mean': self.scalers[model_name].mean_,
+                'scale': self.scalers[model_name].scale_,
+                'forest': compile_forest(model, isolation=isolation)
+            }
+            if isolation:
+                entry['path_norm'] = float(average_path_length([model.max_samples_])[0])
+                entry['offset'] = float(model.offset_)
+            bundle['models'][model_name] = entry
+        joblib.dump(bundle, path)
+        print(f"Saved serving bundle: {path}")
+        return path
+
+    def train_per_device(self, df, n_jobs=None, min_rows=50):
+        \"\"\"Train failure and anomaly models for every device in a process pool
+
+        Devices are independent, so each partition is trained in its own
+        process with single-threaded estimators (n_jobs processes already
+        use every core). Devices with fewer than min_rows readings are skipped.
+        \"\"\"
+        partitions = []
+        skipped = []
+        for device_id, frame in df.groupby('device_id', sort=False):
+            if len(frame) < min_rows:
+                skipped.append(device_id)
+            else:
+                partitions.append((device_id, frame.sort_values('timestamp') if 'timestamp' in frame else frame))
+        # Largest partitions first keeps the pool busy until the end
+        partitions.sort(key=lambda item: len(item[1]), reverse=True)
+
+        results = {}
+        with ProcessPoolExecutor(max_workers=resolve_jobs(n_jobs)) as pool:
+            for device_id, device_results, fitted in pool.map(_train_device, partitions):
+                self.device_models[device_id] = fitted
+                results[device_id] = device_results
+
+        r2_scores = [r['failure_prediction']['r2_score'] for r in results.values() if r['failure_prediction']]
+        return {
+            'devices': results,
+            'skipped': skipped,
+            'summary': {
+                'trained': len(results),
+                'mean_r2_score': float(np.mean(r2_scores)) if r2_scores else None,
+                'anomaly_count': int(sum(r['anomaly_detection']['anomaly_count']
+                                         for r in results.values() if r['anomaly_detection']))
+            }
+        }
+
+def resolve_jobs(n_jobs):
+    \"\"\"Worker count for n_jobs, where None or -1 means one per core\"\"\"
+    if n_jobs in (None, -1):
+        return os.cpu_count() or 1
+    return max(1, n_jobs)
+
+# Pool worker lives at module level so it can be pickled
+def _train_device(task):
+    device_id, frame = task
+    system = SmartXMLSystem(n_jobs=1)
+    results = {
+        'failure_prediction': system.train_failure_prediction(frame.copy()),
+        'anomaly_detection': system.train_anomaly_detection(frame.copy())
+    }
+    fitted = {'models': system.models, 'scalers': system.scalers, 'feature_names': system.feature_names}
+    return device_id, results, fitted
+
+def sample_fleet(devices=1, n_samples=1000):
+    \"\"\"Synthetic readings for demonstration, n_samples per device\"\"\"
+    np.random.seed(42)
+    frames = []
+    for d in range(devices):
+        frame = pd.DataFrame({
+            'device_id': f"device_{d:03d}",
+            'temperature': np.random.normal(75, 10, n_samples),
+            'pressure': np.random.normal(1.5, 0.3, n_samples),
+            'vibration': np.random.exponential(0.3, n_samples),
+            'humidity': np.random.normal(50, 8, n_samples),
+            'timestamp': pd.date_range(start='2024-01-01', periods=n_samples, freq='h')
+        })
+
+        # Add some anomalies
+        anomaly_indices = np.random.choice(n_samples, size=n_samples // 20, replace=False)
+        frame.loc[anomaly_indices, 'temperature'] += 20
+        frame.loc[anomaly_indices, 'pressure'] += 1.0
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="SmartX ML prediction system")
+    parser.add_argument("--n-jobs", type=int, default=None, help="worker processes / sklearn jobs (-1 = all cores)")
+    parser.add_argument("--per-device", type=int, metavar="DEVICES",
+                        help="train one model pair per device for this many sample devices")
+    args = parser.parse_args()
+
+    if args.per_device:
+        ml_system = SmartXMLSystem()
+        fleet = sample_fleet(devices=args.per_device)
+        print(f"Training per-device models for {args.per_device} devices...")
+        results = ml_system.train_per_device(fleet, n_jobs=args.n_jobs)
+        print(f"Per-device training summary: {results['summary']}")
+        return
+
+    # Example usage
+    ml_system = SmartXMLSystem(n_jobs=args.n_jobs)
+    
+    # Generate sample data for demonstration
+    sample_data = sample_fleet().drop(columns=['device_id'])
+    
+    print("Training ML models...")
+    
+    # Train models
+    failure_results = ml_system.train_failure_prediction(sample_data)
+    anomaly_results = ml_system.train_anomaly_detection(sample_data)
+    
+    if failure_results:
+        print(f"Failure Prediction Model - R2 Score: {failure_results['r2_score']:.3f}")
+    
+    if anomaly_results:
+        print(f"Anomaly Detection Model - Anomalies Found: {anomaly_results['anomaly_count']}")
+    
+    # Test prediction on new data
+    test_data = {
+        'temperature': 95,
+        'pressure': 2.5,
+        'vibration': 0.9,
+        'humidity': 45
+    }
+    
+    failure_pred = ml_system.predict_failure_probability(test_data)
+    anomaly_pred = ml_system.detect_anomaly(test_data)
+    
+    if failure_pred:
+        print(f"Failure Prediction: {failure_pred}")
+    
+    if anomaly_pred:
+        print(f"Anomaly Detection: {anomaly_pred}")
+    
+    # Save models
+    ml_system.save_models()
+    ml_system.export_serving_bundle()
+
+if __name__ == "__main__":
+    main()
+"""
+
+def generate_mqtt_code(blocks):
+    return """#!/usr/bin/env python3
+\"\"\"
+SmartX MQTT Device Simulator
+Generated automatically from visual blocks
+
+MQTTDeviceSimulator runs one device on its own connection. MultiDeviceSimulator
+drives thousands of virtual devices from a single heap-based scheduler over a
+small pool of connections, generating each batch of due readings with numpy.
+\"\"\"
+import paho.mqtt.client as mqtt
+import argparse
+import heapq
+import json
+import time
+import random
+from datetime import datetime
+import threading
+import numpy as np
+
+def sensor_batch(n, rng=np.random):
+    \"\"\"Generate n realistic readings at once as column arrays\"\"\"
+    temperature = 75 + rng.normal(0, 5, n)
+    pressure = 1.5 + rng.normal(0, 0.2, n)
+    vibration = np.maximum(0.1, 0.3 + rng.normal(0, 0.1, n))
+    humidity = np.clip(50 + rng.normal(0, 3, n), 30, 70)
+
+    # Occasionally simulate issues (5% high temperature, 3% pressure, 4% vibration)
+    temperature += (rng.random(n) < 0.05) * rng.uniform(10, 20, n)
+    pressure += (rng.random(n) < 0.03) * rng.uniform(0.5, 1.0, n)
+    vibration += (rng.random(n) < 0.04) * rng.uniform(0.3, 0.6, n)
+
+    # Determine status based on readings
+    critical = (temperature > 90) | (pressure > 2.2) | (vibration > 1.0)
+    warning = (temperature > 85) | (pressure > 2.0) | (vibration > 0.8)
+    status = np.where(critical, "Critical", np.where(warning, "Warning", "Running"))
+
+    # Calculate efficiency (decreases with problems)
+    efficiency = (95 - np.maximum(0, temperature - 80) * 2
+                  - np.maximum(0, pressure - 1.8) * 10
+                  - np.maximum(0, vibration - 0.6) * 20)
+    efficiency = np.clip(efficiency, 60, 100)
+
+    return {
+        "temperature": np.round(temperature, 1),
+        "pressure": np.round(pressure, 2),
+        "vibration": np.round(vibration, 2),
+        "humidity": np.round(humidity, 1),
+        "status": status,
+        "efficiency": np.round(efficiency, 1)
+    }
+
+# Bounds on a publish interval requested by the server's rate controller
+MIN_INTERVAL = 0.5
+MAX_INTERVAL = 300.0
+
+def requested_interval(control_data):
+    \"\"\"Interval from a set_interval control message, clamped, or None\"\"\"
+    if control_data.get('action') != 'set_interval':
+        return None
+    try:
+        interval = float(control_data['interval'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return min(MAX_INTERVAL, max(MIN_INTERVAL, interval))
+
+def handle_action(device_id, action):
+    \"\"\"Act on an automation control message\"\"\"
+    if action == "activate_cooling_system":
+        print(f"{device_id}: Activating cooling system...")
+    elif action == "activate_heating_system":
+        print(f"{device_id}: Activating heating system...")
+    elif action == "open_pressure_relief_valve":
+        print(f"{device_id}: Opening pressure relief valve...")
+    elif action == "reduce_machine_speed":
+        print(f"{device_id}: Reducing machine speed...")
+    else:
+        print(f"{device_id}: Unknown action: {action}")
+
+class MQTTDeviceSimulator:
+    def __init__(self, broker_host="localhost", broker_port=1883, device_id="smartx_device_01"):
+        self.broker_host = broker_host
+        self.broker_port = broker_port
+        self.device_id = device_id
+        self.client = mqtt.Client()
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.running = False
+        self.interval = 5.0
+        self.wake = threading.Event()
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            print(f"Device {self.device_id} connected to MQTT broker")
+            # Subscribe to control messages
+            client.subscribe(f"smartx/control/{self.device_id}")
+        else:
+            print(f"Connection failed: {rc}")
+
+    def on_message(self, client, userdata, msg):
+        try:
+            control_data = json.loads(msg.payload.decode())
+            print(f"Received control message: {control_data}")
+            self.handle_control_message(control_data)
+        except Exception as e:
+            print(f"Error processing control message: {e}")
+
+    def handle_control_message(self, control_data):
+        \"\"\"Handle control messages from the system\"\"\"
+        interval = requested_interval(control_data)
+        if interval is not None:
+            print(f"{self.device_id}: publish interval {self.interval}s -> {interval}s ({control_data.get('reason')})")
+            self.interval = interval
+            # Start the new interval now rather than after the current wait
+            self.wake.set()
+            return
+        handle_action(self.device_id, control_data.get('action'))
+
+    def generate_sensor_data(self):
+        \"\"\"Generate realistic sensor data\"\"\"
+        batch = sensor_batch(1)
+        data = {"device_id": self.device_id}
+        data.update({key: values[0].item() for key, values in batch.items()})
+        data["timestamp"] = datetime.now().isoformat()
+        return data
+
+    def publish_sensor_data(self):
+        \"\"\"Publish sensor data to MQTT topic\"\"\"
+        data = self.generate_sensor_data()
+        topic = f"smartx/sensors/{self.device_id}"
+
+        try:
+            self.client.publish(topic, json.dumps(data))
+            print(f"Published data: {json.dumps(data, indent=2)}")
+        except Exception as e:
+            print(f"Error publishing data: {e}")
+
+    def start_simulation(self, interval=5):
+        \"\"\"Start the device simulation\"\"\"
+        print(f"Starting MQTT device simulation for {self.device_id}")
+        self.running = True
+        self.interval = float(interval)
+
+        # Connect to broker
+        try:
+            self.client.connect(self.broker_host, self.broker_port, 60)
+            self.client.loop_start()
+        except Exception as e:
+            print(f"Failed to connect to MQTT broker: {e}")
+            return
+
+        # Publish data at regular intervals; the server may change the interval
+        while self.running:
+            self.publish_sensor_data()
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def stop_simulation(self):
+        \"\"\"Stop the device simulation\"\"\"
+        self.running = False
+        self.wake.set()
+        self.client.loop_stop()
+        self.client.disconnect()
+        print(f"Stopped simulation for {self.device_id}")
+
+class MultiDeviceSimulator:
+    \"\"\"Many virtual devices on one scheduler thread and a few connections
+
+    Devices sit in a heap keyed by their next due time. Each tick pops every
+    device due within `tick` seconds, generates their readings as one numpy
+    batch and publishes them round-robin over the connection pool. The next
+    due time is advanced from the scheduled time (not the publish time) with
+    +/- jitter, so the fleet keeps its target rate without drifting. A shorter
+    interval from the control topic reschedules the device at once; its old
+    heap entry is left behind and skipped by generation.
+    \"\"\"
+
+    def __init__(self, broker_host="localhost", broker_port=1883, connections=4,
+                 jitter=0.1, tick=0.01, qos=0, report_interval=10.0, seed=None):
+        self.broker_host = broker_host
+        self.broker_port = broker_port
+        self.connection_count = connections
+        self.jitter = jitter
+        self.tick = tick
+        self.qos = qos
+        self.report_interval = report_interval
+        self.rng = np.random.default_rng(seed)
+        self.device_ids = []
+        self.intervals = []
+        self.due = []
+        self.generation = []
+        self.index = {}
+        self.clients = []
+        self.heap = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.published = 0
+        self.skipped = 0
+        self.interval_changes = 0
+        self.lag = []
+        self.started = None
+        self.stopped = None
+
+    def add_device(self, device_id, interval=5):
+        \"\"\"Add a device to the simulation\"\"\"
+        self.index[device_id] = len(self.device_ids)
+        self.device_ids.append(device_id)
+        self.intervals.append(float(interval))
+        self.due.append(0.0)
+        self.generation.append(0)
+
+    def target_rate(self):
+        return sum(1.0 / interval for interval in self.intervals)
+
+    def connect(self):
+        for n in range(self.connection_count):
+            client = mqtt.Client(client_id=f"smartx_sim_{n}_{random.randrange(1 << 30)}")
+            client.max_queued_messages_set(0)
+            if n == 0:
+                # One wildcard subscription serves every simulated device
+                client.on_connect = lambda c, u, f, rc: c.subscribe("smartx/control/+")
+                client.on_message = self.on_control_message
+            client.connect(self.broker_host, self.broker_port, 60)
+            client.loop_start()
+            self.clients.append(client)
+
+    def on_control_message(self, client, userdata, msg):
+        device_id = msg.topic.rsplit('/', 1)[-1]
+        if device_id not in self.index:
+            return
+        try:
+            self.handle_control_message(device_id, json.loads(msg.payload.decode()))
+        except Exception as e:
+            print(f"Error processing control message: {e}")
+
+    def handle_control_message(self, device_id, control_data):
+        \"\"\"Handle a control message addressed to one simulated device\"\"\"
+        interval = requested_interval(control_data)
+        if interval is not None:
+            i = self.index[device_id]
+            with self.lock:
+                previous, self.intervals[i] = self.intervals[i], interval
+                self.interval_changes += 1
+                # A device being published now is rescheduled with the new interval anyway
+                if interval < previous and self.heap and self.due[i] is not None:
+                    # Don't make an alarm speed-up wait out the old interval
+                    due = min(self.due[i], time.monotonic() + interval)
+                    self.generation[i] += 1
+                    self.due[i] = due
+                    heapq.heappush(self.heap, (due, i, self.generation[i]))
+            return
+        handle_action(device_id, control_data.get('action'))
+
+    def schedule_initial(self):
+        \"\"\"Spread first publishes over each device's interval to avoid a burst\"\"\"
+        now = time.monotonic()
+        offsets = self.rng.random(len(self.intervals)) * np.array(self.intervals)
+        with self.lock:
+            self.due = [now + offset for offset in offsets.tolist()]
+            self.heap = [(due, i, self.generation[i]) for i, due in enumerate(self.due)]
+            heapq.heapify(self.heap)
+
+    def next_due(self, due, i):
+        interval = self.intervals[i]
+        return due + interval * (1.0 + self.jitter * (2.0 * random.random() - 1.0))
+
+    def run(self):
+        heap = self.heap
+        last_report = self.started = time.monotonic()
+        last_count = 0
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            if heap and heap[0][0] > now:
+                self.stop_event.wait(min(heap[0][0] - now, 0.5))
+                continue
+            # Take every device due within this tick
+            horizon = now + self.tick
+            due = []
+            with self.lock:
+                while heap and heap[0][0] <= horizon:
+                    when, i, generation = heapq.heappop(heap)
+                    if generation != self.generation[i]:
+                        # Superseded by a reschedule
+                        continue
+                    if now - when > self.intervals[i]:
+                        # Fell more than a whole interval behind; drop the missed publish
+                        self.skipped += 1
+                        when = now
+                    self.due[i] = None
+                    due.append((when, i))
+            if due:
+                self.publish_batch(due, now)
+                with self.lock:
+                    for when, i in due:
+                        self.due[i] = self.next_due(when, i)
+                        heapq.heappush(heap, (self.due[i], i, self.generation[i]))
+            if now - last_report >= self.report_interval:
+                rate = (self.published - last_count) / (now - last_report)
+                print(f"[{len(self.device_ids)} devices] actual {rate:.1f} msg/s, "
+                      f"target {self.target_rate():.1f} msg/s, skipped {self.skipped}, "
+                      f"interval changes {self.interval_changes}")
+                last_report, last_count = now, self.published
+
+    def publish_batch(self, due, now):
+        readings = sensor_batch(len(due), self.rng)
+        columns = {key: values.tolist() for key, values in readings.items()}
+        timestamp = datetime.now().isoformat()
+        for row, (when, i) in enumerate(due):
+            device_id = self.device_ids[i]
+            payload = json.dumps({
+                "device_id": device_id,
+                "temperature": columns["temperature"][row],
+                "pressure": columns["pressure"][row],
+                "vibration": columns["vibration"][row],
+                "humidity": columns["humidity"][row],
+                "status": columns["status"][row],
+                "efficiency": columns["efficiency"][row],
+                "timestamp": timestamp
+            })
+            self.clients[i % len(self.clients)].publish(f"smartx/sensors/{device_id}", payload, qos=self.qos)
+            self.lag.append(max(0.0, now - when))
+        self.published += len(due)
+        if len(self.lag) > 100000:
+            del self.lag[:50000]
+
+    def summary(self):
+        end = self.stopped or time.monotonic()
+        elapsed = max(end - (self.started or end), 1e-9)
+        lag = np.array(self.lag) if self.lag else np.zeros(1)
+        return {
+            'devices': len(self.device_ids),
+            'connections': len(self.clients),
+            'elapsed_s': round(elapsed, 1),
+            'published': self.published,
+            'target_rate': round(self.target_rate(), 1),
+            'actual_rate': round(self.published / elapsed, 1),
+            'skipped': self.skipped,
+            'interval_changes': self.interval_changes,
+            'schedule_lag_ms': {'p50': round(float(np.percentile(lag, 50)) * 1000, 2),
+                                'p99': round(float(np.percentile(lag, 99)) * 1000, 2)}
+        }
+
+    def start(self):
+        print(f"Starting simulation for {len(self.device_ids)} devices over {self.connection_count} connections...")
+        self.connect()
+        self.schedule_initial()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.stopped = time.monotonic()
+        if self.thread:
+            self.thread.join()
+        for client in self.clients:
+            client.loop_stop()
+            client.disconnect()
+        summary = self.summary()
+        print(json.dumps(summary, indent=2))
+        return summary
+
+    def start_all_devices(self, duration=None):
+        \"\"\"Start simulation for all devices\"\"\"
+        self.start()
+        try:
+            # Keep the main thread alive
+            self.stop_event.wait(duration)
+        except KeyboardInterrupt:
+            print("\\nStopping all device simulations...")
+        self.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="SmartX MQTT device simulator")
+    parser.add_argument("--devices", type=int, help="simulate this many devices (skips the menu)")
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--min-interval", type=float, default=3.0)
+    parser.add_argument("--max-interval", type=float, default=8.0)
+    parser.add_argument("--jitter", type=float, default=0.1, help="fraction of the interval")
+    parser.add_argument("--qos", type=int, choices=[0, 1, 2], default=0)
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    args = parser.parse_args()
+
+    if args.devices:
+        simulator = MultiDeviceSimulator(args.broker, args.port, connections=args.connections,
+                                         jitter=args.jitter, qos=args.qos)
+        for i in range(args.devices):
+            simulator.add_device(f"smartx_device_{i+1:05d}", random.uniform(args.min_interval, args.max_interval))
+        simulator.start_all_devices(args.duration)
+        return
+
+    # Single device simulation
+    print("SmartX MQTT Device Simulator")
+    print("Choose simulation mode:")
+    print("1. Single device")
+    print("2. Multiple devices")
+
+    choice = input("Enter choice (1 or 2): ").strip()
+
+    if choice == "1":
+        device_id = input("Enter device ID (default: smartx_device_01): ").strip()
+        if not device_id:
+            device_id = "smartx_device_01"
+
+        interval = input("Enter data publish interval in seconds (default: 5): ").strip()
+        try:
+            interval = int(interval) if interval else 5
+        except ValueError:
+            interval = 5
+
+        device = MQTTDeviceSimulator(args.broker, args.port, device_id=device_id)
+        device.start_simulation(interval)
+
+    elif choice == "2":
+        num_devices = input("Enter number of devices (default: 3): ").strip()
+        try:
+            num_devices = int(num_devices) if num_devices else 3
+        except ValueError:
+            num_devices = 3
+
+        simulator = MultiDeviceSimulator(args.broker, args.port, connections=min(args.connections, num_devices))
+
+        for i in range(num_devices):
+            device_id = f"smartx_device_{i+1:02d}"
+            interval = random.randint(3, 8)  # Random interval between 3-8 seconds
+            simulator.add_device(device_id, interval)
+
+        simulator.start_all_devices(args.duration)
+
+    else:
+        print("Invalid choice. Exiting.")
+
+if __name__ == "__main__":
+    main()
+"""
+
+def generate_basic_monitoring_code(blocks):
+    return """#!/usr/bin/env python3
+\"\"\"
+SmartX Basic Monitoring System
+Generated automatically from visual blocks
+\"\"\"
+import time
+import random
+import json
+from datetime import datetime
+
+class BasicMonitoringSystem:
+    def __init__(self):
+        self.thresholds = {
+            'temperature': {'min': 60, 'max': 85},
+            'pressure': {'min': 1.0, 'max': 2.0},
+            'vibration': {'min': 0.1, 'max': 0.7},
+            'humidity': {'min': 40, 'max': 60}
+        }
+    
+    def monitor_system(self):
+        \"\"\"Generated monitoring function\"\"\"
+        # Simulate sensor readings
+        temperature = random.randint(60, 100)
+        pressure = round(random.uniform(1.0, 2.5), 2)
+        vibration = round(random.uniform(0.1, 1.0), 2)
+        humidity = random.randint(30, 70)
+        
+        print(f"Temperature: {temperature}°F")
+        print(f"Pressure: {pressure} bar")
+        print(f"Vibration: {vibration}")
+        print(f"Humidity: {humidity}%")
+        
+        # Check thresholds
+        alerts = []
+        
+        if temperature > self.thresholds['temperature']['max']:
+            alerts.append(f"High temperature alert: {temperature}°F")
+        
+        if pressure > self.thresholds['pressure']['max']:
+            alerts.append(f"High pressure alert: {pressure} bar")
+        
+        if vibration > self.thresholds['vibration']['max']:
+            alerts.append(f"Excessive vibration: {vibration}")
+        
+        if humidity < self.thresholds['humidity']['min'] or humidity > self.thresholds['humidity']['max']:
+            alerts.append(f"Humidity out of range: {humidity}%")
+        
+        if alerts:
+            print("🚨 ALERTS:")
+            for alert in alerts:
+                print(f"  - {alert}")
+            return "maintenance_required"
+        else:
+            print("✅ All systems normal")
+            return "normal"
+    
+    def main(self):
+        \"\"\"Main execution function\"\"\"
+        print("Starting SmartX monitoring system...")
+        
+        while True:
+            print(f"\\n--- {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
+            status = self.monitor_system()
+            
+            if status == "maintenance_required":
+                print("⚠️ Initiating maintenance protocol...")
+                # In a real system, this would trigger maintenance workflows
+            
+            time.sleep(5)
+
+if __name__ == "__main__":
+    system = BasicMonitoringSystem()
+    try:
+        system.main()
+    except KeyboardInterrupt:
+        print("\\nMonitoring system stopped.")
+"""
+
+GENERATORS = {
+    "iot_automation": generate_iot_automation_code,
+    "data_processing": generate_data_processing_code,
+    "ml_prediction": generate_ml_code,
+    "mqtt_handler": generate_mqtt_code,
+    "monitoring": generate_basic_monitoring_code,
+}
+
+# Block graph compiler
+#
+# The editor sends its workspace as Blockly JSON serialization. Each block type
+# maps to a template that is split into literal/placeholder segments once at
+# import time:
+#   {f_NAME} field value as a Python literal    {n_NAME} numeric field
+#   {v_NAME} value input (expression)           {s_NAME} statement input (body)
+#   {o_NAME} field mapped through OPERATORS     {i_NAME} variable name
+# Field values never reach the output unquoted, so a workspace can't inject code.
+
+MAX_BLOCKS = 5000
+CACHE_SIZE = 512
+INDENT = "    "
+
+OPERATORS = {
+    "OP": {"EQ": "==", "NEQ": "!=", "LT": "<", "LTE": "<=", "GT": ">", "GTE": ">=",
+           "AND": "and", "OR": "or",
+           "ADD": "+", "MINUS": "-", "MULTIPLY": "*", "DIVIDE": "/", "POWER": "**"},
+    "BOOL": {"TRUE": "True", "FALSE": "False"},
+    "MODE": {"WHILE": "", "UNTIL": "not "},
+}
+
+SENSORS = ["pressure", "vibration", "humidity", "power", "flow", "level", "ph", "conductivity", "gas"]
+
+# type -> (kind, template, helper functions the generated code calls)
+BLOCK_TEMPLATES = {
+    "smartx_read_temperature": ("expr", "read_temperature_sensor({f_UNIT})", ["read_temperature_sensor"]),
+    "smartx_send_alert": ("stmt", "send_alert({v_MESSAGE}, severity={f_SEVERITY})", ["send_alert"]),
+    "smartx_log_event": ("stmt", "log_event({v_EVENT})", ["log_event"]),
+    "smartx_send_notification": ("stmt", "send_notification({v_MESSAGE})", ["send_notification"]),
+    "smartx_update_database": ("stmt", "update_database({v_DATA})", ["update_database"]),
+    "smartx_trigger_alarm": ("stmt", "trigger_alarm({v_ALARM_TYPE})", ["trigger_alarm"]),
+    "smartx_create_report": ("stmt", "create_report({v_REPORT_TYPE})", ["create_report"]),
+    "smartx_control_machine": ("stmt", "control_machine({f_ACTION}, duration={v_DURATION})", ["control_machine"]),
+    "smartx_mqtt_publish": ("stmt", "mqtt_publish({v_TOPIC}, {v_MESSAGE})", ["mqtt_publish"]),
+    "smartx_mqtt_subscribe": ("expr", "mqtt_subscribe({v_TOPIC})", ["mqtt_subscribe"]),
+    "smartx_http_request": ("stmt", "http_request({v_URL}, {v_METHOD})", ["http_request"]),
+    "smartx_send_email": ("stmt", "send_email({v_TO}, {v_SUBJECT}, {v_BODY})", ["send_email"]),
+    "smartx_webhook": ("stmt", "webhook({v_URL}, {v_DATA})", ["webhook"]),
+    "smartx_wait_seconds": ("stmt", "time.sleep({v_SECONDS})", []),
+    "smartx_get_timestamp": ("expr", "get_timestamp({f_FORMAT})", ["get_timestamp"]),
+    "controls_repeat_ext": ("stmt", "for _ in range(int({v_TIMES})):\n{s_DO}", []),
+    "controls_whileUntil": ("stmt", "while {o_MODE}({v_BOOL}):\n{s_DO}", []),
+    "logic_compare": ("expr", "({v_A} {o_OP} {v_B})", []),
+    "logic_operation": ("expr", "({v_A} {o_OP} {v_B})", []),
+    "logic_negate": ("expr", "(not {v_BOOL})", []),
+    "logic_boolean": ("expr", "{o_BOOL}", []),
+    "math_number": ("expr", "{n_NUM}", []),
+    "math_arithmetic": ("expr", "({v_A} {o_OP} {v_B})", []),
+    "text": ("expr", "{f_TEXT}", []),
+    "text_print": ("stmt", "print({v_TEXT})", []),
+    "variables_get": ("expr", "{i_VAR}", []),
+    "variables_set": ("stmt", "{i_VAR} = {v_VALUE}", []),
+}
+for _sensor in SENSORS:
+    BLOCK_TEMPLATES[f"smartx_read_{_sensor}"] = ("expr", f"read_{_sensor}_sensor()", [f"read_{_sensor}_sensor"])
+for _name in ["filter_data", "calculate_average", "find_anomaly", "aggregate_data", "transform_data", "validate_data"]:
+    BLOCK_TEMPLATES[f"smartx_{_name}"] = ("expr", _name + "({v_DATA})", [_name])
+for _name in ["predict_failure", "classify_data", "optimize_process", "detect_pattern", "forecast_trend"]:
+    BLOCK_TEMPLATES[f"smartx_{_name}"] = ("expr", _name + "({v_INPUT_DATA}, model={f_MODEL})", [_name])
+for _name in ["schedule_task", "check_time_range", "format_datetime"]:
+    BLOCK_TEMPLATES[f"smartx_{_name}"] = ("expr", _name + "({v_INPUT})", [_name])
+
+# Runtime helpers, emitted only when a block in the workspace calls them
+HELPERS = {
+    "read_temperature_sensor": """def read_temperature_sensor(unit='CELSIUS'):
+    base_temp = random.randint(60, 100)
+    if unit == 'FAHRENHEIT':
+        return (base_temp * 9/5) + 32
+    elif unit == 'KELVIN':
+        return base_temp + 273.15
+    return base_temp
+""",
+    "read_pressure_sensor": "def read_pressure_sensor():\n    return round(random.uniform(1.0, 2.5), 2)\n",
+    "read_vibration_sensor": "def read_vibration_sensor():\n    return round(random.uniform(0.1, 1.0), 2)\n",
+    "read_humidity_sensor": "def read_humidity_sensor():\n    return random.randint(30, 70)\n",
+    "read_power_sensor": "def read_power_sensor():\n    return round(random.uniform(100, 1000), 2)\n",
+    "read_flow_sensor": "def read_flow_sensor():\n    return round(random.uniform(10, 100), 2)\n",
+    "read_level_sensor": "def read_level_sensor():\n    return round(random.uniform(0, 100), 1)\n",
+    "read_ph_sensor": "def read_ph_sensor():\n    return round(random.uniform(6.5, 8.5), 2)\n",
+    "read_conductivity_sensor": "def read_conductivity_sensor():\n    return round(random.uniform(100, 1000), 1)\n",
+    "read_gas_sensor": "def read_gas_sensor():\n    return round(random.uniform(0, 50), 2)\n",
+    "send_alert": "def send_alert(message, severity='MEDIUM'):\n    logger.warning(f\"ALERT [{severity}]: {message}\")\n",
+    "log_event": "def log_event(event):\n    logger.info(f\"EVENT [{datetime.now()}]: {event}\")\n",
+    "send_notification": "def send_notification(message):\n    logger.info(f\"NOTIFICATION: {message}\")\n",
+    "update_database": "def update_database(data):\n    logger.info(f\"DATABASE UPDATE: {data}\")\n",
+    "trigger_alarm": "def trigger_alarm(alarm_type):\n    logger.critical(f\"ALARM TRIGGERED: {alarm_type}\")\n",
+    "create_report": "def create_report(report_type):\n    logger.info(f\"GENERATING REPORT: {report_type}\")\n",
+    "control_machine": """def control_machine(action, duration=None):
+    if duration:
+        logger.info(f"MACHINE CONTROL: {action} for {duration} seconds")
+    else:
+        logger.info(f"MACHINE CONTROL: {action}")
+""",
+    "filter_data": "def filter_data(data):\n    return data\n",
+    "calculate_average": """def calculate_average(data):
+    if isinstance(data, list) and data:
+        return sum(data) / len(data)
+    return data if isinstance(data, (int, float)) else 0
+""",
+    "find_anomaly": "def find_anomaly(data):\n    return random.choice([True, False])\n",
+    "aggregate_data": "def aggregate_data(data):\n    return data\n",
+    "transform_data": "def transform_data(data):\n    return data\n",
+    "validate_data": "def validate_data(data):\n    return data is not None\n",
+    "predict_failure": "def predict_failure(data, model='NN'):\n    return round(random.uniform(0, 1), 3)\n",
+    "classify_data": "def classify_data(data, model='RF'):\n    return random.choice(['normal', 'warning', 'critical'])\n",
+    "optimize_process": "def optimize_process(data, model='SVM'):\n    return {'optimized': True, 'improvement': random.uniform(0, 20)}\n",
+    "detect_pattern": "def detect_pattern(data, model='NN'):\n    return {'pattern_detected': random.choice([True, False])}\n",
+    "forecast_trend": "def forecast_trend(data, model='LR'):\n    return {'trend': random.choice(['increasing', 'decreasing', 'stable'])}\n",
+    "mqtt_publish": "def mqtt_publish(topic, message):\n    logger.info(f\"MQTT PUBLISH: Topic={topic}, Message={message}\")\n",
+    "mqtt_subscribe": "def mqtt_subscribe(topic):\n    logger.info(f\"MQTT SUBSCRIBE: Topic={topic}\")\n    return f\"message_from_{topic}\"\n",
+    "http_request": "def http_request(url, method):\n    logger.info(f\"HTTP {method}: {url}\")\n    return {'status': 'success'}\n",
+    "send_email": "def send_email(to, subject, body):\n    logger.info(f\"EMAIL: To={to}, Subject={subject}\")\n",
+    "webhook": "def webhook(url, data):\n    logger.info(f\"WEBHOOK: URL={url}, Data={data}\")\n",
+    "get_timestamp": """def get_timestamp(format_type='ISO'):
+    now = datetime.now()
+    if format_type == 'UNIX':
+        return int(now.timestamp())
+    elif format_type == 'FORMATTED':
+        return now.strftime('%Y-%m-%d %H:%M:%S')
+    return now.isoformat()
+""",
+    "schedule_task": "def schedule_task(task_info):\n    logger.info(f\"TASK SCHEDULED: {task_info}\")\n",
+    "check_time_range": "def check_time_range(time_range):\n    return True\n",
+    "format_datetime": "def format_datetime(datetime_str):\n    return datetime_str\n",
+}
+
+PROGRAM_HEADER = """#!/usr/bin/env python3
+\"\"\"
+SmartX Workflow
+Generated automatically from visual blocks
+\"\"\"
+import time
+import random
+import logging
+from datetime import datetime
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+"""
+
+PROGRAM_FOOTER = """
+def main():
+    \"\"\"Main automation workflow\"\"\"
+    logger.info("SmartX Workflow Starting...")
+    try:
+        run_workflow()
+        logger.info("SmartX Workflow Completed Successfully")
+    except Exception as e:
+        logger.error(f"Workflow Error: {e}")
+
+if __name__ == "__main__":
+    main()
+"""
+
+
+class BlockGraphError(ValueError):
+    """Raised for workspaces that can't be compiled"""
+
+
+def _compile_template(template):
+    """Split a template into (literal, kind, name) segments"""
+    segments = []
+    for literal, field, _, _ in string.Formatter().parse(template):
+        kind, name = field.split("_", 1) if field else (None, None)
+        segments.append((literal, kind, name))
+    return segments
+
+
+COMPILED_TEMPLATES = {
+    block_type: (kind, _compile_template(template), helpers)
+    for block_type, (kind, template, helpers) in BLOCK_TEMPLATES.items()
+}
+
+
+def _identifier(name):
+    name = re.sub(r"\W", "_", str(name or "")) or "var"
+    if name[0].isdigit() or keyword.iskeyword(name):
+        name = "_" + name
+    return name
+
+
+def _number(value, where):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise BlockGraphError(f"Invalid number in {where}")
+    if not math.isfinite(number):
+        raise BlockGraphError(f"Invalid number in {where}")
+    return repr(int(number)) if number.is_integer() else repr(number)
+
+
+def normalize_graph(graph):
+    """Reduce a workspace to the parts that affect the generated code
+
+    Accepts Blockly's workspace serialization ({"blocks": {"blocks": [...]},
+    "variables": [...]}) or a bare list of top-level blocks. Ids, positions and
+    UI state are dropped, variable ids are resolved to names and top-level
+    blocks are ordered the way Blockly runs them (top to bottom, left to right).
+    """
+    variables = {}
+    top = graph or []
+    if isinstance(graph, dict):
+        variables = {v.get("id"): v.get("name") for v in graph.get("variables") or [] if isinstance(v, dict)}
+        top = graph.get("blocks") or []
+        if isinstance(top, dict):
+            top = top.get("blocks") or []
+    if not isinstance(top, list):
+        raise BlockGraphError("Blocks must be a list or a Blockly workspace")
+
+    count = 0
+
+    def walk(block):
+        nonlocal count
+        if not isinstance(block, dict) or "type" not in block:
+            raise BlockGraphError("Every block needs a type")
+        count += 1
+        if count > MAX_BLOCKS:
+            raise BlockGraphError(f"Workspace has more than {MAX_BLOCKS} blocks")
+        node = {"type": str(block["type"])}
+        fields = {}
+        for name, value in (block.get("fields") or {}).items():
+            if isinstance(value, dict):
+                value = variables.get(value.get("id"), value.get("name", value.get("id")))
+            fields[name] = value
+        if fields:
+            node["fields"] = fields
+        inputs = {}
+        for name, connection in (block.get("inputs") or {}).items():
+            child = None
+            if isinstance(connection, dict):
+                child = connection.get("block") or connection.get("shadow")
+            if child:
+                inputs[name] = walk(child)
+        if inputs:
+            node["inputs"] = inputs
+        following = block.get("next")
+        if isinstance(following, dict) and following.get("block"):
+            node["next"] = walk(following["block"])
+        if block.get("extraState"):
+            node["extraState"] = block["extraState"]
+        return node
+
+    def position(block):
+        if not isinstance(block, dict):
+            return (0, 0)
+        return (block.get("y") or 0, block.get("x") or 0)
+
+    try:
+        return [walk(block) for block in sorted(top, key=position)]
+    except RecursionError:
+        raise BlockGraphError("Workspace is nested too deeply")
+
+
+def graph_hash(code_type, normalized):
+    payload = json.dumps([code_type, normalized], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class _Compiler:
+    """Walks a normalized graph and renders each block's compiled template"""
+
+    def __init__(self):
+        self.helpers = []
+
+    def expression(self, block):
+        if block is None:
+            return "None"
+        entry = COMPILED_TEMPLATES.get(block["type"])
+        if entry is None or entry[0] != "expr":
+            return "None"
+        return self.render(block, entry, 0)
+
+    def statements(self, block, depth):
+        lines = []
+        while block is not None:
+            entry = COMPILED_TEMPLATES.get(block["type"])
+            if block["type"] == "controls_if":
+                lines.append(self.if_block(block, depth))
+            elif entry is None:
+                lines.append(f"{INDENT * depth}pass  # unsupported block: {_identifier(block['type'])}")
+            elif entry[0] == "expr":
+                lines.append(INDENT * depth + self.expression(block))
+            else:
+                lines.append(INDENT * depth + self.render(block, entry, depth))
+            block = block.get("next")
+        return "\n".join(lines) if lines else INDENT * depth + "pass"
+
+    def if_block(self, block, depth):
+        inputs = block.get("inputs", {})
+        extra = block.get("extraState") or {}
+        try:
+            branches = 1 + int(extra.get("elseIfCount", 0) or 0)
+        except (TypeError, ValueError):
+            raise BlockGraphError("Invalid elseIfCount in controls_if")
+        lines = []
+        for n in range(min(branches, MAX_BLOCKS)):
+            statement = "if" if n == 0 else "elif"
+            lines.append(f"{INDENT * depth}{statement} {self.expression(inputs.get(f'IF{n}'))}:")
+            lines.append(self.statements(inputs.get(f"DO{n}"), depth + 1))
+        if extra.get("hasElse") or "ELSE" in inputs:
+            lines.append(f"{INDENT * depth}else:")
+            lines.append(self.statements(inputs.get("ELSE"), depth + 1))
+        return "\n".join(lines)
+
+    def render(self, block, entry, depth):
+        _, segments, helpers = entry
+        self.helpers.extend(helpers)
+        fields = block.get("fields", {})
+        inputs = block.get("inputs", {})
+        out = []
+        for literal, kind, name in segments:
+            out.append(literal)
+            if kind == "f":
+                out.append(repr(fields.get(name)))
+            elif kind == "n":
+                out.append(_number(fields.get(name, 0), f"{block['type']}.{name}"))
+            elif kind == "v":
+                out.append(self.expression(inputs.get(name)))
+            elif kind == "s":
+                out.append(self.statements(inputs.get(name), depth + 1))
+            elif kind == "o":
+                out.append(OPERATORS[name].get(fields.get(name), "None"))
+            elif kind == "i":
+                out.append(_identifier(fields.get(name)))
+        return "".join(out)
+
+
+def compile_graph(normalized):
+    """Generate a standalone program from a normalized block graph"""
+    compiler = _Compiler()
+    body = [compiler.statements(block, 1) for block in normalized] or [INDENT + "pass"]
+    helpers = "\n".join(HELPERS[name] for name in dict.fromkeys(compiler.helpers))
+    run = "def run_workflow():\n" + "\n".join(body) + "\n"
+    return PROGRAM_HEADER + helpers + ("\n" if helpers else "") + run + PROGRAM_FOOTER
+
+
+class ArtifactCache:
+    """Thread-safe LRU of generated artifacts keyed by graph hash"""
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            artifact = self._entries.get(key)
+            if artifact is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return artifact
+
+    def put(self, key, artifact):
+        with self._lock:
+            self._entries[key] = artifact
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+artifact_cache = ArtifactCache()
+
+
+def _raw_key(raw):
+    return "raw:" + hashlib.sha256(raw).hexdigest()
+
+
+def cached_artifact(raw):
+    """Return the artifact for a request body seen before, without parsing it"""
+    return artifact_cache.get(_raw_key(raw))
+
+
+def build_artifact(code_type, blocks, raw=None):
+    """Return (artifact, cached) for a code type and block graph
+
+    The "workflow" type compiles the block graph into a program; every other
+    type yields its fixed template. Without a type, a Blockly workspace is
+    compiled and anything else gets the monitoring template. The artifact
+    holds the source, the graph hash and the result of compiling the source
+    as a syntax check.
+
+    `raw` is the request body the graph was parsed from. An editor re-sending
+    the same body is answered by hashing those bytes, skipping normalization;
+    bodies that only differ in ids or positions still share one artifact
+    through the normalized graph hash.
+    """
+    raw_key = None
+    if raw is not None:
+        raw_key = _raw_key(raw)
+        artifact = artifact_cache.get(raw_key)
+        if artifact is not None:
+            return artifact, True
+
+    if code_type is None:
+        code_type = "workflow" if isinstance(blocks, dict) else "monitoring"
+    # Templates don't depend on the blocks, so only workflows are normalized
+    normalized = normalize_graph(blocks) if code_type == "workflow" else None
+    key = graph_hash(code_type, normalized)
+    artifact = artifact_cache.get(key)
+    if artifact is not None:
+        if raw_key:
+            artifact_cache.put(raw_key, artifact)
+        return artifact, True
+
+    if code_type == "workflow":
+        code = compile_graph(normalized)
+    else:
+        code = GENERATORS.get(code_type, generate_basic_monitoring_code)(blocks)
+    try:
+        compile(code, f"smartx_{code_type}.py", "exec")
+        syntax_error = None
+    except SyntaxError as e:
+        syntax_error = f"line {e.lineno}: {e.msg}"
+    artifact = {
+        "code": code,
+        "type": code_type,
+        "hash": key,
+        "syntax_ok": syntax_error is None,
+        "syntax_error": syntax_error
+    }
+    artifact_cache.put(key, artifact)
+    if raw_key:
+        artifact_cache.put(raw_key, artifact)
+    return artifact, False
+
+
+def generate(code_type, blocks):
+    """Generate source for a code type, defaulting to basic monitoring"""
+    return build_artifact(code_type, blocks)[0]["code"]
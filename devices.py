@@ -0,0 +1,79 @@
+"""
+SmartX device directory
+Location and device type of each registered device, shared by the fleet
+aggregates and the historian rules. A background thread reloads it from
+`connected_devices`, so lookups on the ingest path never touch MongoDB; the
+last copy is kept while MongoDB is unavailable.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+DEFAULT_LOCATION = "unassigned"
+DEFAULT_DEVICE_TYPE = "generic"
+
+
+class DeviceDirectory:
+    """In-memory copy of connected_devices, refreshed every `refresh` seconds"""
+
+    def __init__(self, mongo, refresh=60.0, app=None):
+        self.mongo = mongo
+        self.refresh = refresh
+        self.loaded_at = None
+        self.last_error = None
+        self._devices = {}
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("DEVICE_DIRECTORY_REFRESH", 60.0)
+        self.refresh = float(app.config["DEVICE_DIRECTORY_REFRESH"])
+        app.extensions['smartx_devices'] = self
+
+    def start(self):
+        """Load now, then reload from a background thread (once per process)"""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.reload()
+        threading.Thread(target=self._run, name="device-directory", daemon=True).start()
+
+    def _run(self):
+        while True:
+            # Retry soon until MongoDB has answered once
+            time.sleep(self.refresh if self.loaded_at else 1.0)
+            self.reload()
+
+    def reload(self):
+        if not self.mongo.available:
+            return
+        try:
+            cursor = self.mongo.db.connected_devices.find(
+                {}, {"_id": 0, "device_id": 1, "device_type": 1, "location": 1})
+            devices = {doc["device_id"]: (doc.get("location") or DEFAULT_LOCATION,
+                                          doc.get("device_type") or DEFAULT_DEVICE_TYPE)
+                       for doc in cursor if doc.get("device_id")}
+        except Exception as e:
+            self.last_error = str(e)
+            self.mongo.mark_failed(e)
+            return
+        # One reference swap, so readers never see a partial directory
+        self._devices = devices
+        self.loaded_at = datetime.utcnow()
+        self.last_error = None
+
+    def lookup(self, device_id):
+        """(location, device_type) of a device; never does I/O"""
+        return self._devices.get(device_id, (DEFAULT_LOCATION, DEFAULT_DEVICE_TYPE))
+
+    def device_type(self, device_id):
+        return self.lookup(device_id)[1]
+
+    def status(self):
+        return {
+            "devices": len(self._devices),
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "last_error": self.last_error
+        }
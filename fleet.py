@@ -0,0 +1,528 @@
+"""
+SmartX fleet aggregates
+Every reading updates the aggregates of the nodes its device belongs to: the
+plant root, each prefix of its location path ("plant/line/cell") and its
+device type. A reading replaces the device's previous contribution, so an
+update touches O(depth) nodes and reading a node never looks at devices.
+Per-metric maxima are lazy-deletion heaps, rebuilt whenever superseded
+entries outnumber the live ones. Fleet-wide rankings per metric (risk
+included) are indexed heaps, so a device's new reading moves it in
+O(log n) and the top k come out without touching the rest. Ingest
+processes publish their aggregates to fleet_snapshots for web-only
+processes to serve.
+"""
+import heapq
+import itertools
+import logging
+import math
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+import risk
+from devices import DEFAULT_LOCATION
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_COLLECTION = "fleet_snapshots"
+HIERARCHIES = ("all", "location", "device_type")
+ROOT = "plant"
+STALE_STATUS = "Offline"
+RISK = "risk"
+# Longest ranking a snapshot carries, and so the largest k web-only processes can serve
+TOP_MAX = 100
+# Payload fields that are not metrics
+IGNORED_FIELDS = ("timestamp", "device_id", "status", "alerts")
+
+
+def location_path(location):
+    """Prefixes of a location from the site down: "a/b/c" -> ["a", "a/b", "a/b/c"]"""
+    segments = [segment.strip() for segment in str(location or "").split("/") if segment.strip()]
+    segments = segments or [DEFAULT_LOCATION]
+    return ["/".join(segments[:depth]) for depth in range(1, len(segments) + 1)]
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def metric_values(data):
+    """Numeric metrics of one payload plus its risk score"""
+    values = {name: value for name, value in data.items()
+              if name not in IGNORED_FIELDS and _is_number(value) and "." not in name and not name.startswith("$")}
+    values[RISK] = risk.risk_score(data)
+    return values
+
+
+class _Peak:
+    """Max-heap of (value, device) whose superseded entries are dropped lazily"""
+    __slots__ = ("heap",)
+
+    def __init__(self):
+        self.heap = []
+
+    def push(self, value, seq, device_id):
+        heapq.heappush(self.heap, (-value, seq, device_id))
+
+    def top(self, current):
+        heap = self.heap
+        while heap and not current(heap[0]):
+            heapq.heappop(heap)
+        return (-heap[0][0], heap[0][2]) if heap else None
+
+    def compact(self, current):
+        self.heap = [entry for entry in self.heap if current(entry)]
+        heapq.heapify(self.heap)
+
+
+class _Ranking:
+    """Indexed max-heap of [value, device_id]: O(log n) update and removal, top k in O(k log k)"""
+    __slots__ = ("heap", "index")
+
+    def __init__(self):
+        self.heap = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.heap)
+
+    def _place(self, position, entry):
+        self.heap[position] = entry
+        self.index[entry[1]] = position
+
+    def _up(self, position):
+        heap = self.heap
+        entry = heap[position]
+        while position:
+            parent = (position - 1) // 2
+            if heap[parent][0] >= entry[0]:
+                break
+            self._place(position, heap[parent])
+            position = parent
+        self._place(position, entry)
+
+    def _down(self, position):
+        heap = self.heap
+        entry = heap[position]
+        size = len(heap)
+        while True:
+            child = 2 * position + 1
+            if child >= size:
+                break
+            if child + 1 < size and heap[child + 1][0] > heap[child][0]:
+                child += 1
+            if heap[child][0] <= entry[0]:
+                break
+            self._place(position, heap[child])
+            position = child
+        self._place(position, entry)
+
+    def update(self, device_id, value):
+        position = self.index.get(device_id)
+        if position is None:
+            self.heap.append((value, device_id))
+            self._up(len(self.heap) - 1)
+            return
+        previous = self.heap[position][0]
+        self.heap[position] = (value, device_id)
+        if value > previous:
+            self._up(position)
+        elif value < previous:
+            self._down(position)
+
+    def remove(self, device_id):
+        position = self.index.pop(device_id, None)
+        if position is None:
+            return
+        last = self.heap.pop()
+        if position < len(self.heap):
+            self._place(position, last)
+            self._up(position)
+            self._down(self.index[last[1]])
+
+    def top(self, k):
+        """The k largest (value, device_id), largest first; only the heap's top levels are visited"""
+        heap = self.heap
+        result = []
+        frontier = [(-heap[0][0], heap[0][1], 0)] if heap else []
+        while frontier and len(result) < k:
+            negative, device_id, position = heapq.heappop(frontier)
+            result.append((-negative, device_id))
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (-heap[child][0], heap[child][1], child))
+        return result
+
+
+class _Node:
+    __slots__ = ("hierarchy", "name", "devices", "statuses", "sums", "counts", "peaks", "alerts", "alerting")
+
+    def __init__(self, hierarchy, name):
+        self.hierarchy = hierarchy
+        self.name = name
+        self.devices = 0
+        self.statuses = {}
+        self.sums = {}
+        self.counts = {}
+        self.peaks = {}
+        self.alerts = 0
+        self.alerting = 0
+
+
+class _Device:
+    __slots__ = ("device_id", "location", "device_type", "nodes", "status", "values", "alerts", "seen")
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.location = None
+        self.device_type = None
+        self.nodes = ()
+        self.status = None
+        # metric -> (value, seq); seq identifies the heap entries that are still current
+        self.values = {}
+        self.alerts = 0
+        self.seen = None
+
+
+class FleetIndex:
+    """Incrementally maintained aggregates per hierarchy node"""
+
+    def __init__(self, mongo, directory, app=None):
+        self.mongo = mongo
+        # Shared with the historian; reloaded in the background, so lookups are free
+        self.directory = directory
+        self.enabled = True
+        self.stale_after = 300.0
+        self.publish_interval = 5.0
+        self.last_publish = None
+        self.last_error = None
+        self.publisher = None
+        self._nodes = {}
+        self._devices = {}
+        # Devices by last reading, oldest first, for stale eviction
+        self._by_seen = {}
+        self._rankings = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("FLEET_ENABLED", True)
+        app.config.setdefault("FLEET_STALE_AFTER", 300.0)
+        app.config.setdefault("FLEET_PUBLISH_INTERVAL", 5.0)
+        self.enabled = bool(app.config["FLEET_ENABLED"])
+        self.stale_after = float(app.config["FLEET_STALE_AFTER"])
+        self.publish_interval = float(app.config["FLEET_PUBLISH_INTERVAL"])
+        app.extensions['smartx_fleet'] = self
+
+    @property
+    def running(self):
+        """True in a process that ingests, where the aggregates are live"""
+        return self._pid == os.getpid()
+
+    def _node(self, hierarchy, name):
+        node = self._nodes.get((hierarchy, name))
+        if node is None:
+            node = self._nodes[(hierarchy, name)] = _Node(hierarchy, name)
+        return node
+
+    def _current(self, metric):
+        devices = self._devices
+
+        def current(entry):
+            device = devices.get(entry[2])
+            held = device.values.get(metric) if device is not None else None
+            return held is not None and held[1] == entry[1]
+        return current
+
+    def observe(self, device_id, timestamp, data, alerts=None):
+        """Replace one device's contribution with its latest reading; O(depth x metrics)
+
+        `alerts` is the device's open alert count; by default the thresholds
+        the reading itself crosses are counted.
+        """
+        if not self.enabled or not isinstance(data, dict):
+            return
+        location, device_type = self.directory.lookup(device_id)
+        nodes = (("all", ROOT),) + tuple(("location", name) for name in location_path(location)) \
+            + (("device_type", device_type),)
+        status = data.get("status")
+        values = metric_values(data)
+        if alerts is None:
+            alerts = len(risk.reading_alerts(data))
+        with self._lock:
+            device = self._devices.get(device_id)
+            if device is None:
+                device = self._devices[device_id] = _Device(device_id)
+            previous = set(device.values)
+            self._detach(device)
+            device.location, device.device_type = location, device_type
+            device.nodes = tuple(self._node(hierarchy, name) for hierarchy, name in nodes)
+            device.status = status if isinstance(status, str) else "Unknown"
+            device.values = {metric: (value, next(self._seq)) for metric, value in values.items()}
+            device.alerts = alerts
+            device.seen = timestamp
+            self._attach(device)
+            self._rank(device, previous)
+            self._by_seen.pop(device_id, None)
+            self._by_seen[device_id] = device
+
+    def _rank(self, device, previous):
+        for metric, (value, _) in device.values.items():
+            ranking = self._rankings.get(metric)
+            if ranking is None:
+                ranking = self._rankings[metric] = _Ranking()
+            ranking.update(device.device_id, value)
+        for metric in previous.difference(device.values):
+            ranking = self._rankings[metric]
+            ranking.remove(device.device_id)
+            if not ranking:
+                del self._rankings[metric]
+
+    def _attach(self, device):
+        for node in device.nodes:
+            node.devices += 1
+            node.statuses[device.status] = node.statuses.get(device.status, 0) + 1
+            for metric, (value, seq) in device.values.items():
+                node.sums[metric] = node.sums.get(metric, 0.0) + value
+                node.counts[metric] = node.counts.get(metric, 0) + 1
+                peak = node.peaks.get(metric)
+                if peak is None:
+                    peak = node.peaks[metric] = _Peak()
+                peak.push(value, seq, device.device_id)
+                # Superseded entries pile up under a stable maximum; rebuild once they dominate
+                if len(peak.heap) > 2 * node.counts[metric] + 32:
+                    peak.compact(self._current(metric))
+            node.alerts += device.alerts
+            node.alerting += 1 if device.alerts else 0
+
+    def _detach(self, device):
+        for node in device.nodes:
+            node.devices -= 1
+            remaining = node.statuses[device.status] - 1
+            if remaining:
+                node.statuses[device.status] = remaining
+            else:
+                del node.statuses[device.status]
+            for metric, (value, _) in device.values.items():
+                count = node.counts[metric] - 1
+                if count:
+                    node.counts[metric] = count
+                    node.sums[metric] -= value
+                else:
+                    # Reset rather than subtract so rounding error never outlives the last device
+                    del node.counts[metric], node.sums[metric], node.peaks[metric]
+            node.alerts -= device.alerts
+            node.alerting -= 1 if device.alerts else 0
+        # Invalidates this device's heap entries
+        device.values = {}
+
+    def expire(self, now=None):
+        """Mark devices silent for longer than stale_after as offline; returns how many"""
+        cutoff = (now or datetime.utcnow()) - timedelta(seconds=self.stale_after)
+        expired = 0
+        with self._lock:
+            while self._by_seen:
+                device_id = next(iter(self._by_seen))
+                device = self._by_seen[device_id]
+                if device.seen >= cutoff:
+                    break
+                del self._by_seen[device_id]
+                # Still counted, as offline, but no longer part of the metric aggregates or rankings
+                previous = set(device.values)
+                self._detach(device)
+                device.status = STALE_STATUS
+                device.alerts = 0
+                self._attach(device)
+                self._rank(device, previous)
+                expired += 1
+        return expired
+
+    def _raw(self, node):
+        maxima = {}
+        for metric, peak in node.peaks.items():
+            top = peak.top(self._current(metric))
+            if top is not None:
+                maxima[metric] = list(top)
+        return {
+            "hierarchy": node.hierarchy,
+            "name": node.name,
+            "devices": node.devices,
+            "statuses": sorted(node.statuses.items()),
+            "metrics": [[metric, node.sums[metric], node.counts[metric], maxima.get(metric)]
+                        for metric in sorted(node.counts)],
+            "alerts": node.alerts,
+            "alerting": node.alerting
+        }
+
+    def _ranked(self, metric, k):
+        ranking = self._rankings.get(metric)
+        if ranking is None:
+            return []
+        entries = []
+        for value, device_id in ranking.top(k):
+            device = self._devices[device_id]
+            entries.append([device_id, value, device.status, device.location, device.device_type, device.seen])
+        return entries
+
+    def top(self, metric, k):
+        """The k devices with the highest current value of metric, in snapshot form"""
+        # Evict first so a silent device never outranks the live ones
+        self.expire()
+        with self._lock:
+            return self._ranked(metric, k)
+
+    def raw_nodes(self, hierarchy=None):
+        """Aggregates of every non-empty node (of one hierarchy) in snapshot form"""
+        with self._lock:
+            return [self._raw(node) for node in self._nodes.values()
+                    if node.devices and (hierarchy is None or node.hierarchy == hierarchy)]
+
+    def start(self):
+        """Expire stale devices and publish snapshots from a background thread (once per process)"""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.publisher = f"{socket.gethostname()}:{self._pid}"
+        self._nodes, self._devices, self._by_seen, self._rankings = {}, {}, {}, {}
+        threading.Thread(target=self._run, name="fleet-aggregates", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.publish_interval)
+            try:
+                self.expire()
+            except Exception as e:
+                logger.error(f"Fleet expiry failed: {str(e)}")
+            if self.mongo.available:
+                self.publish()
+
+    def publish(self):
+        """Replace this process's snapshot in fleet_snapshots"""
+        nodes = self.raw_nodes()
+        with self._lock:
+            rankings = [[metric, self._ranked(metric, TOP_MAX)] for metric in sorted(self._rankings)]
+        now = datetime.utcnow()
+        try:
+            self.mongo.db[SNAPSHOT_COLLECTION].replace_one(
+                {"_id": self.publisher},
+                {"_id": self.publisher, "updated": now, "nodes": nodes, "rankings": rankings}, upsert=True)
+        except Exception as e:
+            self.last_error = str(e)
+            self.mongo.mark_failed(e)
+            return False
+        self.last_publish = now
+        self.last_error = None
+        return True
+
+    def status(self):
+        return {
+            "enabled": self.enabled,
+            "running": self.running,
+            "devices": len(self._devices),
+            "nodes": len(self._nodes),
+            "rankings": len(self._rankings),
+            "stale_after_seconds": self.stale_after,
+            "directory": self.directory.status(),
+            "last_publish": self.last_publish.isoformat() if self.last_publish else None,
+            "last_error": self.last_error
+        }
+
+
+def read_snapshots(db, hierarchy, max_age, now=None):
+    """Nodes of one hierarchy merged across the snapshots published within max_age seconds"""
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=max_age)
+    return merge_nodes(node for doc in db[SNAPSHOT_COLLECTION].find({"updated": {"$gte": cutoff}})
+                       for node in doc.get("nodes", []) if node["hierarchy"] == hierarchy)
+
+
+def read_top(db, metric, k, max_age, now=None):
+    """The k highest entries for metric across the snapshots published within max_age seconds"""
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=max_age)
+    entries = [entry for doc in db[SNAPSHOT_COLLECTION].find({"updated": {"$gte": cutoff}}, {"rankings": 1})
+               for name, ranked in doc.get("rankings", []) if name == metric for entry in ranked]
+    return heapq.nlargest(k, entries, key=lambda entry: entry[1])
+
+
+def render_top(entries, metric):
+    """API form of ranked snapshot entries"""
+    ranked = []
+    for rank, (device_id, value, status, location, device_type, seen) in enumerate(entries, 1):
+        entry = {"rank": rank, "device_id": device_id, "value": value, "status": status,
+                 "location": location, "device_type": device_type,
+                 "last_seen": seen.isoformat() if seen else None}
+        if metric == RISK:
+            entry["risk_level"] = risk.risk_level(value)
+        ranked.append(entry)
+    return ranked
+
+
+def merge_nodes(nodes):
+    """Combine snapshot nodes with the same hierarchy and name"""
+    merged = {}
+    for node in nodes:
+        key = (node["hierarchy"], node["name"])
+        into = merged.get(key)
+        if into is None:
+            merged[key] = {**node, "statuses": dict(node["statuses"]),
+                           "metrics": {metric: [total, count, peak] for metric, total, count, peak in node["metrics"]}}
+            continue
+        into["devices"] += node["devices"]
+        into["alerts"] += node["alerts"]
+        into["alerting"] += node["alerting"]
+        for status, count in node["statuses"]:
+            into["statuses"][status] = into["statuses"].get(status, 0) + count
+        for metric, total, count, peak in node["metrics"]:
+            held = into["metrics"].get(metric)
+            if held is None:
+                into["metrics"][metric] = [total, count, peak]
+                continue
+            held[0] += total
+            held[1] += count
+            if peak is not None and (held[2] is None or peak[0] > held[2][0]):
+                held[2] = peak
+    return [{**node, "statuses": sorted(node["statuses"].items()),
+             "metrics": [[metric, *held] for metric, held in sorted(node["metrics"].items())]}
+            for node in merged.values()]
+
+
+def render(node):
+    """API form of one snapshot node"""
+    metrics = {}
+    worst = None
+    for metric, total, count, peak in node["metrics"]:
+        summary = {
+            "mean": round(total / count, 4) if count else None,
+            "max": peak[0] if peak else None,
+            "max_device": peak[1] if peak else None,
+            "devices": count
+        }
+        if metric == RISK:
+            worst = {"score": summary["max"], "device_id": summary["max_device"],
+                     "level": risk.risk_level(summary["max"]) if peak else None, "mean": summary["mean"]}
+        else:
+            metrics[metric] = summary
+    name = node["name"]
+    if node["hierarchy"] == "location":
+        parent, depth = name.rpartition("/")[0] or ROOT, name.count("/") + 1
+    elif node["hierarchy"] == "all":
+        parent, depth = None, 0
+    else:
+        parent, depth = ROOT, 1
+    return {
+        "group_by": node["hierarchy"],
+        "node": name,
+        "parent": parent,
+        "depth": depth,
+        "devices": node["devices"],
+        "status": dict(node["statuses"]),
+        "metrics": metrics,
+        "worst_risk": worst,
+        "active_alerts": node["alerts"],
+        "devices_alerting": node["alerting"]
+    }
+
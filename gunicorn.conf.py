@@ -0,0 +1,24 @@
+"""
+Gunicorn settings for SmartX
+
+The app is imported once in the master (preload) so workers share its pages
+copy-on-write. Nothing opens a socket at import; each worker starts its own
+MongoDB health checker after fork. In ingest roles the worker holding the
+MQTT lock file also runs the MQTT subscriber; the rest stand by.
+"""
+import gc
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+preload_app = True
+
+
+def pre_fork(server, worker):
+    # Move preloaded objects out of the collector's reach so GC passes in the
+    # workers don't write to (and un-share) their pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from app import start_background_services
+    start_background_services(server.app.wsgi())
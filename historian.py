@@ -0,0 +1,360 @@
+"""
+SmartX historian-style ingest compression
+Decides per reading whether it must be persisted. Each metric follows a rule
+for its device type: swinging-door metrics are stored so that straight lines
+between stored points stay within the tolerance of every dropped reading,
+deadband metrics only when they move more than the tolerance from the last
+stored value, and text metrics when they change. A heartbeat stores a point
+at least every max_interval seconds. `resample` rebuilds a regular series
+from stored points with the matching interpolation.
+"""
+import bisect
+import copy
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+MODES = ("swinging_door", "deadband", "change", "none")
+RULES_COLLECTION = "compression_rules"
+EPOCH = datetime(1970, 1, 1)
+
+# Tolerances are roughly the sensors' noise band
+DEFAULT_RULES = {
+    "max_interval": 300,
+    "metrics": {
+        "temperature": {"mode": "swinging_door", "tolerance": 0.5},
+        "pressure": {"mode": "swinging_door", "tolerance": 0.05},
+        "vibration": {"mode": "swinging_door", "tolerance": 0.05},
+        "rpm": {"mode": "swinging_door", "tolerance": 10},
+        "power": {"mode": "swinging_door", "tolerance": 0.5},
+        "humidity": {"mode": "deadband", "tolerance": 1.0},
+        "efficiency": {"mode": "deadband", "tolerance": 1.0},
+        "status": {"mode": "change"}
+    }
+}
+# Metrics without a rule are stored whenever their value changes
+FALLBACK_RULE = {"mode": "change"}
+
+DECISIONS = registry.counter(
+    "smartx_historian_readings_total", "Ingested readings by compression decision", ("decision",))
+
+
+def _seconds(timestamp):
+    return (timestamp - EPOCH).total_seconds()
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def validate_rules(rules):
+    """Normalized copy of a rule document, or ValueError"""
+    if not isinstance(rules, dict):
+        raise ValueError("Rules must be an object")
+    normalized = {"metrics": {}}
+    if "max_interval" in rules:
+        max_interval = rules["max_interval"]
+        if not _is_number(max_interval) or max_interval <= 0:
+            raise ValueError("max_interval must be a positive number of seconds")
+        normalized["max_interval"] = max_interval
+    metrics = rules.get("metrics", {})
+    if not isinstance(metrics, dict):
+        raise ValueError("metrics must be an object keyed by metric name")
+    for metric, rule in metrics.items():
+        if not isinstance(rule, dict) or rule.get("mode") not in MODES:
+            raise ValueError(f"Rule for {metric!r} needs a mode, one of {', '.join(MODES)}")
+        tolerance = rule.get("tolerance", 0)
+        if rule["mode"] in ("swinging_door", "deadband") and (not _is_number(tolerance) or tolerance < 0):
+            raise ValueError(f"Rule for {metric!r} needs a non-negative tolerance")
+        normalized["metrics"][metric] = {"mode": rule["mode"], "tolerance": tolerance}
+    return normalized
+
+
+def merge_rules(base, override):
+    merged = copy.deepcopy(base)
+    if "max_interval" in override:
+        merged["max_interval"] = override["max_interval"]
+    merged["metrics"].update(override.get("metrics", {}))
+    return merged
+
+
+class RuleBook:
+    """Compression rules per device, resolved through the device's type
+
+    Device types come from the shared device directory, per-type rules from
+    `compression_rules`, reloaded every `refresh` seconds by a background
+    thread; the last copy is kept while MongoDB is unavailable.
+    """
+
+    def __init__(self, mongo, directory, defaults=DEFAULT_RULES, refresh=60.0):
+        self.mongo = mongo
+        self.directory = directory
+        self.defaults = defaults
+        self.refresh = refresh
+        self._type_rules = {}
+        self._merged = {}
+        self._loaded = False
+        self._pid = None
+
+    def start(self):
+        """Load now, then reload from a background thread (once per process)"""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.reload()
+        threading.Thread(target=self._run, name="historian-rules", daemon=True).start()
+
+    def _run(self):
+        while True:
+            # Retry soon until MongoDB has answered once
+            time.sleep(self.refresh if self._loaded else 1.0)
+            self.reload()
+
+    def reload(self):
+        if not self.mongo.available:
+            return
+        try:
+            type_rules = {doc["device_type"]: doc for doc in self.mongo.db[RULES_COLLECTION].find({}, {"_id": 0})}
+        except Exception as e:
+            self.mongo.mark_failed(e)
+            return
+        self._type_rules, self._merged, self._loaded = type_rules, {}, True
+
+    def device_type(self, device_id):
+        return self.directory.device_type(device_id)
+
+    def for_type(self, device_type):
+        rules = self._merged.get(device_type)
+        if rules is None:
+            rules = self._merged[device_type] = merge_rules(self.defaults, self._type_rules.get(device_type, {}))
+        return rules
+
+    def for_device(self, device_id):
+        return self.for_type(self.device_type(device_id))
+
+    def save(self, device_type, rules):
+        """Store validated rules for a device type and apply them immediately"""
+        rules = validate_rules(rules)
+        self.mongo.db[RULES_COLLECTION].replace_one(
+            {"device_type": device_type}, {"device_type": device_type, **rules}, upsert=True)
+        self._type_rules[device_type] = rules
+        self._merged.pop(device_type, None)
+        return self.for_type(device_type)
+
+
+class _Track:
+    """Compression state of one device since its last stored reading"""
+    __slots__ = ("anchor", "anchor_t", "held", "held_t", "doors")
+
+    def __init__(self, doc, t):
+        self.restart(doc, t)
+
+    def restart(self, doc, t):
+        self.anchor, self.anchor_t = doc["data"], t
+        self.held, self.held_t = None, None
+        # Feasible slope range [low, high] of a line from the anchor per metric
+        self.doors = {}
+
+
+class IngestCompressor:
+    """Filters readings down to the points a historian has to keep"""
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.enabled = True
+        self.offered = 0
+        self.stored = 0
+        self._tracks = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def init_app(self, app):
+        app.config.setdefault("HISTORIAN_ENABLED", True)
+        app.config.setdefault("HISTORIAN_MAX_INTERVAL", DEFAULT_RULES["max_interval"])
+        app.config.setdefault("HISTORIAN_RULES_REFRESH", 60.0)
+        self.enabled = bool(app.config["HISTORIAN_ENABLED"])
+        self.rules.defaults = merge_rules(DEFAULT_RULES, {"max_interval": app.config["HISTORIAN_MAX_INTERVAL"]})
+        self.rules.refresh = float(app.config["HISTORIAN_RULES_REFRESH"])
+        app.extensions['smartx_historian'] = self
+
+    def start(self, store):
+        """Pass held readings of quiet devices to store() from a background thread"""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, args=(store,), name="historian-flush", daemon=True).start()
+
+    def _run(self, store):
+        while True:
+            time.sleep(10)
+            try:
+                for doc in self.flush_idle():
+                    store(doc)
+            except Exception as e:
+                logger.error(f"Historian flush failed: {str(e)}")
+
+    def offer(self, doc):
+        """Documents to persist now for an incoming reading (zero, one or two)"""
+        self.offered += 1
+        if not self.enabled or not isinstance(doc.get("data"), dict):
+            return self._keep([doc])
+        device_id = doc["device_id"]
+        rules = self.rules.for_device(device_id)
+        t = _seconds(doc["timestamp"])
+        with self._lock:
+            track = self._tracks.get(device_id)
+            if track is None or t <= track.anchor_t:
+                self._tracks[device_id] = _Track(doc, t)
+                return self._keep([doc])
+            stored = []
+            if track.held is not None and not self._fits_doors(track, doc["data"], t, rules):
+                # The last reading that fit becomes the new anchor
+                stored.append(track.held)
+                track.restart(track.held, track.held_t)
+            if t - track.anchor_t >= rules["max_interval"] or self._exception(track, doc["data"], rules):
+                stored.append(doc)
+                track.restart(doc, t)
+            else:
+                self._narrow_doors(track, doc["data"], t, rules)
+                track.held, track.held_t = doc, t
+        return self._keep(stored)
+
+    def _keep(self, docs):
+        self.stored += len(docs)
+        DECISIONS.labels("stored" if docs else "suppressed").inc()
+        return docs
+
+    @staticmethod
+    def _exception(track, values, rules):
+        """True when a reading must be stored regardless of the doors"""
+        if values.keys() != track.anchor.keys():
+            return True
+        metrics = rules["metrics"]
+        for metric, value in values.items():
+            rule = metrics.get(metric, FALLBACK_RULE)
+            anchor = track.anchor[metric]
+            mode = rule["mode"]
+            if mode == "none":
+                return True
+            if mode == "swinging_door" and _is_number(value) and _is_number(anchor):
+                continue
+            if mode == "deadband" and _is_number(value) and _is_number(anchor):
+                if abs(value - anchor) > rule["tolerance"]:
+                    return True
+            elif value != anchor:
+                return True
+        return False
+
+    @staticmethod
+    def _fits_doors(track, values, t, rules):
+        dt = t - track.anchor_t
+        for metric, (low, high) in track.doors.items():
+            value = values.get(metric)
+            if not _is_number(value):
+                return False
+            slope = (value - track.anchor[metric]) / dt
+            if slope < low - 1e-12 or slope > high + 1e-12:
+                return False
+        return True
+
+    @staticmethod
+    def _narrow_doors(track, values, t, rules):
+        dt = t - track.anchor_t
+        for metric, rule in rules["metrics"].items():
+            if rule["mode"] != "swinging_door" or not _is_number(values.get(metric)):
+                continue
+            offset = values[metric] - track.anchor[metric]
+            low = (offset - rule["tolerance"]) / dt
+            high = (offset + rule["tolerance"]) / dt
+            door = track.doors.get(metric)
+            track.doors[metric] = (low, high) if door is None else (max(door[0], low), min(door[1], high))
+
+    def flush_idle(self, now=None):
+        """Held readings of devices quiet for longer than their max_interval
+
+        Stores the last value of a device that stopped reporting, which would
+        otherwise wait for its next reading.
+        """
+        now = _seconds(now or datetime.utcnow())
+        flushed = []
+        with self._lock:
+            for device_id, track in self._tracks.items():
+                if track.held is None:
+                    continue
+                if now - track.held_t >= self.rules.for_device(device_id)["max_interval"]:
+                    flushed.append(track.held)
+                    track.restart(track.held, track.held_t)
+        self.stored += len(flushed)
+        return flushed
+
+    def status(self):
+        return {
+            "enabled": self.enabled,
+            "offered": self.offered,
+            "stored": self.stored,
+            "ratio": round(self.offered / self.stored, 2) if self.stored else None,
+            "devices": len(self._tracks)
+        }
+
+
+def _interpolate(times, values, mode, t, max_interval):
+    """Value at t from stored (times, values) of one metric"""
+    i = bisect.bisect_right(times, t) - 1
+    if i < 0:
+        return None
+    if i == len(times) - 1:
+        # Past the last stored point the value holds until a heartbeat was due
+        return values[i] if t - times[i] <= max_interval else None
+    if t == times[i] or mode != "swinging_door":
+        return values[i]
+    before, after = values[i], values[i + 1]
+    if not _is_number(before) or not _is_number(after):
+        return before
+    return before + (after - before) * (t - times[i]) / (times[i + 1] - times[i])
+
+
+def resample(docs, since, until, step, rules_for_device):
+    """Regular per-device series rebuilt from stored readings
+
+    Swinging-door metrics are interpolated linearly between stored points;
+    deadband and text metrics hold the last stored value. Returns documents
+    shaped like sensor_data, sorted by timestamp.
+    """
+    series = {}
+    for doc in docs:
+        if isinstance(doc.get("data"), dict):
+            series.setdefault(doc["device_id"], []).append(doc)
+    start, end = _seconds(since), _seconds(until)
+    grid = []
+    t = start
+    while t <= end:
+        grid.append(t)
+        t += step
+    result = []
+    for device_id, device_docs in series.items():
+        device_docs.sort(key=lambda d: d["timestamp"])
+        rules = rules_for_device(device_id)
+        columns = {}
+        for doc in device_docs:
+            stamp = _seconds(doc["timestamp"])
+            for metric, value in doc["data"].items():
+                times, values = columns.setdefault(metric, ([], []))
+                times.append(stamp)
+                values.append(value)
+        for t in grid:
+            data = {}
+            for metric, (times, values) in columns.items():
+                mode = rules["metrics"].get(metric, FALLBACK_RULE)["mode"]
+                value = _interpolate(times, values, mode, t, rules["max_interval"])
+                if value is not None:
+                    data[metric] = round(value, 4) if isinstance(value, float) else value
+            if data:
+                result.append({"device_id": device_id, "timestamp": EPOCH + timedelta(seconds=t), "data": data})
+    result.sort(key=lambda d: d["timestamp"])
+    return result
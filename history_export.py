@@ -0,0 +1,336 @@
+"""
+SmartX streamed history export
+Encodes a device/time/field selection of sensor_data as CSV, NDJSON, Arrow
+IPC or Parquet, compressed on the fly, while reading the cursor in batches.
+Days past raw retention are read from the archive one day at a time and
+merged with the raw cursor in time order.
+Finished exports are spooled to disk under a key derived from the selection,
+so HTTP range requests (resumed downloads) are served from the spool file.
+"""
+import csv
+import hashlib
+import heapq
+import io
+import json
+import logging
+import os
+import time
+import zlib
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("csv", "ndjson", "arrow", "parquet")
+COMPRESSIONS = ("none", "gzip", "zstd")
+DEFAULT_FIELDS = ("temperature", "pressure", "vibration", "humidity", "status", "efficiency")
+TEXT_FIELDS = ("status",)
+
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet"
+}
+EXTENSIONS = {"csv": "csv", "ndjson": "ndjson", "arrow": "arrows", "parquet": "parquet"}
+COMPRESSION_SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+
+class ExportError(ValueError):
+    """An export request that cannot be served as asked"""
+
+
+def _parse_time(value, name):
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+    except ValueError:
+        raise ExportError(f"Invalid {name} timestamp: {value!r}")
+
+
+def parse_selection(args, now=None):
+    """Validated selection dict from request arguments
+
+    `until` defaults to now, truncated to the second; the resolved value is
+    part of the export key, so pass it back explicitly to resume a download.
+    """
+    fmt = args.get("format", "csv")
+    if fmt not in FORMATS:
+        raise ExportError(f"Unknown format {fmt!r}, expected one of {', '.join(FORMATS)}")
+    compression = args.get("compression", "none")
+    if compression not in COMPRESSIONS:
+        raise ExportError(f"Unknown compression {compression!r}, expected one of {', '.join(COMPRESSIONS)}")
+
+    now = (now or datetime.utcnow()).replace(microsecond=0)
+    until = _parse_time(args["until"], "until") if args.get("until") else now
+    if args.get("since"):
+        since = _parse_time(args["since"], "since")
+    else:
+        try:
+            hours = float(args.get("hours", 24))
+        except ValueError:
+            raise ExportError("hours must be a number")
+        since = until - timedelta(hours=hours)
+    if since > until:
+        raise ExportError("since must not be after until")
+
+    devices = sorted(d.strip() for d in args.get("devices", "").split(",") if d.strip())
+    fields = [f.strip() for f in args.get("fields", "").split(",") if f.strip()] or list(DEFAULT_FIELDS)
+    if any(not field.replace("_", "").isalnum() for field in fields):
+        raise ExportError("Field names may only contain letters, digits and underscores")
+    return {
+        "devices": devices,
+        "since": since,
+        "until": until,
+        "fields": fields,
+        "format": fmt,
+        "compression": compression
+    }
+
+
+def export_key(selection):
+    """Stable identifier for a selection; also used as the HTTP ETag"""
+    canonical = json.dumps({key: value.isoformat() if isinstance(value, datetime) else value
+                            for key, value in selection.items()}, sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()[:32]
+
+
+def export_filename(selection):
+    stamp = selection["until"].strftime("%Y%m%d_%H%M%S")
+    return (f"smartx_export_{stamp}.{EXTENSIONS[selection['format']]}"
+            f"{COMPRESSION_SUFFIXES[selection['compression']] if selection['format'] != 'parquet' else ''}")
+
+
+def media_type(selection):
+    if selection["format"] == "parquet" or selection["compression"] == "none":
+        return MEDIA_TYPES[selection["format"]]
+    return "application/gzip" if selection["compression"] == "gzip" else "application/zstd"
+
+
+def _row(doc, fields):
+    data = doc.get("data") or {}
+    return (doc.get("device_id"), doc.get("timestamp"), *[data.get(field) for field in fields])
+
+
+def _row_order(row):
+    return row[1], row[0] or ""
+
+
+def iter_raw_rows(collection, selection, batch_size=5000):
+    """(device_id, timestamp, values...) rows from sensor_data in time order"""
+    query = {"timestamp": {"$gte": selection["since"], "$lte": selection["until"]}}
+    if selection["devices"]:
+        query["device_id"] = {"$in": selection["devices"]}
+    projection = {"_id": 0, "device_id": 1, "timestamp": 1}
+    projection.update({f"data.{field}": 1 for field in selection["fields"]})
+    cursor = collection.find(query, projection, sort=[("timestamp", 1), ("device_id", 1)]).batch_size(batch_size)
+    for doc in cursor:
+        yield _row(doc, selection["fields"])
+
+
+def iter_archived_rows(db, selection, cutoff):
+    """Rows from archive blocks for the days before `cutoff`, one day in memory at a time"""
+    from retention import ARCHIVE_COLLECTION, decode_block
+    since, until = selection["since"], min(selection["until"], cutoff)
+    query = {"day": {"$gte": since.replace(hour=0, minute=0, second=0, microsecond=0), "$lte": until}}
+    if selection["devices"]:
+        query["device_id"] = {"$in": selection["devices"]}
+    for day in sorted(db[ARCHIVE_COLLECTION].distinct("day", query)):
+        rows = []
+        for block in db[ARCHIVE_COLLECTION].find({**query, "day": day}):
+            rows.extend(_row(reading, selection["fields"]) for reading in decode_block(block, since, until)
+                        if since <= reading["timestamp"] <= until)
+        rows.sort(key=_row_order)
+        yield from rows
+
+
+def iter_batches(collection, selection, batch_size=5000, cutoff=None):
+    """Yield lists of (device_id, timestamp, values...) rows in time order
+
+    With a raw-retention `cutoff`, archived days before it are merged in.
+    """
+    rows = iter_raw_rows(collection, selection, batch_size)
+    if cutoff is not None and selection["since"] < cutoff:
+        rows = heapq.merge(iter_archived_rows(collection.database, selection, cutoff), rows, key=_row_order)
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _isoformat(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _csv_chunks(batches, fields):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["device_id", "timestamp", *fields])
+    for batch in batches:
+        writer.writerows((device_id, _isoformat(stamp), *values) for device_id, stamp, *values in batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _ndjson_chunks(batches, fields):
+    encode = json.JSONEncoder(default=str).encode
+    for batch in batches:
+        yield "".join([encode({"device_id": device_id, "timestamp": _isoformat(stamp),
+                               **dict(zip(fields, values))}) + "\n"
+                       for device_id, stamp, *values in batch]).encode()
+
+
+class _Sink(io.RawIOBase):
+    """Write-only file object that hands buffered output to a generator"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        out = b"".join(self.chunks)
+        self.chunks = []
+        return out
+
+
+def _columnar_chunks(batches, fields, fmt, compression):
+    import pyarrow as pa
+    schema = pa.schema([("device_id", pa.string()), ("timestamp", pa.timestamp("ms"))]
+                       + [(field, pa.string() if field in TEXT_FIELDS else pa.float64()) for field in fields])
+    sink = _Sink()
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        # Parquet compresses per column; the outer stream is left as is
+        writer = pq.ParquetWriter(sink, schema, compression="none" if compression == "none" else compression)
+        write = writer.write_table
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+        write = writer.write_batch
+    for batch in batches:
+        columns = list(zip(*batch))
+        arrays = [pa.array(column, type=schema.field(i).type, from_pandas=True)
+                  for i, column in enumerate(columns)]
+        if fmt == "parquet":
+            write(pa.Table.from_arrays(arrays, schema=schema))
+        else:
+            write(pa.RecordBatch.from_arrays(arrays, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def _compress(chunks, compression):
+    if compression == "none":
+        yield from chunks
+        return
+    if compression == "gzip":
+        # wbits=31 writes a gzip header with mtime 0, so output is reproducible
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
+    else:
+        import zstandard
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        compress, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        out = compress(chunk)
+        if out:
+            yield out
+    yield finish()
+
+
+def check_available(selection):
+    """Raise ExportError for missing optional packages before any bytes are sent"""
+    if selection["format"] in ("arrow", "parquet"):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ExportError(f"{selection['format']} export needs pyarrow, which is not installed")
+    if selection["compression"] == "zstd" and selection["format"] != "parquet":
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            raise ExportError("zstd compression needs the zstandard package, which is not installed")
+
+
+def export_stream(collection, selection, batch_size=5000, cutoff=None):
+    """Generator of encoded, compressed bytes for a selection, archive included before `cutoff`"""
+    batches = iter_batches(collection, selection, batch_size, cutoff)
+    fmt, fields = selection["format"], selection["fields"]
+    if fmt == "csv":
+        return _compress(_csv_chunks(batches, fields), selection["compression"])
+    if fmt == "ndjson":
+        return _compress(_ndjson_chunks(batches, fields), selection["compression"])
+    columnar = _columnar_chunks(batches, fields, fmt, selection["compression"])
+    return columnar if fmt == "parquet" else _compress(columnar, selection["compression"])
+
+
+class ExportSpool:
+    """Finished exports on disk, keyed by selection, for range requests
+
+    A full download streams to the client and to `<key>.part` at the same
+    time; the file is renamed into place only when the export completes,
+    so a spool file is always whole. Files older than `ttl` are removed.
+    """
+
+    def __init__(self, directory, ttl=3600):
+        self.directory = directory
+        self.ttl = ttl
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.export")
+
+    def ready(self, key):
+        return os.path.exists(self.path(key))
+
+    def tee(self, key, chunks):
+        """Yield chunks while spooling them; the spool is kept only if the stream finishes"""
+        os.makedirs(self.directory, exist_ok=True)
+        self.cleanup()
+        part = f"{self.path(key)}.{os.getpid()}.{time.monotonic_ns()}.part"
+        finished = False
+        try:
+            with open(part, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(part, self.path(key))
+            finished = True
+        finally:
+            if not finished and os.path.exists(part):
+                os.remove(part)
+
+    def build(self, key, chunks):
+        """Write a whole export to the spool without streaming it anywhere"""
+        for _ in self.tee(key, chunks):
+            pass
+        return self.path(key)
+
+    def cleanup(self):
+        cutoff = time.time() - self.ttl
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,36 @@
+"""
+SmartX entry points
+
+    python main.py [all|web|ingest]         # development server for one role
+    gunicorn 'main:web_app()'               # pages and dashboard APIs only
+    gunicorn -w 1 'main:ingest_app()'       # MQTT subscriber and /api/device-data
+    gunicorn 'main:all_in_one_app()'        # pages, APIs and MQTT ingest together
+    gunicorn app:app                        # role from SMARTX_ROLE (default: all)
+
+gunicorn.conf.py preloads the app in the master and starts MongoDB/MQTT
+connections per worker after fork.
+"""
+import os
+import sys
+
+from app import create_app, start_background_services
+
+
+def web_app():
+    return create_app({"SMARTX_ROLE": "web"})
+
+
+def ingest_app():
+    return create_app({"SMARTX_ROLE": "ingest"})
+
+
+def all_in_one_app():
+    return create_app({"SMARTX_ROLE": "all"})
+
+
+if __name__ == "__main__":
+    app = create_app({"SMARTX_ROLE": sys.argv[1]} if len(sys.argv) > 1 else None)
+    # The reloader re-runs this file in a child; only that serving process starts services
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_services(app)
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", "5000")), debug=True)
@@ -0,0 +1,319 @@
+"""
+SmartX in-process model serving
+Scores readings with a bundle written by the generated SmartXMLSystem's
+export_serving_bundle(). Forests arrive as flat arrays, so serving needs numpy
+and joblib but not scikit-learn; both are imported only when a model is loaded.
+"""
+import logging
+import os
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SERVING_FORMAT = "smartx-serving-1"
+SENSOR_COLUMNS = ("temperature", "pressure", "vibration", "humidity")
+
+
+class ModelUnavailable(RuntimeError):
+    """Raised when scoring is requested with no model loaded"""
+
+
+class _Model:
+    """One loaded model: feature plan, scaler and flattened forest"""
+
+    def __init__(self, np, entry, isolation):
+        self.np = np
+        self.features = list(entry["features"])
+        self.mean = np.asarray(entry["mean"], dtype=float)
+        self.scale = np.asarray(entry["scale"], dtype=float)
+        forest = entry["forest"]
+        trees, width = forest["feature"].shape
+        # Index into the flattened arrays as tree * width + node
+        self.offsets = np.arange(trees, dtype=np.intp)[None, :] * width
+        self.feature = forest["feature"].reshape(-1)
+        self.threshold = forest["threshold"].reshape(-1)
+        self.left = forest["left"].reshape(-1).astype(np.intp) + self.offsets.reshape(-1).repeat(width)
+        self.right = forest["right"].reshape(-1).astype(np.intp) + self.offsets.reshape(-1).repeat(width)
+        self.value = forest["value"].reshape(-1)
+        self.depth = int(forest["depth"])
+        self.isolation = isolation
+        self.path_norm = entry.get("path_norm")
+        self.offset = entry.get("offset")
+        self._plan()
+
+    def _plan(self):
+        """Precompute where each feature column comes from"""
+        np = self.np
+        sources, kinds = [], []
+        for name in self.features:
+            if name == "hour":
+                kinds.append(1)
+                sources.append(0)
+            elif name == "day_of_week":
+                kinds.append(2)
+                sources.append(0)
+            elif name.endswith("_rolling_std"):
+                # A single reading has no history to deviate from
+                kinds.append(3)
+                sources.append(0)
+            else:
+                base = name.replace("_rolling_mean", "").replace("_lag1", "").replace("_lag2", "")
+                kinds.append(0)
+                sources.append(SENSOR_COLUMNS.index(base))
+        kinds = np.array(kinds)
+        self.sources = np.array(sources, dtype=np.intp)
+        self.hour_cols = kinds == 1
+        self.weekday_cols = kinds == 2
+        self.zero_cols = kinds == 3
+
+    def scaled(self, values, hours, weekdays):
+        np = self.np
+        X = values[:, self.sources]
+        X[:, self.hour_cols] = hours[:, None]
+        X[:, self.weekday_cols] = weekdays[:, None]
+        X[:, self.zero_cols] = 0.0
+        return (np.nan_to_num(X) - self.mean) / self.scale
+
+    def evaluate(self, X):
+        """Mean leaf value over all trees for each row of X"""
+        np = self.np
+        rows = np.arange(X.shape[0], dtype=np.intp)[:, None] * X.shape[1]
+        flat_x = X.reshape(-1)
+        node = np.broadcast_to(self.offsets, (X.shape[0], self.offsets.shape[1]))
+        for _ in range(self.depth):
+            go_left = flat_x[rows + self.feature[node]] <= self.threshold[node]
+            node = np.where(go_left, self.left[node], self.right[node])
+        return self.value[node].mean(axis=1)
+
+
+class _Snapshot:
+    """Immutable set of models from one bundle; swapped in as a whole"""
+
+    def __init__(self, np, bundle, path, version):
+        if bundle.get("format") != SERVING_FORMAT:
+            raise ValueError(f"{path} is not a {SERVING_FORMAT} bundle")
+        models = bundle["models"]
+        self.failure = _Model(np, models["failure_prediction"], False) if "failure_prediction" in models else None
+        self.anomaly = _Model(np, models["anomaly_detection"], True) if "anomaly_detection" in models else None
+        self.path = path
+        self.version = version
+        self.created = bundle.get("created")
+        self.loaded = datetime.now().isoformat()
+
+
+class _Request:
+    __slots__ = ("reading", "result", "error", "finished", "done")
+
+    def __init__(self, reading):
+        self.reading = reading
+        self.result = None
+        self.error = None
+        self.finished = False
+        self.done = threading.Event()
+
+
+class ModelServer:
+    """Serves one model bundle with micro-batching and atomic hot-swap
+
+    Concurrent callers are batched without a timer: the first caller to find
+    no batch running becomes the leader and scores everything queued (up to
+    max_batch), then wakes the oldest waiter to lead the next batch. A lone
+    request is scored immediately; under load batches grow on their own.
+    Reloading builds a new snapshot beside the old one and swaps the reference,
+    so in-flight batches finish on the model they started with.
+    """
+
+    def __init__(self, app=None, max_batch=256):
+        self.path = None
+        self.model_dir = None
+        self.max_batch = max_batch
+        self.batches = 0
+        self.scored = 0
+        self.last_error = None
+        self._snapshot = None
+        self._np = None
+        self._versions = 0
+        self._load_lock = threading.Lock()
+        self._queue = []
+        self._queue_lock = threading.Lock()
+        self._leading = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("MODEL_PATH", "")
+        app.config.setdefault("MODEL_DIR", "")
+        app.config.setdefault("MODEL_MAX_BATCH", self.max_batch)
+        self.path = app.config["MODEL_PATH"] or None
+        self.model_dir = app.config["MODEL_DIR"] or None
+        self.max_batch = int(app.config["MODEL_MAX_BATCH"])
+        app.extensions['smartx_models'] = self
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def resolve(self, path):
+        """Absolute path of a requested bundle inside MODEL_DIR
+
+        Bundles are unpickled, so only files under the configured directory
+        may be loaded by name; without MODEL_DIR only MODEL_PATH reloads.
+        """
+        if not self.model_dir:
+            raise ModelUnavailable("Loading a bundle by path needs MODEL_DIR; omit path to reload MODEL_PATH")
+        root = os.path.realpath(self.model_dir)
+        resolved = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, resolved]) != root:
+            raise ModelUnavailable("Model bundles must be inside MODEL_DIR")
+        return resolved
+
+    def load(self, path=None):
+        """Load (or reload) a bundle and swap it in; returns the new version"""
+        path = path or self.path
+        if not path:
+            raise ModelUnavailable("No MODEL_PATH configured")
+        with self._load_lock:
+            import joblib
+            import numpy
+            self._np = numpy
+            # Uncompressed bundles are memory-mapped, so forked workers share pages
+            bundle = joblib.load(path, mmap_mode="r")
+            snapshot = _Snapshot(numpy, bundle, path, self._versions + 1)
+            self._versions += 1
+            self._snapshot = snapshot
+            self.path = path
+            self.last_error = None
+        logger.info(f"Loaded model bundle {path} (version {snapshot.version})")
+        return snapshot.version
+
+    def _current(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            if not self.enabled:
+                raise ModelUnavailable("Model serving is not configured")
+            try:
+                self.load()
+            except ModelUnavailable:
+                raise
+            except Exception as e:
+                self.last_error = str(e)
+                raise ModelUnavailable(f"Model could not be loaded: {e}")
+            snapshot = self._snapshot
+        return snapshot
+
+    def predict(self, reading):
+        """Score one reading dict, batched with any concurrent callers"""
+        self._current()
+        request = _Request(reading)
+        with self._queue_lock:
+            self._queue.append(request)
+            lead = not self._leading
+            self._leading = True
+        if not lead:
+            request.done.wait()
+        if not request.finished:
+            # Woken as the next leader: this request heads the queue
+            self._run_batch()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run_batch(self):
+        with self._queue_lock:
+            batch = self._queue[:self.max_batch]
+            del self._queue[:self.max_batch]
+        try:
+            results = self.predict_many([r.reading for r in batch])
+            for request, result in zip(batch, results):
+                request.result = result
+        except Exception as e:
+            for request in batch:
+                request.error = e
+        for request in batch:
+            request.finished = True
+        # Hand leadership to the oldest waiter rather than keep draining, so
+        # this caller's latency is one batch however busy the server is
+        with self._queue_lock:
+            if self._queue:
+                self._queue[0].done.set()
+            else:
+                self._leading = False
+        for request in batch:
+            request.done.set()
+
+    def predict_many(self, readings):
+        """Score a list of reading dicts in one vectorized pass"""
+        snapshot = self._current()
+        np = self._np
+        values = np.array([[_number(r.get(c)) for c in SENSOR_COLUMNS] for r in readings], dtype=float)
+        hours, weekdays = _time_features(np, readings)
+        self.batches += 1
+        self.scored += len(readings)
+
+        results = [{"model_version": snapshot.version} for _ in readings]
+        if snapshot.failure is not None:
+            probabilities = snapshot.failure.evaluate(snapshot.failure.scaled(values, hours, weekdays))
+            for result, probability in zip(results, probabilities.tolist()):
+                result["failure_probability"] = round(probability, 4)
+                result["ml_risk_level"] = _risk_level(probability)
+        if snapshot.anomaly is not None:
+            model = snapshot.anomaly
+            depths = model.evaluate(model.scaled(values, hours, weekdays))
+            scores = -(2.0 ** (-depths / model.path_norm)) - model.offset
+            for result, score in zip(results, scores.tolist()):
+                result["anomaly_score"] = round(score, 4)
+                result["is_anomaly"] = score < 0
+        return results
+
+    def status(self):
+        snapshot = self._snapshot
+        return {
+            "enabled": self.enabled,
+            "loaded": snapshot is not None,
+            "path": self.path,
+            "version": snapshot.version if snapshot else None,
+            "created": snapshot.created if snapshot else None,
+            "loaded_at": snapshot.loaded if snapshot else None,
+            "batches": self.batches,
+            "scored": self.scored,
+            "mean_batch_size": round(self.scored / self.batches, 2) if self.batches else None,
+            "last_error": self.last_error
+        }
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+def _time_features(np, readings):
+    """Hour and weekday per reading, from its timestamp or the current time"""
+    now = datetime.now()
+    hours = np.empty(len(readings))
+    weekdays = np.empty(len(readings))
+    for i, reading in enumerate(readings):
+        stamp = reading.get("timestamp")
+        when = now
+        if isinstance(stamp, datetime):
+            when = stamp
+        elif isinstance(stamp, str):
+            try:
+                when = datetime.fromisoformat(stamp)
+            except ValueError:
+                pass
+        hours[i] = when.hour
+        weekdays[i] = when.weekday()
+    return hours, weekdays
+
+
+def _risk_level(probability):
+    if probability > 0.8:
+        return "Critical"
+    elif probability > 0.6:
+        return "High"
+    elif probability > 0.4:
+        return "Medium"
+    return "Low"
@@ -0,0 +1,216 @@
+"""
+SmartX on-demand request profiler
+Wraps Flask views in cProfile or a stack sampler and keeps the last N profiles
+"""
+import cProfile
+import functools
+import io
+import itertools
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+
+from flask import request, jsonify, Response, abort
+from flask_login import current_user
+
+PROFILE_HEADER = "X-SmartX-Profile"
+PROFILE_ARG = "_profile"
+MODES = ("cprofile", "sample")
+
+
+class _StackSampler:
+    """Samples the stack of one thread at a fixed interval"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+
+class RequestProfiler:
+    """Opt-in per-request profiler with an admin viewer"""
+
+    def __init__(self, app=None, keep=20, sample_rate=0.0, interval=0.001):
+        self.keep = keep
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.profiles = deque(maxlen=keep)
+        self._ids = itertools.count(1)
+        # cProfile only supports one active profiler at a time
+        self._cprofile_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Wrap every registered view and add the admin endpoints
+
+        Must run after all routes are registered. When profiling is disabled
+        in the config nothing is wrapped, so there is no per-request cost.
+        """
+        if not app.config.get("PROFILER_ENABLED", False):
+            return
+        self.keep = app.config.get("PROFILER_KEEP", self.keep)
+        self.sample_rate = app.config.get("PROFILER_SAMPLE_RATE", self.sample_rate)
+        self.interval = app.config.get("PROFILER_INTERVAL", self.interval)
+        self.profiles = deque(self.profiles, maxlen=self.keep)
+
+        for endpoint, view in list(app.view_functions.items()):
+            if endpoint != 'static':
+                app.view_functions[endpoint] = self._wrap(view)
+
+        app.add_url_rule("/admin/profiles", "list_profiles", self._admin(self.list_profiles))
+        app.add_url_rule("/admin/profiles/<int:profile_id>", "show_profile", self._admin(self.show_profile))
+        app.extensions['smartx_profiler'] = self
+
+    def _requested_mode(self):
+        mode = request.headers.get(PROFILE_HEADER) or request.args.get(PROFILE_ARG)
+        if mode:
+            if not (current_user.is_authenticated and current_user.role == 'admin'):
+                return None
+            return mode if mode in MODES else "cprofile"
+        if self.sample_rate and random.random() < self.sample_rate:
+            return "sample"
+        return None
+
+    def _wrap(self, view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            mode = self._requested_mode()
+            if mode is None:
+                return view(*args, **kwargs)
+            if mode == "cprofile":
+                return self._run_cprofile(view, args, kwargs)
+            return self._run_sampler(view, args, kwargs)
+        return wrapper
+
+    def _run_cprofile(self, view, args, kwargs):
+        if not self._cprofile_lock.acquire(blocking=False):
+            # Another request is being profiled; fall back to the sampler
+            return self._run_sampler(view, args, kwargs)
+        try:
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                return profile.runcall(view, *args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                self._record("cprofile", duration, profile=profile)
+        finally:
+            self._cprofile_lock.release()
+
+    def _run_sampler(self, view, args, kwargs):
+        sampler = _StackSampler(threading.get_ident(), self.interval)
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            sampler.stop()
+            self._record("sample", time.perf_counter() - start, stacks=sampler.stacks)
+
+    def _record(self, mode, duration, profile=None, stacks=None):
+        self.profiles.append({
+            'id': next(self._ids),
+            'mode': mode,
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'user': current_user.get_id() if current_user.is_authenticated else None,
+            'timestamp': datetime.now().isoformat(),
+            'duration_ms': round(duration * 1000, 3),
+            'profile': profile,
+            'stacks': stacks
+        })
+
+    def _admin(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not (current_user.is_authenticated and current_user.role == 'admin'):
+                abort(403)
+            return func(*args, **kwargs)
+        return wrapper
+
+    def _find(self, profile_id):
+        for entry in self.profiles:
+            if entry['id'] == profile_id:
+                return entry
+        abort(404)
+
+    def list_profiles(self):
+        """List stored profiles, newest first"""
+        summary = [{k: v for k, v in entry.items() if k not in ('profile', 'stacks')}
+                   for entry in reversed(self.profiles)]
+        return jsonify({"profiles": summary, "keep": self.keep, "sample_rate": self.sample_rate})
+
+    def show_profile(self, profile_id):
+        """Render one profile as sorted stats or collapsed stacks"""
+        entry = self._find(profile_id)
+        output_format = request.args.get('format', 'stats')
+        if output_format == 'collapsed':
+            return Response(collapsed_stacks(entry), mimetype='text/plain')
+        sort_key = request.args.get('sort', 'cumulative')
+        limit = request.args.get('limit', 50, type=int)
+        return Response(sorted_stats(entry, sort_key, limit), mimetype='text/plain')
+
+
+def sorted_stats(entry, sort_key='cumulative', limit=50):
+    """Format a profile as pstats text (or top stacks for sampled profiles)"""
+    header = f"{entry['method']} {entry['path']} - {entry['duration_ms']} ms ({entry['mode']})\n\n"
+    if entry['profile'] is not None:
+        stream = io.StringIO()
+        stats = pstats.Stats(entry['profile'], stream=stream)
+        try:
+            stats.sort_stats(sort_key)
+        except KeyError:
+            stats.sort_stats('cumulative')
+        stats.print_stats(limit)
+        return header + stream.getvalue()
+    total = sum(entry['stacks'].values())
+    lines = [f"{count:6d} {100.0 * count / total:5.1f}%  {stack.rsplit(';', 1)[-1]}"
+             for stack, count in entry['stacks'].most_common(limit)]
+    return header + f"{total} samples\n" + '\n'.join(lines) + '\n'
+
+
+def collapsed_stacks(entry):
+    """Format a profile as flamegraph.pl / speedscope collapsed stacks"""
+    if entry['stacks'] is not None:
+        return ''.join(f"{stack} {count}\n" for stack, count in entry['stacks'].items())
+    # cProfile keeps caller/callee pairs rather than full stacks, so emit
+    # two-level stacks weighted by inline time in microseconds
+    stats = pstats.Stats(entry['profile']).stats
+    lines = []
+    for (filename, lineno, name), (_, _, inline, _, callers) in stats.items():
+        callee = f"{name} ({os.path.basename(filename)}:{lineno})"
+        if not callers:
+            lines.append(f"{callee} {int(inline * 1e6)}")
+            continue
+        for (c_file, c_line, c_name), caller_stats in callers.items():
+            weight = int(caller_stats[2] * 1e6)
+            if weight:
+                lines.append(f"{c_name} ({os.path.basename(c_file)}:{c_line});{callee} {weight}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,316 @@
+"""
+SmartX streaming quantile sketches
+Every ingested reading is added to a DDSketch per device, metric and hour.
+Sketches are buffered in memory and flushed with $inc, so buckets written by
+several workers merge exactly in MongoDB. Quantiles for any window and any
+group of devices come from merging the hourly buckets it covers, never from
+raw readings. Estimates are within RELATIVE_ACCURACY of the true value.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SKETCH_COLLECTION = "sensor_sketches"
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+# Values closer to zero than this are counted in the zero bucket
+MIN_MAGNITUDE = 1e-9
+
+SKETCH_FLUSHES = registry.counter(
+    "smartx_sketch_flushes_total", "Quantile sketch flushes to MongoDB", ("result",))
+
+
+def _key(magnitude):
+    return math.ceil(math.log(magnitude) / LOG_GAMMA)
+
+
+def _value(key):
+    return 2 * GAMMA ** key / (GAMMA + 1)
+
+
+class DDSketch:
+    """Mergeable quantile sketch with relative error guarantees"""
+    __slots__ = ("positive", "negative", "zero", "count", "min", "max")
+
+    def __init__(self):
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value, weight=1):
+        if value > MIN_MAGNITUDE:
+            key = _key(value)
+            self.positive[key] = self.positive.get(key, 0) + weight
+        elif value < -MIN_MAGNITUDE:
+            key = _key(-value)
+            self.negative[key] = self.negative.get(key, 0) + weight
+        else:
+            self.zero += weight
+        self.count += weight
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for store, incoming in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in incoming.items():
+                store[key] = store.get(key, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        """Estimated value at quantile q (0..1), or None when empty"""
+        if not self.count:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        rank = q * (self.count - 1)
+        seen = 0
+        # Largest magnitudes of the negative store are the smallest values
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return max(-_value(key), self.min)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return min(_value(key), self.max)
+        return self.max
+
+    def to_update(self, prefix):
+        """$inc/$min/$max fields that add this sketch to a stored one at prefix"""
+        inc = {f"{prefix}.count": self.count}
+        inc.update((f"{prefix}.p.{key}", count) for key, count in self.positive.items())
+        inc.update((f"{prefix}.n.{key}", count) for key, count in self.negative.items())
+        if self.zero:
+            inc[f"{prefix}.z"] = self.zero
+        return inc, {f"{prefix}.min": self.min}, {f"{prefix}.max": self.max}
+
+    @classmethod
+    def from_document(cls, doc):
+        sketch = cls()
+        sketch.positive = {int(key): count for key, count in doc.get("p", {}).items()}
+        sketch.negative = {int(key): count for key, count in doc.get("n", {}).items()}
+        sketch.zero = doc.get("z", 0)
+        sketch.count = doc.get("count", 0)
+        sketch.min = doc.get("min", math.inf)
+        sketch.max = doc.get("max", -math.inf)
+        return sketch
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+class SketchStore:
+    """Hourly per-device sketches: buffered at ingest, merged at query time"""
+
+    def __init__(self, mongo, app=None):
+        self.mongo = mongo
+        self.enabled = True
+        self.flush_interval = 10.0
+        # Live sketches saw every reading; rebuild_sketches leaves their hours alone
+        self.live = True
+        self.last_flush = None
+        self.last_error = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._indexed = False
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SKETCH_ENABLED", True)
+        app.config.setdefault("SKETCH_FLUSH_INTERVAL", 10.0)
+        self.enabled = bool(app.config["SKETCH_ENABLED"])
+        self.flush_interval = float(app.config["SKETCH_FLUSH_INTERVAL"])
+        app.extensions['smartx_sketches'] = self
+
+    def add(self, device_id, timestamp, data):
+        """Add every numeric metric of one reading to its hourly sketch"""
+        if not self.enabled or not isinstance(data, dict):
+            return
+        hour = timestamp.replace(minute=0, second=0, microsecond=0)
+        with self._lock:
+            sketches = self._pending.get((device_id, hour))
+            if sketches is None:
+                sketches = self._pending[(device_id, hour)] = {}
+            for metric, value in data.items():
+                if not _is_number(value) or "." in metric or metric.startswith("$"):
+                    continue
+                sketch = sketches.get(metric)
+                if sketch is None:
+                    sketch = sketches[metric] = DDSketch()
+                sketch.add(value)
+
+    def start(self):
+        """Flush buffered sketches from a background thread (once per process)"""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pending = {}
+        threading.Thread(target=self._run, name="sketch-flush", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self.mongo.available:
+                self.flush()
+
+    def ensure_indexes(self, db):
+        db[SKETCH_COLLECTION].create_index([("device_id", 1), ("hour", 1)])
+        db[SKETCH_COLLECTION].create_index([("hour", 1)])
+
+    def flush(self):
+        """Write buffered sketches; they are kept for the next flush if MongoDB fails"""
+        from pymongo import UpdateOne
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        operations = []
+        for (device_id, hour), sketches in pending.items():
+            if not sketches:
+                continue
+            inc, low, high = {}, {}, {}
+            for metric, sketch in sketches.items():
+                metric_inc, metric_min, metric_max = sketch.to_update(f"metrics.{metric}")
+                inc.update(metric_inc)
+                low.update(metric_min)
+                high.update(metric_max)
+            operations.append(UpdateOne(
+                {"_id": f"{device_id}@{hour.isoformat()}"},
+                {"$inc": inc, "$min": low, "$max": high, "$set": {"live": self.live},
+                 "$setOnInsert": {"device_id": device_id, "hour": hour}},
+                upsert=True))
+        if not operations:
+            return 0
+        try:
+            db = self.mongo.db
+            if not self._indexed:
+                self.ensure_indexes(db)
+                self._indexed = True
+            db[SKETCH_COLLECTION].bulk_write(operations, ordered=False)
+        except Exception as e:
+            self._restore(pending)
+            self.last_error = str(e)
+            SKETCH_FLUSHES.labels("error").inc()
+            self.mongo.mark_failed(e)
+            return 0
+        self.last_flush = datetime.utcnow()
+        self.last_error = None
+        SKETCH_FLUSHES.labels("ok").inc()
+        return len(operations)
+
+    def _restore(self, pending):
+        # Merge back rather than replace: readings kept arriving during the flush
+        with self._lock:
+            for bucket, sketches in pending.items():
+                current = self._pending.setdefault(bucket, {})
+                for metric, sketch in sketches.items():
+                    if metric in current:
+                        sketch.merge(current[metric])
+                    current[metric] = sketch
+
+    def query(self, metric, since, until, quantiles, devices=None, group_of=None):
+        """Merge the hourly buckets overlapping [since, until] per group
+
+        group_of maps a device_id to its group name; by default each device
+        is its own group. Returns (groups, buckets read).
+        """
+        query = {"hour": {"$gte": since.replace(minute=0, second=0, microsecond=0), "$lte": until},
+                 f"metrics.{metric}": {"$exists": True}}
+        if devices:
+            query["device_id"] = {"$in": list(devices)}
+        merged = {}
+        buckets = 0
+        for doc in self.mongo.db[SKETCH_COLLECTION].find(query, {"device_id": 1, f"metrics.{metric}": 1}):
+            group = group_of(doc["device_id"]) if group_of else doc["device_id"]
+            sketch = DDSketch.from_document(doc["metrics"][metric])
+            if group in merged:
+                merged[group].merge(sketch)
+            else:
+                merged[group] = sketch
+            buckets += 1
+        groups = [{
+            "group": group,
+            "count": sketch.count,
+            "min": sketch.min,
+            "max": sketch.max,
+            "quantiles": {str(q): _round(sketch.quantile(q)) for q in quantiles}
+        } for group, sketch in sorted(merged.items(), key=lambda item: str(item[0]))]
+        return groups, buckets
+
+    def status(self):
+        return {
+            "enabled": self.enabled,
+            "relative_accuracy": RELATIVE_ACCURACY,
+            "pending_buckets": len(self._pending),
+            "last_flush": self.last_flush.isoformat() if self.last_flush else None,
+            "last_error": self.last_error
+        }
+
+
+def _round(value):
+    return None if value is None else round(value, 6)
+
+
+class _DirectStorage:
+    """MongoStorage stand-in for rebuilding sketches straight from a database handle"""
+
+    available = True
+
+    def __init__(self, db):
+        self.db = db
+
+    def mark_failed(self, error):
+        raise error
+
+
+def rebuild_sketches(db, since, until, devices=None, collection="sensor_data", flush_every=50000):
+    """Recompute the hourly sketches covering [since, until] from stored readings
+
+    Used after a backfill; whole device-hours are rebuilt. Hours that live
+    ingest already sketched are left alone: live sketches saw every reading,
+    while sensor_data only keeps the points ingest compression stored.
+    """
+    start = since.replace(minute=0, second=0, microsecond=0)
+    end = until.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    bucket_query = {"hour": {"$gte": start, "$lt": end}}
+    query = {"timestamp": {"$gte": start, "$lt": end}}
+    if devices:
+        bucket_query["device_id"] = query["device_id"] = {"$in": list(devices)}
+    live = {(doc["device_id"], doc["hour"])
+            for doc in db[SKETCH_COLLECTION].find({**bucket_query, "live": True}, {"device_id": 1, "hour": 1})}
+    db[SKETCH_COLLECTION].delete_many({**bucket_query, "live": {"$ne": True}})
+    store = SketchStore(_DirectStorage(db))
+    store.live = False
+    added = 0
+    for doc in db[collection].find(query, {"_id": 0, "device_id": 1, "timestamp": 1, "data": 1}):
+        if live and (doc["device_id"], doc["timestamp"].replace(minute=0, second=0, microsecond=0)) in live:
+            continue
+        store.add(doc["device_id"], doc["timestamp"], doc.get("data"))
+        added += 1
+        if added % flush_every == 0:
+            store.flush()
+    store.flush()
+    return added
@@ -0,0 +1,254 @@
+"""
+SmartX adaptive publish-rate control
+Watches how hard ingest is working and tells MQTT devices how often to
+publish through `smartx/control/<device_id>` set_interval messages.
+
+Load is the worst of three ratios, each 1.0 at its target:
+- how busy the MQTT handler is (a saturated handler means the broker is
+  queueing for us)
+- mean storage write latency
+- readings waiting in the write-ahead spool
+
+The fleet-wide interval scale follows the smoothed load, growing in
+proportion to overload and shrinking slowly once there is headroom. Each
+device's interval is its own observed interval times the scale. Devices in
+alarm are sped up to the alarm interval and only slowed once the scale
+exceeds their speed-up. Messages go out only when a device's target moves
+by more than `deadband`, at most `max_messages` per tick, alarms first.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Readings closer together than this are one batch, not an interval
+MIN_GAP = 0.05
+ALARM_STATUSES = ("Warning", "Critical")
+
+CONTROL_SCALE = registry.gauge(
+    "smartx_rate_control_scale", "Multiplier applied to device publish intervals")
+CONTROL_LOAD = registry.gauge(
+    "smartx_rate_control_load", "Smoothed ingest load, 1.0 at target")
+CONTROL_MESSAGES = registry.counter(
+    "smartx_control_messages_total", "set_interval control messages sent", ("reason",))
+
+
+class _Device:
+    __slots__ = ("natural", "last", "alarm", "sent", "dirty")
+
+    def __init__(self, last):
+        # Interval the device chose itself, learned before it was first told otherwise
+        self.natural = None
+        self.last = last
+        self.alarm = False
+        self.sent = None
+        self.dirty = False
+
+
+class RateController:
+    """Feedback loop from ingest load to per-device publish intervals"""
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.interval = 5.0
+        self.target_utilization = 0.7
+        self.target_latency = 0.05
+        self.backlog_limit = 10000
+        self.alarm_interval = 1.0
+        self.min_interval = 0.5
+        self.max_interval = 300.0
+        self.max_scale = 20.0
+        self.deadband = 0.2
+        self.max_messages = 1000
+        self.scale = 1.0
+        self.load = 0.0
+        self.last_sample = {}
+        self.sent = 0
+        self.last_error = None
+        self._devices = {}
+        self._busy = 0.0
+        self._storage_seconds = 0.0
+        self._storage_count = 0
+        self._window_start = time.monotonic()
+        self._lock = threading.Lock()
+        self._publish = None
+        self._backlog = None
+        self._pid = None
+        CONTROL_SCALE.set_function(lambda: self.scale)
+        CONTROL_LOAD.set_function(lambda: self.load)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("CONTROL_ENABLED", True)
+        app.config.setdefault("CONTROL_INTERVAL", 5.0)
+        app.config.setdefault("CONTROL_TARGET_UTILIZATION", 0.7)
+        app.config.setdefault("CONTROL_TARGET_LATENCY", 0.05)
+        app.config.setdefault("CONTROL_BACKLOG_LIMIT", 10000)
+        app.config.setdefault("CONTROL_ALARM_INTERVAL", 1.0)
+        app.config.setdefault("CONTROL_MIN_INTERVAL", 0.5)
+        app.config.setdefault("CONTROL_MAX_INTERVAL", 300.0)
+        app.config.setdefault("CONTROL_MAX_SCALE", 20.0)
+        app.config.setdefault("CONTROL_MAX_MESSAGES", 1000)
+        self.enabled = bool(app.config["CONTROL_ENABLED"])
+        self.interval = float(app.config["CONTROL_INTERVAL"])
+        self.target_utilization = float(app.config["CONTROL_TARGET_UTILIZATION"])
+        self.target_latency = float(app.config["CONTROL_TARGET_LATENCY"])
+        self.backlog_limit = int(app.config["CONTROL_BACKLOG_LIMIT"])
+        self.alarm_interval = float(app.config["CONTROL_ALARM_INTERVAL"])
+        self.min_interval = float(app.config["CONTROL_MIN_INTERVAL"])
+        self.max_interval = float(app.config["CONTROL_MAX_INTERVAL"])
+        self.max_scale = float(app.config["CONTROL_MAX_SCALE"])
+        self.max_messages = int(app.config["CONTROL_MAX_MESSAGES"])
+        app.extensions['smartx_rate_control'] = self
+
+    def observe(self, device_id, alarm):
+        """Note one MQTT reading; O(1)"""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            device = self._devices.get(device_id)
+            if device is None:
+                device = self._devices[device_id] = _Device(now)
+            else:
+                gap = now - device.last
+                if gap >= MIN_GAP:
+                    device.last = now
+                    if device.sent is None:
+                        device.natural = gap if device.natural is None else 0.8 * device.natural + 0.2 * gap
+            if alarm != device.alarm:
+                device.alarm = alarm
+                device.dirty = True
+
+    def record_busy(self, seconds):
+        """Time the MQTT handler spent on one message"""
+        with self._lock:
+            self._busy += seconds
+
+    def record_storage(self, seconds):
+        """Time one reading took to store"""
+        with self._lock:
+            self._storage_seconds += seconds
+            self._storage_count += 1
+
+    def start(self, publish, backlog=None):
+        """Run the control loop in a background thread (once per process)
+
+        `publish(device_id, message)` sends one control message; `backlog()`
+        returns how many readings are waiting for storage.
+        """
+        if not self.enabled or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._publish, self._backlog = publish, backlog
+        self._devices = {}
+        self._window_start = time.monotonic()
+        threading.Thread(target=self._run, name="rate-control", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.tick()
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error(f"Rate control tick failed: {str(e)}")
+
+    def sample(self):
+        """Load ratios over the window since the last sample"""
+        with self._lock:
+            now = time.monotonic()
+            elapsed = max(now - self._window_start, 1e-6)
+            busy, self._busy = self._busy, 0.0
+            seconds, count = self._storage_seconds, self._storage_count
+            self._storage_seconds, self._storage_count = 0.0, 0
+            self._window_start = now
+        backlog = self._backlog() if self._backlog else 0
+        self.last_sample = {
+            "utilization": round(busy / elapsed, 4),
+            "storage_latency": round(seconds / count, 6) if count else None,
+            "backlog": backlog
+        }
+        return max(busy / elapsed / self.target_utilization,
+                   (seconds / count) / self.target_latency if count else 0.0,
+                   backlog / self.backlog_limit if self.backlog_limit else 0.0)
+
+    def tick(self):
+        """One control step: update the scale, then send the intervals that moved; returns messages sent"""
+        load = self.sample()
+        self.load = round(0.5 * self.load + 0.5 * load, 4)
+        if self.load > 1.0:
+            # Rate goes as 1/scale, so scaling by the overload brings load back to target
+            self.scale = min(self.max_scale, self.scale * min(self.load, 2.0))
+        elif self.load < 0.8:
+            self.scale = max(1.0, self.scale * 0.9)
+        return self.send()
+
+    def target(self, device):
+        """Interval a device should publish at under the current scale, or None if unknown"""
+        if device.natural is None:
+            return None
+        steady = device.natural * self.scale
+        if device.alarm:
+            steady = min(device.natural, self.alarm_interval * self.scale)
+        return min(self.max_interval, max(self.min_interval, steady))
+
+    def send(self):
+        stale_after = 10 * self.max_interval
+        now = time.monotonic()
+        changes = []
+        with self._lock:
+            for device_id, device in list(self._devices.items()):
+                if now - device.last > stale_after:
+                    del self._devices[device_id]
+                    continue
+                target = self.target(device)
+                if target is None:
+                    continue
+                current = device.sent if device.sent is not None else device.natural
+                # Once load is back to normal, commanded devices get their exact interval back
+                settled = self.scale == 1.0 and device.sent is not None and target != device.sent
+                if device.dirty or settled or abs(target - current) > self.deadband * current:
+                    changes.append((not device.alarm, -abs(target - current) / current, device_id, device, target))
+        changes.sort(key=lambda change: change[:2])
+        sent = 0
+        for _, _, device_id, device, target in changes[:self.max_messages]:
+            reason = "alarm" if device.alarm else ("overload" if self.scale > 1.0 else "steady")
+            message = {
+                "action": "set_interval",
+                "interval": round(target, 2),
+                "reason": reason,
+                "timestamp": datetime.now().isoformat(),
+                "source": "rate_controller"
+            }
+            try:
+                self._publish(device_id, message)
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error(f"Failed to send control message to {device_id}: {str(e)}")
+                break
+            device.sent, device.dirty = target, False
+            CONTROL_MESSAGES.labels(reason).inc()
+            sent += 1
+        self.sent += sent
+        return sent
+
+    def status(self):
+        return {
+            "enabled": self.enabled,
+            "running": self._pid == os.getpid(),
+            "scale": round(self.scale, 3),
+            "load": self.load,
+            "last_sample": self.last_sample,
+            "devices": len(self._devices),
+            "commanded": sum(1 for device in list(self._devices.values()) if device.sent is not None),
+            "in_alarm": sum(1 for device in list(self._devices.values()) if device.alarm),
+            "messages_sent": self.sent,
+            "last_error": self.last_error
+        }
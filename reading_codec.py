@@ -0,0 +1,63 @@
+"""
+SmartX compact binary reading format
+A two-byte header (magic, version) followed by fixed-size little-endian
+records, concatenated for batches. The magic byte is never the first byte
+of a JSON (UTF-8) document, so one MQTT topic can carry both.
+"""
+import struct
+
+CONTENT_TYPE = "application/x-smartx-readings"
+
+# 0xA5 is a UTF-8 continuation byte, so no JSON payload can start with it
+MAGIC = 0xA5
+VERSION = 1
+HEADER = bytes((MAGIC, VERSION))
+
+# Index of each status string in the packed status byte
+STATUSES = ("Running", "Maintenance", "Idle", "Warning", "Critical", "Operating")
+_STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+
+# temperature, pressure, vibration, humidity, efficiency, status
+RECORD = struct.Struct("<5fB")
+
+
+def encode_readings(readings):
+    """Pack a list of reading dicts into bytes"""
+    out = bytearray(HEADER)
+    for reading in readings:
+        out += RECORD.pack(
+            reading["temperature"],
+            reading["pressure"],
+            reading["vibration"],
+            reading["humidity"],
+            reading["efficiency"],
+            _STATUS_CODES.get(reading["status"], 0)
+        )
+    return bytes(out)
+
+
+def is_encoded(body):
+    """True if `body` starts with the packed-readings magic byte"""
+    return body[:1] == HEADER[:1]
+
+
+def decode_readings(body):
+    """Unpack bytes produced by encode_readings into reading dicts"""
+    if not is_encoded(body):
+        raise ValueError("Binary payload is missing the packed-readings header")
+    if body[1:2] != HEADER[1:]:
+        raise ValueError(f"Unsupported packed-readings version {body[1:2].hex() or 'none'}")
+    body = memoryview(body)[len(HEADER):]
+    if len(body) % RECORD.size:
+        raise ValueError(f"Binary payload length {len(body)} is not a multiple of {RECORD.size}")
+    readings = []
+    for temperature, pressure, vibration, humidity, efficiency, status in RECORD.iter_unpack(body):
+        readings.append({
+            "temperature": round(temperature, 2),
+            "pressure": round(pressure, 3),
+            "vibration": round(vibration, 3),
+            "humidity": round(humidity, 2),
+            "efficiency": round(efficiency, 2),
+            "status": STATUSES[status] if status < len(STATUSES) else "Running"
+        })
+    return readings
@@ -0,0 +1,474 @@
+"""
+SmartX retention tiers and background compaction
+
+Raw readings are kept for RETENTION_RAW_DAYS, 1-minute rollups for
+RETENTION_MINUTE_DAYS and hourly rollups indefinitely. A compactor thread
+keeps both rollup tiers up to date and, once raw readings age out, archives
+them as compressed per-device, per-day blocks before deleting them. Only the
+compactor removes raw readings: a TTL on reading time would also expire
+freshly imported history before it could be archived.
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+MINUTE_COLLECTION = "sensor_rollups_minute"
+HOURLY_COLLECTION = "sensor_rollups_hourly"
+ARCHIVE_COLLECTION = "sensor_archive"
+STATE_COLLECTION = "retention_state"
+ROLLUP_COLLECTIONS = {"minute": MINUTE_COLLECTION, "hour": HOURLY_COLLECTION}
+# Numeric data fields summarized by the rollups
+ROLLUP_FIELDS = ("temperature", "pressure", "vibration", "humidity", "efficiency", "rpm", "power")
+BLOCK_CODEC = "json-zlib-1"
+# Columnar per-hour chunks (archive_codec.py, needs numpy)
+GORILLA_CODEC = "gorilla-1"
+CODECS = (BLOCK_CODEC, GORILLA_CODEC)
+
+ARCHIVED_READINGS = registry.counter(
+    "smartx_archived_readings_total", "Raw readings moved into compressed archive blocks")
+COMPACTION_SECONDS = registry.histogram(
+    "smartx_compaction_seconds", "Duration of one retention/compaction pass",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0))
+
+
+def rollup_pipeline(unit, match):
+    """Aggregation that (re)computes `unit` rollups for matching stored readings
+
+    With ingest compression on, sensor_data holds corridor breaks and
+    heartbeats rather than every reading, so `stored_points` counts stored
+    points (not readings) and the averages are means of those points.
+    """
+    group = {"_id": {"device_id": "$device_id", unit: {"$dateTrunc": {"date": "$timestamp", "unit": unit}}},
+             "stored_points": {"$sum": 1}}
+    for field in ROLLUP_FIELDS:
+        group[f"{field}_avg"] = {"$avg": f"$data.{field}"}
+        group[f"{field}_min"] = {"$min": f"$data.{field}"}
+        group[f"{field}_max"] = {"$max": f"$data.{field}"}
+    return [
+        {"$match": match},
+        {"$group": group},
+        {"$addFields": {"device_id": "$_id.device_id", unit: f"$_id.{unit}"}},
+        {"$merge": {"into": ROLLUP_COLLECTIONS[unit], "on": "_id",
+                    "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ]
+
+
+def rebuild_rollups(db, since, until, devices=None, units=("minute", "hour"), collection="sensor_data"):
+    """Recompute rollups for every bucket touched by [since, until]"""
+    if since is None:
+        return
+    since = since.replace(minute=0, second=0, microsecond=0)
+    match = {"timestamp": {"$gte": since, "$lte": until}}
+    if devices:
+        match["device_id"] = {"$in": sorted(devices)}
+    for unit in units:
+        db[collection].aggregate(rollup_pipeline(unit, match), allowDiskUse=True)
+
+
+def default_codec():
+    """gorilla-1 when numpy is installed, json-zlib-1 otherwise"""
+    # Checked without importing, so startup doesn't pay for numpy
+    return GORILLA_CODEC if importlib.util.find_spec("numpy") else BLOCK_CODEC
+
+
+def encode_block(docs):
+    """Compress one device-day of readings (sorted by time) into an archive payload"""
+    day = docs[0]["timestamp"].replace(hour=0, minute=0, second=0, microsecond=0)
+    names = sorted({name for doc in docs for name in doc["data"]})
+    columns = {
+        "t": [int((doc["timestamp"] - day).total_seconds() * 1000) for doc in docs],
+        "fields": {name: [doc["data"].get(name) for doc in docs] for name in names}
+    }
+    return zlib.compress(json.dumps(columns, separators=(",", ":")).encode(), 6)
+
+
+def block_fields(docs, day, codec):
+    """Payload fields of an archive block document for the given codec"""
+    if codec == GORILLA_CODEC:
+        import archive_codec
+        return {"codec": codec, "chunks": archive_codec.encode_day(docs, day)}
+    return {"codec": BLOCK_CODEC, "payload": encode_block(docs)}
+
+
+def decode_block(block, since=None, until=None):
+    """Readings (sensor_data shape, no _id) from an archive block document
+
+    gorilla-1 blocks only decode the hourly chunks overlapping [since, until].
+    """
+    if block.get("codec") == GORILLA_CODEC:
+        import archive_codec
+        return archive_codec.decode_readings(block["chunks"], block["day"], block["device_id"], since, until)
+    if block.get("codec") != BLOCK_CODEC:
+        raise ValueError(f"Unsupported archive codec {block.get('codec')!r}")
+    columns = json.loads(zlib.decompress(block["payload"]))
+    day = block["day"]
+    fields = columns["fields"]
+    readings = []
+    for i, offset in enumerate(columns["t"]):
+        data = {name: values[i] for name, values in fields.items() if values[i] is not None}
+        readings.append({"device_id": block["device_id"],
+                         "timestamp": day + timedelta(milliseconds=offset),
+                         "data": data})
+    return readings
+
+
+def raw_cutoff(raw_days, now=None):
+    """Start of the oldest day kept in sensor_data, or None when raw readings are kept forever"""
+    if not raw_days:
+        return None
+    now = now or datetime.utcnow()
+    return (now - timedelta(days=raw_days)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def aged_days(db, cutoff, devices=None, since=None, limit=None, collection="sensor_data"):
+    """(device_id, day) pairs with raw readings before `cutoff`, oldest day first"""
+    match = {"timestamp": {"$lt": cutoff}}
+    if since is not None:
+        match["timestamp"]["$gte"] = since.replace(hour=0, minute=0, second=0, microsecond=0)
+    if devices:
+        match["device_id"] = {"$in": sorted(devices)}
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": {"device_id": "$device_id",
+                            "day": {"$dateTrunc": {"date": "$timestamp", "unit": "day"}}}}},
+        {"$sort": {"_id.day": 1}}
+    ]
+    if limit:
+        pipeline.append({"$limit": limit})
+    for entry in db[collection].aggregate(pipeline, allowDiskUse=True):
+        yield entry["_id"]["device_id"], entry["_id"]["day"]
+
+
+def archive_day(db, device_id, day, collection="sensor_data", codec=BLOCK_CODEC, rollups=True):
+    """Archive and delete one device's raw readings for one day; returns the count moved
+
+    The block is written before anything is deleted, and an existing block
+    for the day (late readings) is merged, so a crash at any point at worst
+    leaves readings in both places until the next pass. `rollups=False` is
+    for callers that have already rolled the day up.
+    """
+    end = day + timedelta(days=1)
+    query = {"device_id": device_id, "timestamp": {"$gte": day, "$lt": end}}
+    docs = list(db[collection].find(query, {"_id": 1, "timestamp": 1, "data": 1}, sort=[("timestamp", 1)]))
+    if not docs:
+        return 0
+    block_id = f"{device_id}@{day.date().isoformat()}"
+    existing = db[ARCHIVE_COLLECTION].find_one({"_id": block_id})
+    readings = docs
+    if existing is None:
+        # Rollups must cover the day before its raw readings disappear. Late
+        # readings for an archived day are not rolled up: the raw data the
+        # rollups were built from is gone, and a rebuild would undercount.
+        if rollups:
+            rebuild_rollups(db, day, end, [device_id], collection=collection)
+    else:
+        merged = {reading["timestamp"]: reading for reading in decode_block(existing)}
+        merged.update((doc["timestamp"], doc) for doc in docs)
+        readings = [merged[stamp] for stamp in sorted(merged)]
+    db[ARCHIVE_COLLECTION].replace_one({"_id": block_id}, {
+        "_id": block_id,
+        "device_id": device_id,
+        "day": day,
+        "count": len(readings),
+        "first": readings[0]["timestamp"],
+        "last": readings[-1]["timestamp"],
+        **block_fields(readings, day, codec)
+    }, upsert=True)
+    db[collection].delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+    return len(docs)
+
+
+def read_archive(db, since, until, devices=None):
+    """Archived readings in [since, until], oldest first"""
+    query = {"day": {"$gte": since.replace(hour=0, minute=0, second=0, microsecond=0), "$lte": until}}
+    if devices:
+        query["device_id"] = {"$in": list(devices)}
+    readings = []
+    for block in db[ARCHIVE_COLLECTION].find(query):
+        readings.extend(r for r in decode_block(block, since, until) if since <= r["timestamp"] <= until)
+    readings.sort(key=lambda r: r["timestamp"])
+    return readings
+
+
+def read_archive_columns(db, device_id, since, until):
+    """One device's archived readings in [since, until] as numpy columns
+
+    Returns {"timestamp": datetime64[ms] array, field: values array}, with
+    NaN (numbers) or None (text) where a reading lacks a field.
+    """
+    import numpy as np
+    import archive_codec
+    query = {"device_id": device_id,
+             "day": {"$gte": since.replace(hour=0, minute=0, second=0, microsecond=0), "$lte": until}}
+    parts = []
+    for block in db[ARCHIVE_COLLECTION].find(query, sort=[("day", 1)]):
+        if block.get("codec") == GORILLA_CODEC:
+            parts.append(archive_codec.decode_columns(block["chunks"], block["day"], since, until))
+            continue
+        readings = [r for r in decode_block(block) if since <= r["timestamp"] <= until]
+        names = sorted({name for r in readings for name in r["data"]})
+        part = {"timestamp": np.array([r["timestamp"] for r in readings], dtype="datetime64[ms]")}
+        for name in names:
+            values = [r["data"].get(name) for r in readings]
+            numeric = all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values if v is not None)
+            part[name] = (np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+                          if numeric else np.array(values, dtype=object))
+        parts.append(part)
+    names = sorted({name for part in parts for name in part if name != "timestamp"})
+    columns = {"timestamp": np.concatenate([p["timestamp"] for p in parts] or [np.zeros(0, "datetime64[ms]")])}
+    for name in names:
+        columns[name] = np.concatenate([p[name] if name in p else np.full(len(p["timestamp"]), None, dtype=object)
+                                        for p in parts])
+    return columns
+
+
+def recode_blocks(db, codec, limit=1000):
+    """Re-encode up to `limit` archive blocks stored with another codec; returns the count"""
+    recoded = 0
+    for block in db[ARCHIVE_COLLECTION].find({"codec": {"$ne": codec}}).limit(limit):
+        readings = decode_block(block)
+        update = block_fields(readings, block["day"], codec)
+        unset = {"chunks": ""} if codec == BLOCK_CODEC else {"payload": ""}
+        db[ARCHIVE_COLLECTION].update_one({"_id": block["_id"], "codec": block["codec"]},
+                                          {"$set": update, "$unset": unset})
+        recoded += 1
+    return recoded
+
+
+class RetentionManager:
+    """Background rollup maintenance, archiving and TTL indexes for one app
+
+    Every process may start the manager, but a lease document in
+    retention_state lets only one of them compact at a time.
+    """
+
+    def __init__(self, mongo, app=None):
+        self.mongo = mongo
+        self.configure(enabled=False)
+        self.last_run = None
+        self.last_result = None
+        self.last_error = None
+        self._indexed = False
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._wake = threading.Event()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("RETENTION_ENABLED", True)
+        app.config.setdefault("RETENTION_RAW_DAYS", 30)
+        app.config.setdefault("RETENTION_MINUTE_DAYS", 180)
+        app.config.setdefault("RETENTION_INTERVAL", 300.0)
+        app.config.setdefault("RETENTION_LATENESS", 120.0)
+        app.config.setdefault("RETENTION_MAX_BLOCKS", 500)
+        app.config.setdefault("RETENTION_ARCHIVE_CODEC", "")
+        self.configure(
+            enabled=app.config["RETENTION_ENABLED"],
+            raw_days=app.config["RETENTION_RAW_DAYS"],
+            minute_days=app.config["RETENTION_MINUTE_DAYS"],
+            interval=app.config["RETENTION_INTERVAL"],
+            lateness=app.config["RETENTION_LATENESS"],
+            max_blocks=app.config["RETENTION_MAX_BLOCKS"],
+            codec=app.config["RETENTION_ARCHIVE_CODEC"]
+        )
+        app.extensions['smartx_retention'] = self
+
+    def configure(self, enabled=True, raw_days=30, minute_days=180, interval=300.0,
+                  lateness=120.0, max_blocks=500, codec=None):
+        """Set the tiers; 0 days keeps a tier forever"""
+        codec = codec or default_codec()
+        if codec not in CODECS:
+            raise ValueError(f"Unknown archive codec {codec!r}, expected one of {', '.join(CODECS)}")
+        self.codec = codec
+        self.enabled = bool(enabled)
+        self.raw_days = float(raw_days)
+        self.minute_days = float(minute_days)
+        self.interval = float(interval)
+        self.lateness = float(lateness)
+        self.max_blocks = int(max_blocks)
+
+    @property
+    def raw_cutoff(self):
+        """Readings older than this live in the archive rather than sensor_data"""
+        return raw_cutoff(self.raw_days)
+
+    def start(self):
+        """Start the compactor once per process (safe to call often)"""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._indexed = False
+            self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if not self.mongo.available:
+                continue
+            try:
+                self.run_once()
+            except Exception as e:
+                self.last_error = str(e)
+                self._indexed = False
+                logger.error(f"Retention pass failed: {e}")
+
+    def ensure_indexes(self, db):
+        """Create the query and TTL indexes, adjusting TTLs if the config changed"""
+        db.sensor_data.create_index([("device_id", 1), ("timestamp", 1)])
+        # No TTL on raw readings (and any older one is removed): the compactor archives them first
+        self._ensure_ttl(db, "sensor_data", "timestamp", None)
+        minute_ttl = int(self.minute_days * 86400) if self.minute_days else None
+        self._ensure_ttl(db, MINUTE_COLLECTION, "minute", minute_ttl)
+        db[HOURLY_COLLECTION].create_index([("device_id", 1), ("hour", 1)])
+        db[ARCHIVE_COLLECTION].create_index([("device_id", 1), ("day", 1)])
+        db[ARCHIVE_COLLECTION].create_index([("day", 1)])
+
+    @staticmethod
+    def _ensure_ttl(db, collection, field, seconds):
+        name = f"{field}_1"
+        current = db[collection].index_information().get(name)
+        if current is None:
+            options = {"expireAfterSeconds": seconds} if seconds else {}
+            db[collection].create_index([(field, 1)], **options)
+        elif seconds and current.get("expireAfterSeconds") != seconds:
+            db.command("collMod", collection, index={"keyPattern": {field: 1}, "expireAfterSeconds": seconds})
+        elif not seconds and "expireAfterSeconds" in current:
+            # Retention switched off: keep the index, stop expiring
+            db[collection].drop_index(name)
+            db[collection].create_index([(field, 1)])
+
+    def _acquire_lease(self, db):
+        now = datetime.utcnow()
+        lease = db[STATE_COLLECTION].find_one_and_update(
+            {"_id": "compactor", "$or": [{"expires": {"$lt": now}}, {"owner": self.owner}]},
+            {"$set": {"owner": self.owner, "expires": now + timedelta(seconds=max(self.interval * 2, 600))}})
+        if lease is not None:
+            return True
+        try:
+            db[STATE_COLLECTION].insert_one({"_id": "compactor", "owner": self.owner,
+                                             "expires": now + timedelta(seconds=max(self.interval * 2, 600))})
+            return True
+        except Exception:
+            # Another process holds the lease
+            return False
+
+    def run_once(self):
+        """One pass: indexes, incremental rollups, then archiving; returns a summary"""
+        db = self.mongo.db
+        if not self._indexed:
+            self.ensure_indexes(db)
+            self._indexed = True
+        if not self._acquire_lease(db):
+            return None
+        started = time.perf_counter()
+        with COMPACTION_SECONDS.time():
+            rolled_until = self.update_rollups(db)
+            archived, blocks = self.compact(db)
+        self.last_run = datetime.utcnow()
+        self.last_error = None
+        self.last_result = {
+            "rolled_up_until": rolled_until.isoformat() if rolled_until else None,
+            "archived_readings": archived,
+            "archived_blocks": blocks,
+            "seconds": round(time.perf_counter() - started, 3)
+        }
+        if archived:
+            logger.info(f"Archived {archived} readings into {blocks} blocks")
+        return self.last_result
+
+    def update_rollups(self, db):
+        """Roll up readings since the last watermark, leaving room for late arrivals"""
+        state = db[STATE_COLLECTION].find_one({"_id": "rollups"}) or {}
+        until = datetime.utcnow() - timedelta(seconds=self.lateness)
+        since = state.get("until")
+        if since is None:
+            first = db.sensor_data.find_one({}, {"timestamp": 1}, sort=[("timestamp", 1)])
+            if first is None:
+                return None
+            since = first["timestamp"]
+        # Re-cover the lateness window so readings that arrived late are counted
+        since = since - timedelta(seconds=self.lateness)
+        rebuild_rollups(db, since, until)
+        db[STATE_COLLECTION].update_one({"_id": "rollups"}, {"$set": {"until": until}}, upsert=True)
+        return until
+
+    def compact(self, db):
+        """Archive device-days older than the raw retention; returns (readings, blocks)"""
+        cutoff = self.raw_cutoff
+        if cutoff is None:
+            return 0, 0
+        archived = blocks = 0
+        for device_id, day in aged_days(db, cutoff, limit=self.max_blocks):
+            moved = archive_day(db, device_id, day, codec=self.codec)
+            archived += moved
+            blocks += 1
+            ARCHIVED_READINGS.inc(moved)
+        return archived, blocks
+
+    def status(self):
+        return {
+            "enabled": self.enabled,
+            "raw_days": self.raw_days,
+            "minute_rollup_days": self.minute_days,
+            "hourly_rollups": "indefinite",
+            "archive_codec": self.codec,
+            "raw_cutoff": self.raw_cutoff.isoformat() if self.raw_cutoff else None,
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+            "last_result": self.last_result,
+            "last_error": self.last_error
+        }
+
+
+class _CliStorage:
+    """Minimal stand-in for MongoStorage when running a pass from the command line"""
+
+    available = True
+
+    def __init__(self, uri):
+        from pymongo import MongoClient
+        self.db = MongoClient(uri).get_default_database()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run one SmartX retention/compaction pass")
+    parser.add_argument("--uri", default=os.environ.get("MONGO_URI", "mongodb://localhost:27017/smartx_iot"))
+    parser.add_argument("--raw-days", type=float, default=float(os.environ.get("RETENTION_RAW_DAYS", "30")))
+    parser.add_argument("--minute-days", type=float, default=float(os.environ.get("RETENTION_MINUTE_DAYS", "180")))
+    parser.add_argument("--max-blocks", type=int, default=100000, help="device-days archived in this pass")
+    parser.add_argument("--codec", choices=CODECS, default=os.environ.get("RETENTION_ARCHIVE_CODEC") or None,
+                        help="archive block codec (default: gorilla-1 when numpy is installed)")
+    parser.add_argument("--recode", type=int, default=0, metavar="N",
+                        help="instead of a pass, re-encode up to N blocks stored with another codec")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    manager = RetentionManager(_CliStorage(args.uri))
+    manager.configure(raw_days=args.raw_days, minute_days=args.minute_days,
+                      max_blocks=args.max_blocks, codec=args.codec)
+    if args.recode:
+        print(json.dumps({"recoded": recode_blocks(manager.mongo.db, manager.codec, args.recode),
+                          "codec": manager.codec}, indent=2))
+        return
+    print(json.dumps(manager.run_once() or {"skipped": "another process holds the compactor lease"}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
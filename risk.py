@@ -0,0 +1,123 @@
+"""
+SmartX rule-based risk scoring
+The threshold rules behind /api/predict, kept in one place so the fleet
+aggregates score every reading the same way. Per-reading alerts use the
+alert engine's rules.
+"""
+import math
+
+from alerts import DEFAULT_RULES, Rule
+
+# Values assumed for metrics a reading doesn't carry
+DEFAULTS = {"temperature": 75, "pressure": 1.5, "vibration": 0.5, "humidity": 50}
+
+# Lowest score of each band: level, overall recommendation, predicted time to failure
+BANDS = (
+    (60, "Critical Risk", "Stop operation immediately - maintenance required", "< 4 hours"),
+    (40, "High Risk", "Schedule immediate maintenance", "12-24 hours"),
+    (20, "Medium Risk", "Schedule maintenance within 48 hours", "2-7 days"),
+    (0, "Low Risk", "Normal operation - continue monitoring", "> 30 days")
+)
+
+# Raise thresholds only: a single reading has no history to debounce or clear
+ALERT_RULES = tuple(Rule(spec, 0, 0) for spec in DEFAULT_RULES)
+
+
+def _band(score):
+    for floor, level, recommendation, failure_time in BANDS:
+        if score >= floor:
+            return level, recommendation, failure_time
+    return BANDS[-1][1:]
+
+
+def risk_level(score):
+    return _band(score)[0]
+
+
+def assess(temperature, pressure, vibration, humidity):
+    """Risk score (0-120), level, contributing factors and recommendations"""
+    risk_score = 0
+    risk_factors = []
+    maintenance_recommendations = []
+
+    # Temperature analysis
+    if temperature > 90:
+        risk_score += 40
+        risk_factors.append("Critical temperature levels")
+        maintenance_recommendations.append("Immediate cooling system inspection required")
+    elif temperature > 85:
+        risk_score += 25
+        risk_factors.append("High temperature detected")
+        maintenance_recommendations.append("Check cooling system within 24 hours")
+    elif temperature > 75:
+        risk_score += 10
+        risk_factors.append("Elevated temperature")
+
+    # Pressure analysis
+    if pressure > 2.2:
+        risk_score += 35
+        risk_factors.append("Critical pressure levels")
+        maintenance_recommendations.append("Pressure relief system check required")
+    elif pressure > 2.0:
+        risk_score += 20
+        risk_factors.append("High pressure levels")
+        maintenance_recommendations.append("Monitor pressure trends closely")
+    elif pressure > 1.8:
+        risk_score += 10
+        risk_factors.append("Moderate pressure increase")
+
+    # Vibration analysis
+    if vibration > 0.9:
+        risk_score += 30
+        risk_factors.append("Severe vibration detected")
+        maintenance_recommendations.append("Bearing and alignment inspection needed")
+    elif vibration > 0.7:
+        risk_score += 20
+        risk_factors.append("High vibration levels")
+        maintenance_recommendations.append("Schedule vibration analysis")
+    elif vibration > 0.5:
+        risk_score += 10
+        risk_factors.append("Elevated vibration")
+
+    # Humidity analysis
+    if humidity > 70 or humidity < 30:
+        risk_score += 15
+        risk_factors.append("Humidity outside optimal range")
+        maintenance_recommendations.append("Check environmental controls")
+
+    risk_level, overall_recommendation, predicted_failure_time = _band(risk_score)
+
+    return {
+        "risk_score": risk_score,
+        "risk_level": risk_level,
+        "risk_factors": risk_factors,
+        "maintenance_recommendations": maintenance_recommendations,
+        "overall_recommendation": overall_recommendation,
+        "predicted_failure_time": predicted_failure_time
+    }
+
+
+def _number(data, name):
+    value = data.get(name)
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+        return value
+    return None
+
+
+def risk_score(data):
+    """Risk score of one reading's payload; missing metrics take their defaults"""
+    values = {}
+    for name, default in DEFAULTS.items():
+        value = _number(data, name)
+        values[name] = default if value is None else value
+    return assess(**values)["risk_score"]
+
+
+def reading_alerts(data):
+    """Messages of the alert rules one reading breaches; metrics it doesn't carry raise nothing"""
+    alerts = []
+    for rule in ALERT_RULES:
+        value = _number(data, rule.metric)
+        if value is not None and rule.breached(value) and rule.message not in alerts:
+            alerts.append(rule.message)
+    return alerts
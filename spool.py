@@ -0,0 +1,391 @@
+"""
+SmartX durable write-ahead spool
+Readings that cannot be written to MongoDB are appended to segmented,
+CRC-checked log files on local disk and replayed into MongoDB in rate-limited
+batches once it recovers. Every spooled reading carries its ObjectId, so a
+batch replayed twice (after a crash or a timed-out insert) is deduplicated by
+the server instead of stored twice.
+"""
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from metrics import registry
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX hosts run a single slot without locking
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Each record: payload length, CRC32 of the payload, then the payload
+RECORD_HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX = ".seg"
+CHECKPOINT = "checkpoint.json"
+# Next to the code rather than the working directory, and not in the temp
+# directory, which may be cleared on reboot while readings are still spooled
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool")
+
+SPOOLED_TOTAL = registry.counter(
+    "smartx_spool_appended_total", "Readings written to the local spool while MongoDB was failing")
+REPLAYED_TOTAL = registry.counter(
+    "smartx_spool_replayed_total", "Spooled readings replayed into MongoDB")
+CORRUPT_TOTAL = registry.counter(
+    "smartx_spool_corrupt_records_total", "Spool records dropped because their CRC or length was invalid")
+
+
+def encode_reading(doc):
+    from bson import ObjectId
+    doc.setdefault("_id", ObjectId())
+    return json.dumps({
+        "i": str(doc["_id"]),
+        "d": doc["device_id"],
+        "t": doc["timestamp"].isoformat(),
+        "p": doc["data"]
+    }, separators=(",", ":"), default=str).encode()
+
+
+def decode_reading(payload):
+    from bson import ObjectId
+    record = json.loads(payload)
+    return {
+        "_id": ObjectId(record["i"]),
+        "device_id": record["d"],
+        "timestamp": datetime.fromisoformat(record["t"]),
+        "data": record["p"]
+    }
+
+
+def read_records(path, offset=0, limit=None, max_records=None):
+    """Yield (payload, end_offset) for valid records from offset
+
+    Stops at the first torn or corrupt record: after a crash only the tail of
+    the segment being written can be incomplete.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        position = offset
+        count = 0
+        while (limit is None or position < limit) and (max_records is None or count < max_records):
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, crc = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                CORRUPT_TOTAL.inc()
+                logger.warning(f"Spool segment {path} has a corrupt record at offset {position}")
+                return
+            position += RECORD_HEADER.size + length
+            count += 1
+            yield payload, position
+
+
+def try_lock(path):
+    """Open `path` holding an exclusive lock, or None if a live process holds it
+
+    The lock lasts until the file is closed or the process exits.
+    """
+    lock_file = open(path, "a")
+    if fcntl is None:
+        return lock_file
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return lock_file
+    except OSError:
+        lock_file.close()
+        return None
+
+
+class WriteAheadSpool:
+    """Segmented append-only log with a committed read position
+
+    Appends go to the newest segment and roll over at `segment_bytes`.
+    `read_batch` returns records after the checkpoint and `commit` moves the
+    checkpoint, deleting segments that are fully replayed.
+    """
+
+    def __init__(self, directory, segment_bytes=16 << 20, fsync_interval=1.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._segment = 0
+        self._end = 0
+        self._last_sync = time.monotonic()
+        self._position = (0, 0)
+        self._open()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:012d}{SEGMENT_SUFFIX}")
+
+    def _segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT)) as f:
+                saved = json.load(f)
+            self._position = (saved["segment"], saved["offset"])
+        except (FileNotFoundError, ValueError, KeyError):
+            self._position = (0, 0)
+        segments = self._segments()
+        # Count what is still to be replayed, and drop a torn tail left by a crash
+        for segment in segments:
+            if segment < self._position[0]:
+                continue
+            start = self._position[1] if segment == self._position[0] else 0
+            end = start
+            for _, end in read_records(self._path(segment), start):
+                self.pending += 1
+            if segment == segments[-1] and os.path.getsize(self._path(segment)) > end:
+                with open(self._path(segment), "r+b") as f:
+                    f.truncate(end)
+        self._segment = segments[-1] if segments else max(self._position[0], 1)
+        self._file = open(self._path(self._segment), "ab", buffering=0)
+        self._end = self._file.seek(0, os.SEEK_END)
+        if self._position[0] == 0:
+            self._position = (segments[0] if segments else self._segment, 0)
+
+    def append(self, doc):
+        """Durably queue one sensor_data document (assigns its _id if missing)"""
+        payload = encode_reading(doc)
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if self._end >= self.segment_bytes:
+                self._rotate()
+            # One unbuffered write per record, so a reader never sees half of one
+            self._file.write(record)
+            self._end += len(record)
+            self.pending += 1
+            now = time.monotonic()
+            if self.fsync_interval <= 0 or now - self._last_sync >= self.fsync_interval:
+                os.fsync(self._file.fileno())
+                self._last_sync = now
+        SPOOLED_TOTAL.inc()
+
+    def _rotate(self):
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._segment += 1
+        self._file = open(self._path(self._segment), "ab", buffering=0)
+        self._end = 0
+
+    def sync(self):
+        with self._lock:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+                self._last_sync = time.monotonic()
+
+    def read_batch(self, max_records):
+        """(docs, position) for up to max_records after the checkpoint"""
+        with self._lock:
+            active, active_end = self._segment, self._end
+        segment, offset = self._position
+        docs = []
+        while len(docs) < max_records and segment <= active:
+            path = self._path(segment)
+            if os.path.exists(path):
+                limit = active_end if segment == active else None
+                for payload, offset in read_records(path, offset, limit, max_records - len(docs)):
+                    try:
+                        docs.append(decode_reading(payload))
+                    except (ValueError, KeyError) as e:
+                        CORRUPT_TOTAL.inc()
+                        logger.warning(f"Skipping undecodable spool record: {e}")
+            if len(docs) >= max_records or segment == active:
+                break
+            segment, offset = segment + 1, 0
+        return docs, (segment, offset)
+
+    def commit(self, position, count):
+        """Mark everything before position as replayed"""
+        temporary = os.path.join(self.directory, CHECKPOINT + ".tmp")
+        with open(temporary, "w") as f:
+            json.dump({"segment": position[0], "offset": position[1]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, os.path.join(self.directory, CHECKPOINT))
+        self._position = position
+        with self._lock:
+            self.pending = max(0, self.pending - count)
+        for segment in self._segments():
+            if segment < position[0]:
+                os.remove(self._path(segment))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+
+
+class DurableSpool:
+    """Per-process spool slot plus a rate-limited replayer into MongoDB
+
+    Each process claims its own slot directory under SPOOL_DIR with an
+    exclusive lock, so gunicorn workers never share a segment. The replayer
+    also drains slots left behind by processes that are gone.
+    """
+
+    def __init__(self, mongo, app=None):
+        self.mongo = mongo
+        self.enabled = True
+        self.directory = "spool"
+        self.last_error = None
+        self.replayed = 0
+        self._spool = None
+        self._slot = None
+        self._lock_file = None
+        self._pid = None
+        self._open_lock = threading.Lock()
+        self._wake = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SPOOL_ENABLED", True)
+        app.config.setdefault("SPOOL_DIR", DEFAULT_DIRECTORY)
+        app.config.setdefault("SPOOL_SEGMENT_MB", 16)
+        app.config.setdefault("SPOOL_FSYNC_INTERVAL", 1.0)
+        app.config.setdefault("SPOOL_REPLAY_RATE", 5000)
+        app.config.setdefault("SPOOL_REPLAY_BATCH", 1000)
+        self.enabled = bool(app.config["SPOOL_ENABLED"])
+        self.directory = app.config["SPOOL_DIR"]
+        self.segment_bytes = int(float(app.config["SPOOL_SEGMENT_MB"]) * (1 << 20))
+        self.fsync_interval = float(app.config["SPOOL_FSYNC_INTERVAL"])
+        self.replay_rate = float(app.config["SPOOL_REPLAY_RATE"])
+        self.replay_batch = int(app.config["SPOOL_REPLAY_BATCH"])
+        app.extensions['smartx_spool'] = self
+
+    @property
+    def pending(self):
+        return self._spool.pending if self._spool is not None else 0
+
+    def _claim_slot(self):
+        """Open the first slot directory no other live process holds"""
+        os.makedirs(self.directory, exist_ok=True)
+        slot = 0
+        while True:
+            path = os.path.join(self.directory, f"slot-{slot}")
+            lock_file = self._try_lock(path)
+            if lock_file is not None:
+                return slot, path, lock_file
+            slot += 1
+
+    @staticmethod
+    def _try_lock(path):
+        os.makedirs(path, exist_ok=True)
+        return try_lock(os.path.join(path, "lock"))
+
+    def start(self):
+        """Open this process's slot and start the replayer (safe to call often)"""
+        if not self.enabled or self._pid == os.getpid():
+            return
+        with self._open_lock:
+            if self._pid == os.getpid():
+                return
+            # A forked worker must not inherit the parent's slot or lock
+            self._slot, path, self._lock_file = self._claim_slot()
+            self._spool = WriteAheadSpool(path, self.segment_bytes, self.fsync_interval)
+            self._pid = os.getpid()
+            if self._spool.pending:
+                logger.info(f"Spool slot {self._slot} has {self._spool.pending} readings to replay")
+            threading.Thread(target=self._run, name="spool-replay", daemon=True).start()
+
+    def append(self, doc):
+        """Queue a reading for MongoDB; returns False when the spool is disabled"""
+        if not self.enabled:
+            return False
+        self.start()
+        self._spool.append(doc)
+        return True
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(5.0)
+            self._wake.clear()
+            if not self.mongo.available:
+                continue
+            try:
+                self._spool.sync()
+                self.replay(self._spool)
+                self._drain_orphans()
+            except Exception as e:
+                self.last_error = str(e)
+                self.mongo.mark_failed(e)
+
+    def replay(self, spool):
+        """Drain a spool into MongoDB at no more than replay_rate readings/s"""
+        from pymongo.errors import BulkWriteError
+        while self.mongo.available:
+            started = time.monotonic()
+            docs, position = spool.read_batch(self.replay_batch)
+            if not docs:
+                if position != spool._position:
+                    spool.commit(position, 0)
+                return
+            try:
+                self.mongo.db.sensor_data.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                # Duplicate _ids were already stored by an earlier attempt
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+            spool.commit(position, len(docs))
+            self.replayed += len(docs)
+            REPLAYED_TOTAL.inc(len(docs))
+            if self.replay_rate > 0:
+                delay = len(docs) / self.replay_rate - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+    def _drain_orphans(self):
+        """Replay slots whose owning process has exited"""
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.startswith("slot-") or name == f"slot-{self._slot}" or not os.path.isdir(path):
+                continue
+            lock_file = self._try_lock(path) if fcntl is not None else None
+            if lock_file is None:
+                continue
+            try:
+                orphan = WriteAheadSpool(path, self.segment_bytes, self.fsync_interval)
+                if orphan.pending:
+                    logger.info(f"Replaying {orphan.pending} readings left in spool {name}")
+                    self.replay(orphan)
+                orphan.close()
+            finally:
+                lock_file.close()
+
+    def disk_bytes(self):
+        """Size of all spool segments, including other processes' slots"""
+        total = 0
+        for root, _, names in os.walk(self.directory):
+            total += sum(os.path.getsize(os.path.join(root, name))
+                         for name in names if name.endswith(SEGMENT_SUFFIX))
+        return total
+
+    def status(self):
+        return {
+            "enabled": self.enabled,
+            "slot": self._slot,
+            "pending": self.pending,
+            "disk_bytes": self.disk_bytes() if self.enabled else 0,
+            "replayed": self.replayed,
+            "replay_rate": self.replay_rate if self.enabled else None,
+            "last_error": self.last_error
+        }
@@ -2,6 +2,9 @@
 // Enhanced Blockly Workspace JavaScript
 let workspace;
 let generatedCode = '';
+let serverCodeTimer = null;
+// Aborts the in-flight /api/generate-code request once the workspace changes again
+let serverCodeController = null;
 let workspaceStats = { blocks: 0, lines: 0, complexity: 'Simple' };
 
 // Initialize when page loads
@@ -498,6 +501,48 @@ function onWorkspaceChange(event) {
     generateCodePreview();
     updateWorkspaceStats();
     updateExportButtons();
+    scheduleServerCode();
+}
+
+// Ask the server for the generated program once edits settle. Unchanged
+// graphs are answered from the server's cache, so this is cheap to repeat.
+function scheduleServerCode() {
+    clearTimeout(serverCodeTimer);
+    // A response for an older graph must not overwrite newer code
+    if (serverCodeController) serverCodeController.abort();
+    serverCodeController = null;
+    serverCodeTimer = setTimeout(fetchServerCode, 400);
+}
+
+async function fetchServerCode() {
+    if (!Blockly.serialization || workspace.getAllBlocks().length === 0) return;
+    const controller = new AbortController();
+    serverCodeController = controller;
+    try {
+        const response = await fetch('/api/generate-code', {
+            method: 'POST',
+            signal: controller.signal,
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                type: 'workflow',
+                blocks: Blockly.serialization.workspaces.save(workspace)
+            })
+        });
+        if (!response.ok) return;
+        const result = await response.json();
+        if (controller.signal.aborted) return;
+        if (result.syntax_ok) {
+            generatedCode = result.code;
+        } else {
+            console.warn('Server code failed syntax check:', result.syntax_error);
+        }
+    } catch (error) {
+        if (error.name === 'AbortError') return;
+        // Keep the client-side preview when the server is unreachable
+        console.warn('Server code generation unavailable:', error);
+    } finally {
+        if (serverCodeController === controller) serverCodeController = null;
+    }
 }
 
 // Generate enhanced code preview
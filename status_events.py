@@ -0,0 +1,332 @@
+"""
+SmartX status-transition events, uptime and OEE
+Ingest only notes when a device's `status` changes (or it comes back after
+being silent); a background thread turns those notes into interval events
+in status_events and adds the closed intervals to lifetime counters in
+status_counters. Uptime, availability, MTBF/MTTR and OEE for any window are
+computed from the events overlapping it, never from raw readings.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+EVENTS_COLLECTION = "status_events"
+COUNTERS_COLLECTION = "status_counters"
+OFFLINE = "Offline"
+# Warning and Critical machines are still producing; Idle is unplanned time, not downtime
+STATES = {
+    "Running": "running",
+    "Operating": "running",
+    "Warning": "running",
+    "Critical": "running",
+    "Idle": "idle",
+    "Maintenance": "down",
+    OFFLINE: "offline"
+}
+STATE_NAMES = ("running", "idle", "down", "offline", "unknown")
+
+TRANSITIONS = registry.counter(
+    "smartx_status_transitions_total", "Device status transitions recorded", ("state",))
+
+
+def state_of(status):
+    return STATES.get(status, "unknown")
+
+
+def _event_id(device_id, start):
+    # Microseconds, as MongoDB truncates datetimes to milliseconds and a batch can change twice in one
+    return f"{device_id}@{start.isoformat(timespec='microseconds')}"
+
+
+class _Seen:
+    __slots__ = ("status", "last_seen")
+
+    def __init__(self, status, last_seen):
+        self.status = status
+        self.last_seen = last_seen
+
+
+class StatusTracker:
+    """Detects status transitions at ingest and keeps the event index up to date"""
+
+    def __init__(self, mongo, app=None):
+        self.mongo = mongo
+        self.offline_after = 300.0
+        self.flush_interval = 5.0
+        self.last_error = None
+        self._devices = {}
+        # Devices whose last_seen moved since the last flush
+        self._moved = set()
+        self._queue = []
+        self._lock = threading.Lock()
+        self._indexed = False
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("STATUS_OFFLINE_AFTER", 300.0)
+        app.config.setdefault("STATUS_FLUSH_INTERVAL", 5.0)
+        self.offline_after = float(app.config["STATUS_OFFLINE_AFTER"])
+        self.flush_interval = float(app.config["STATUS_FLUSH_INTERVAL"])
+        app.extensions['smartx_status'] = self
+
+    def observe(self, device_id, timestamp, data):
+        """Note one reading; O(1) and no I/O unless the status changed"""
+        status = data.get("status") if isinstance(data, dict) else None
+        with self._lock:
+            seen = self._devices.get(device_id)
+            self._moved.add(device_id)
+            if seen is None:
+                self._devices[device_id] = _Seen(status, timestamp)
+                if status is not None:
+                    # First sight in this process: the flush compares with the stored state
+                    self._queue.append((device_id, status, timestamp, None))
+                return
+            gap = (timestamp - seen.last_seen).total_seconds() > self.offline_after
+            if status is not None and (status != seen.status or gap):
+                self._queue.append((device_id, status, timestamp, seen.last_seen))
+                seen.status = status
+            seen.last_seen = timestamp
+
+    def start(self):
+        """Write queued transitions from a background thread (once per process)"""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._devices, self._moved, self._queue = {}, set(), []
+        threading.Thread(target=self._run, name="status-events", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self.mongo.available:
+                self.flush()
+
+    def ensure_indexes(self, db):
+        db[EVENTS_COLLECTION].create_index([("device_id", 1), ("start", 1)])
+        db[EVENTS_COLLECTION].create_index([("start", 1)])
+        db[EVENTS_COLLECTION].create_index([("device_id", 1), ("end", 1)])
+
+    def flush(self):
+        """Apply queued transitions in order, then store the last-seen times that moved; returns transitions applied"""
+        from pymongo import UpdateOne
+        with self._lock:
+            queue, self._queue = self._queue, []
+            moved, self._moved = self._moved, set()
+            last_seen = {device_id: self._devices[device_id].last_seen for device_id in moved}
+        applied = position = 0
+        try:
+            db = self.mongo.db
+            if not self._indexed:
+                self.ensure_indexes(db)
+                self._indexed = True
+            for position, (device_id, status, timestamp, previous_seen) in enumerate(queue):
+                applied += self._apply(db, device_id, status, timestamp, previous_seen)
+            if last_seen:
+                db[COUNTERS_COLLECTION].bulk_write(
+                    [UpdateOne({"_id": device_id}, {"$max": {"last_seen": seen}}, upsert=True)
+                     for device_id, seen in last_seen.items()], ordered=False)
+        except Exception as e:
+            with self._lock:
+                self._queue = queue[position:] + self._queue
+                self._moved |= moved
+            self.last_error = str(e)
+            self.mongo.mark_failed(e)
+            return applied
+        self.last_error = None
+        return applied
+
+    def _apply(self, db, device_id, status, timestamp, previous_seen):
+        events, counters = db[EVENTS_COLLECTION], db[COUNTERS_COLLECTION]
+        current = events.find_one({"device_id": device_id, "end": None}, sort=[("start", -1)])
+        if previous_seen is None:
+            stored = counters.find_one({"_id": device_id}, {"last_seen": 1}) or {}
+            previous_seen = stored.get("last_seen")
+        silent = (previous_seen is not None
+                  and (timestamp - previous_seen).total_seconds() > self.offline_after)
+        if current is not None:
+            if current["start"] >= timestamp:
+                return 0
+            if current["status"] == status and not silent:
+                # Another worker (or an earlier run of this one) already recorded it
+                return 0
+        if current is not None and silent and current["state"] != "offline":
+            self._close(db, current, max(previous_seen, current["start"]), OFFLINE)
+            current = self._open(db, device_id, OFFLINE, previous_seen, current["state"])
+        if current is not None:
+            self._close(db, current, timestamp, status)
+        self._open(db, device_id, status, timestamp, current["state"] if current else None)
+        return 1
+
+    def _close(self, db, event, end, next_status):
+        state, next_state = event["state"], state_of(next_status)
+        duration = (end - event["start"]).total_seconds()
+        db[EVENTS_COLLECTION].update_one({"_id": event["_id"]}, {"$set": {"end": end, "duration": duration}})
+        inc = {f"totals.{state}": duration}
+        if state == "running" and next_state == "down":
+            inc["failures"] = 1
+        elif state == "down" and next_state == "running":
+            inc["repairs"] = 1
+        db[COUNTERS_COLLECTION].update_one({"_id": event["device_id"]}, {"$inc": inc}, upsert=True)
+
+    def _open(self, db, device_id, status, start, from_state):
+        event = {"_id": _event_id(device_id, start), "device_id": device_id, "status": status,
+                 "state": state_of(status), "from_state": from_state, "start": start, "end": None}
+        db[EVENTS_COLLECTION].replace_one({"_id": event["_id"]}, event, upsert=True)
+        db[COUNTERS_COLLECTION].update_one({"_id": device_id}, {
+            "$set": {"status": status, "state": event["state"], "since": start},
+            "$max": {"last_seen": start}}, upsert=True)
+        TRANSITIONS.labels(event["state"]).inc()
+        return event
+
+    def status(self):
+        return {
+            "offline_after": self.offline_after,
+            "queued_transitions": len(self._queue),
+            "tracked_devices": len(self._devices),
+            "last_error": self.last_error
+        }
+
+
+def _ratio(numerator, denominator):
+    return round(numerator / denominator, 4) if denominator else None
+
+
+def _hours(seconds):
+    return round(seconds / 3600, 3) if seconds is not None else None
+
+
+def _metrics(totals, failures, repairs, performance=None):
+    running, down = totals["running"], totals["down"]
+    availability = _ratio(running, running + down)
+    summary = {
+        "seconds": {state: round(totals[state], 1) for state in STATE_NAMES},
+        "failures": failures,
+        "repairs": repairs,
+        "availability": availability,
+        "mtbf_hours": _hours(running / failures) if failures else None,
+        "mttr_hours": _hours(down / repairs) if repairs else None,
+        "performance": performance
+    }
+    # Quality needs reject counts, which devices don't report; it is taken as 1
+    summary["oee"] = (round(availability * performance, 4)
+                      if availability is not None and performance is not None else availability)
+    return summary
+
+
+def summarize(db, since, until, devices=None, offline_after=300.0, now=None, performance=None):
+    """Per-device uptime/availability/MTBF for [since, until] from the event index
+
+    `performance` optionally maps device_id to a 0..1 performance factor
+    used for OEE; without it OEE equals availability.
+    """
+    now = now or datetime.utcnow()
+    query = {"start": {"$lt": until}, "$or": [{"end": None}, {"end": {"$gt": since}}]}
+    if devices:
+        query["device_id"] = {"$in": list(devices)}
+    events = list(db[EVENTS_COLLECTION].find(query, sort=[("start", 1)]))
+    device_ids = sorted({event["device_id"] for event in events})
+    last_seen = {doc["_id"]: doc.get("last_seen")
+                 for doc in db[COUNTERS_COLLECTION].find({"_id": {"$in": device_ids}}, {"last_seen": 1})}
+    per_device = {}
+    for event in events:
+        entry = per_device.setdefault(event["device_id"], {
+            "totals": dict.fromkeys(STATE_NAMES, 0.0), "failures": 0, "repairs": 0, "current": None})
+        start = max(event["start"], since)
+        end = event["end"]
+        if end is None:
+            entry["current"] = event
+            end = min(until, now)
+            seen = last_seen.get(event["device_id"])
+            # A device that stopped reporting is offline from its last reading
+            if seen is not None and (now - seen).total_seconds() > offline_after and seen < end:
+                entry["totals"]["offline"] += max(0.0, (end - max(seen, start)).total_seconds())
+                end = max(seen, start)
+        end = min(end, until)
+        if end > start:
+            entry["totals"][event["state"]] += (end - start).total_seconds()
+        if since <= event["start"] < until:
+            if event.get("from_state") == "running" and event["state"] == "down":
+                entry["failures"] += 1
+            elif event.get("from_state") == "down" and event["state"] == "running":
+                entry["repairs"] += 1
+    results = []
+    for device_id, entry in sorted(per_device.items()):
+        current = entry["current"]
+        summary = {"device_id": device_id,
+                   **_metrics(entry["totals"], entry["failures"], entry["repairs"],
+                              (performance or {}).get(device_id))}
+        if current is not None:
+            summary["status"] = current["status"]
+            summary["state_since"] = current["start"].isoformat()
+        results.append(summary)
+    return results
+
+
+def performance_from_rollups(db, since, until, devices=None):
+    """device_id -> mean efficiency (0..1) from the hourly rollups, for OEE
+
+    Every hour counts the same: compression stores more points while a
+    machine is changing, so weighting by stored points would favour those hours.
+    """
+    from retention import HOURLY_COLLECTION
+    match = {"hour": {"$gte": since.replace(minute=0, second=0, microsecond=0), "$lt": until},
+             "efficiency_avg": {"$ne": None}}
+    if devices:
+        match["device_id"] = {"$in": list(devices)}
+    hourly = {}
+    for doc in db[HOURLY_COLLECTION].find(match, {"device_id": 1, "efficiency_avg": 1}):
+        total, hours = hourly.get(doc["device_id"], (0.0, 0))
+        hourly[doc["device_id"]] = (total + doc["efficiency_avg"], hours + 1)
+    return {device_id: round(min(total / hours / 100, 1.0), 4) for device_id, (total, hours) in hourly.items() if hours}
+
+
+def fleet_summary(results):
+    """Totals over per-device summaries"""
+    totals = {state: sum(r["seconds"][state] for r in results) for state in STATE_NAMES}
+    return _metrics(totals, sum(r["failures"] for r in results), sum(r["repairs"] for r in results))
+
+
+def lifetime(db, device_id, now=None):
+    """Lifetime counters of one device, including its open interval"""
+    doc = db[COUNTERS_COLLECTION].find_one({"_id": device_id})
+    if doc is None:
+        return None
+    now = now or datetime.utcnow()
+    totals = dict.fromkeys(STATE_NAMES, 0.0)
+    totals.update(doc.get("totals", {}))
+    if doc.get("since") is not None:
+        end = min(now, doc.get("last_seen") or now)
+        totals[doc.get("state", "unknown")] += max(0.0, (end - doc["since"]).total_seconds())
+    return {"device_id": device_id, "status": doc.get("status"),
+            "state_since": doc["since"].isoformat() if doc.get("since") else None,
+            **_metrics(totals, doc.get("failures", 0), doc.get("repairs", 0))}
+
+
+def current_uptime(db, device_id, now=None):
+    """Seconds since the device last started running, or None if it isn't running"""
+    doc = db[COUNTERS_COLLECTION].find_one({"_id": device_id}, {"state": 1, "since": 1})
+    if not doc or doc.get("state") != "running" or doc.get("since") is None:
+        return None
+    # Warning/Critical are running too, so walk back over consecutive running events
+    start = doc["since"]
+    for event in db[EVENTS_COLLECTION].find({"device_id": device_id, "start": {"$lt": start}},
+                                            sort=[("start", -1)]):
+        if event["state"] != "running":
+            break
+        start = event["start"]
+    return ((now or datetime.utcnow()) - start).total_seconds()
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return None
+    minutes = int(seconds // 60)
+    return f"{minutes // 60}h {minutes % 60}m"
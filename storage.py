@@ -0,0 +1,112 @@
+"""
+SmartX MongoDB connection with background health checking
+The client is created and probed off the request path, so startup never
+waits on the database and availability is re-evaluated while running.
+"""
+import logging
+import os
+import threading
+
+from flask_pymongo import PyMongo
+
+logger = logging.getLogger(__name__)
+
+
+class MongoStorage:
+    """Lazily connected MongoDB handle whose availability changes at runtime
+
+    `available` starts False and is flipped by a background checker that pings
+    the server every MONGO_HEALTH_INTERVAL seconds. Callers that see a write
+    fail call `mark_failed()` so the checker re-probes immediately. Listeners
+    added with `on_recovery()` run in the checker thread each time the server
+    comes back (including the first successful connect).
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.available = False
+        self.last_error = None
+        self._pymongo = None
+        self._listeners = []
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("MONGO_URI", "mongodb://localhost:27017/smartx_iot")
+        app.config.setdefault("MONGO_TIMEOUT_MS", 1500)
+        app.config.setdefault("MONGO_HEALTH_INTERVAL", 5.0)
+        self.app = app
+        self.timeout_ms = int(app.config["MONGO_TIMEOUT_MS"])
+        self.interval = float(app.config["MONGO_HEALTH_INTERVAL"])
+        app.extensions['smartx_mongo'] = self
+
+    @property
+    def db(self):
+        if self._pymongo is None:
+            raise RuntimeError("MongoDB is not connected")
+        return self._pymongo.db
+
+    def on_recovery(self, callback):
+        self._listeners.append(callback)
+        return callback
+
+    def start(self):
+        """Start the health checker once per process (safe to call often)"""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # A forked worker inherits the flag but not the thread or sockets
+            self._pymongo = None
+            self.available = False
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="mongo-health", daemon=True)
+            self._thread.start()
+
+    def mark_failed(self, error):
+        """Record a failed operation and have the checker re-probe now"""
+        if self.available:
+            logger.warning(f"MongoDB operation failed, switching to fallback storage: {error}")
+        self.available = False
+        self.last_error = str(error)
+        self._wake.set()
+
+    def check(self):
+        """Probe the server once and update availability"""
+        try:
+            if self._pymongo is None:
+                self._pymongo = PyMongo(
+                    self.app,
+                    serverSelectionTimeoutMS=self.timeout_ms,
+                    connectTimeoutMS=self.timeout_ms
+                )
+            self._pymongo.cx.admin.command("ping")
+        except Exception as e:
+            if self.available or self.last_error is None:
+                logger.warning(f"MongoDB not available, using fallback mode: {e}")
+            self.available = False
+            self.last_error = str(e)
+            return False
+
+        if not self.available:
+            logger.info("MongoDB connected successfully")
+            self.available = True
+            self.last_error = None
+            for callback in self._listeners:
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"MongoDB recovery handler failed: {e}")
+        return True
+
+    def _run(self):
+        while True:
+            self.check()
+            # Re-probe sooner while the server is down
+            self._wake.wait(self.interval if self.available else min(self.interval, 2.0))
+            self._wake.clear()
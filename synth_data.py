@@ -0,0 +1,376 @@
+"""
+SmartX synthetic history generator
+
+Builds realistic multi-device sensor history with numpy for seeding storage
+and benchmarks. Each device gets correlated series (power follows RPM,
+temperature follows load, ambient cycle and a slow drift) with injected fault
+episodes that cross the /api/predict thresholds, plus idle shifts and
+maintenance after faults. Output is identical for the same seed however it is
+chunked, because every device draws from its own spawned seed.
+
+Examples:
+    # 1,000 devices x 90 days at one reading per minute straight into MongoDB
+    python synth_data.py mongo --devices 1000 --days 90 --uri mongodb://localhost:27017/smartx_iot
+
+    # The same history as NDJSON (one sensor_data document per line)
+    python synth_data.py ndjson --devices 50 --days 7 --output history.ndjson
+
+    # Seed the JSON fallback file read by the app when MongoDB is down
+    python synth_data.py file --devices 5 --days 1 --output sensor_data.json
+"""
+import argparse
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+STATUSES = ("Running", "Warning", "Critical", "Idle", "Maintenance")
+DATA_FIELDS = ("temperature", "pressure", "vibration", "humidity", "rpm", "power", "efficiency")
+
+# Thresholds used by /api/predict and the twin's status rules
+CRITICAL = {"temperature": 90.0, "pressure": 2.2, "vibration": 0.9}
+WARNING = {"temperature": 85.0, "pressure": 2.0, "vibration": 0.7}
+
+
+def device_ids(count, prefix="smartx_device_"):
+    width = max(3, len(str(count)))
+    return [f"{prefix}{i + 1:0{width}d}" for i in range(count)]
+
+
+def _smooth_noise(rng, n, scale, persistence):
+    """AR(1) noise: correlated from one reading to the next"""
+    shocks = rng.normal(0.0, scale * np.sqrt(1 - persistence ** 2), n)
+    if persistence == 0:
+        return shocks
+    # Closed-form AR(1) via a scaled cumulative sum, chunked to keep powers finite
+    out = np.empty(n)
+    state = rng.normal(0.0, scale)
+    block = 512
+    powers = persistence ** np.arange(block)
+    for start in range(0, n, block):
+        e = shocks[start:start + block]
+        k = len(e)
+        p = powers[:k]
+        out[start:start + k] = p * (persistence * state + np.cumsum(e / p))
+        state = out[start + k - 1]
+    return out
+
+
+def _episodes(rng, n, rate, min_len, max_len):
+    """Boolean mask and 0..1 ramp for randomly placed episodes"""
+    mask = np.zeros(n, dtype=bool)
+    ramp = np.zeros(n)
+    for start in rng.integers(0, n, rng.poisson(rate)):
+        length = int(rng.integers(min_len, max_len + 1))
+        end = min(n, start + length)
+        mask[start:end] = True
+        ramp[start:end] = np.maximum(ramp[start:end], np.linspace(0.0, 1.0, length)[:end - start])
+    return mask, ramp
+
+
+def generate_device(seed, start, periods, interval, faults_per_day=0.3):
+    """Column arrays for one device's history
+
+    `seed` is a numpy SeedSequence (or int); `start` a datetime and
+    `interval` the seconds between readings.
+    """
+    rng = np.random.default_rng(seed)
+    minutes = np.arange(periods) * (interval / 60.0)
+    day_phase = 2 * np.pi * (((start.hour * 60 + start.minute) + minutes) % 1440) / 1440
+    per_day = 86400.0 / interval
+
+    # Per-device character
+    base_rpm = rng.uniform(1500, 2100)
+    base_temp = rng.uniform(70, 78)
+    base_pressure = rng.uniform(1.35, 1.6)
+    base_vibration = rng.uniform(0.2, 0.35)
+    drift_per_day = rng.normal(0.0, 0.05)
+
+    # Off shifts: idle stretches with the machine stopped
+    idle, _ = _episodes(rng, periods, periods / per_day * 0.5, int(per_day / 24), int(per_day / 6))
+
+    rpm = base_rpm + 150 * np.sin(day_phase - 1.0) + _smooth_noise(rng, periods, 80, 0.95)
+    rpm = np.where(idle, 0.0, np.clip(rpm, 800, 3000))
+    load = rpm / base_rpm
+
+    power = np.where(idle, rng.uniform(2, 6, periods),
+                     40 + 0.045 * rpm + _smooth_noise(rng, periods, 6, 0.8))
+
+    ambient = 3 * np.sin(day_phase - 2.0)
+    drift = drift_per_day * minutes / 1440 + np.cumsum(rng.normal(0, 0.002, periods))
+    temperature = base_temp + ambient + 6 * (load - 1) + drift + _smooth_noise(rng, periods, 1.2, 0.9)
+    temperature = np.where(idle, base_temp - 8 + ambient, temperature)
+    pressure = base_pressure + 0.25 * (load - 1) + _smooth_noise(rng, periods, 0.06, 0.9)
+    vibration = base_vibration * np.maximum(load, 0.05) + np.abs(_smooth_noise(rng, periods, 0.04, 0.5))
+    humidity = 50 - 6 * np.sin(day_phase - 2.0) + _smooth_noise(rng, periods, 2.0, 0.98)
+
+    # Fault episodes ramp one or more sensors through warning into critical
+    fault, ramp = _episodes(rng, periods, periods / per_day * faults_per_day,
+                            int(per_day / 96) + 2, int(per_day / 12) + 2)
+    fault &= ~idle
+    ramp = np.where(fault, ramp, 0.0)
+    kind = rng.integers(0, 3)
+    if kind == 0:
+        temperature = temperature + ramp * rng.uniform(18, 28)
+    elif kind == 1:
+        pressure = pressure + ramp * rng.uniform(0.8, 1.2)
+    else:
+        vibration = vibration + ramp * rng.uniform(0.7, 1.1)
+
+    # Maintenance follows the end of every fault
+    maintenance = np.zeros(periods, dtype=bool)
+    ends = np.flatnonzero(fault[:-1] & ~fault[1:]) + 1
+    for end in ends:
+        maintenance[end:end + int(per_day / 48) + 1] = True
+    maintenance &= ~fault
+
+    temperature = np.clip(temperature, 40, 120)
+    pressure = np.clip(pressure, 0.5, 3.5)
+    vibration = np.clip(vibration, 0.02, 2.5)
+    humidity = np.clip(humidity, 20, 80)
+
+    critical = ((temperature > CRITICAL["temperature"]) | (pressure > CRITICAL["pressure"])
+                | (vibration > CRITICAL["vibration"]))
+    warning = ((temperature > WARNING["temperature"]) | (pressure > WARNING["pressure"])
+               | (vibration > WARNING["vibration"]))
+    status = np.select([maintenance, idle, critical, warning], [4, 3, 2, 1], 0).astype(np.int8)
+
+    efficiency = np.clip(95 - np.maximum(temperature - 75, 0) * 0.5 - np.maximum(vibration - 0.3, 0) * 10
+                         - np.maximum(pressure - 1.8, 0) * 10, 60, 98)
+    efficiency = np.where(idle | maintenance, 0.0, efficiency)
+
+    return {
+        "timestamp": np.datetime64(start, "ms") + (np.arange(periods) * int(interval * 1000)).astype("timedelta64[ms]"),
+        "temperature": np.round(temperature, 1),
+        "pressure": np.round(pressure, 2),
+        "vibration": np.round(vibration, 2),
+        "humidity": np.round(humidity, 1),
+        "rpm": np.rint(rpm).astype(np.int64),
+        "power": np.round(power, 1),
+        "efficiency": np.round(efficiency, 1),
+        "status": status
+    }
+
+
+def fleet_plan(devices, days, interval=60, seed=0, start=None, prefix="smartx_device_"):
+    """One (device_id, seed, start, periods, interval) task per device"""
+    periods = int(days * 86400 // interval)
+    start = start or (datetime.utcnow() - timedelta(days=days)).replace(second=0, microsecond=0)
+    seeds = np.random.SeedSequence(seed).spawn(devices)
+    return [(device_id, device_seed, start, periods, interval)
+            for device_id, device_seed in zip(device_ids(devices, prefix), seeds)]
+
+
+def device_chunks(task, chunk_rows=200000):
+    """Yield (device_id, columns) chunks for one planned device"""
+    device_id, seed, start, periods, interval = task
+    columns = generate_device(seed, start, periods, interval)
+    for begin in range(0, periods, chunk_rows):
+        yield device_id, {name: values[begin:begin + chunk_rows] for name, values in columns.items()}
+
+
+def generate_fleet(devices, days, interval=60, seed=0, start=None, chunk_rows=200000, prefix="smartx_device_"):
+    """Yield (device_id, columns) chunks for the whole fleet, device by device"""
+    for task in fleet_plan(devices, days, interval, seed, start, prefix):
+        yield from device_chunks(task, chunk_rows)
+
+
+def to_documents(device_id, columns):
+    """sensor_data documents ({device_id, timestamp, data}) for one chunk"""
+    stamps = columns["timestamp"].astype("datetime64[ms]").tolist()
+    statuses = [STATUSES[code] for code in columns["status"].tolist()]
+    rows = zip(stamps, *(columns[name].tolist() for name in DATA_FIELDS), statuses)
+    return [{
+        "device_id": device_id,
+        "timestamp": stamp,
+        "data": {
+            "temperature": temperature, "pressure": pressure, "vibration": vibration,
+            "humidity": humidity, "rpm": rpm, "power": power, "efficiency": efficiency,
+            "status": status
+        }
+    } for stamp, temperature, pressure, vibration, humidity, rpm, power, efficiency, status in rows]
+
+
+# Fixed-width NDJSON layout: (field, integer digits, decimals). JSON allows
+# whitespace before a value, so numbers are right-aligned with spaces and
+# every line of a chunk can be rendered as one uint8 matrix.
+NDJSON_LAYOUT = (("temperature", 3, 1), ("pressure", 1, 2), ("vibration", 1, 2), ("humidity", 3, 1),
+                 ("rpm", 4, 0), ("power", 4, 1), ("efficiency", 3, 1))
+_STATUS_BYTES = np.array([f'"{status}"'.ljust(13).encode() for status in STATUSES])
+
+
+def _ascii_column(values, digits, decimals):
+    """Render non-negative numbers as right-aligned ASCII, one row per value"""
+    width = digits + (decimals + 1 if decimals else 0)
+    limit = 10 ** digits - 10 ** -decimals
+    scaled = np.rint(np.clip(values, 0, limit) * 10 ** decimals).astype(np.int64)
+    out = np.empty((len(scaled), width), dtype=np.uint8)
+    pos = width - 1
+    for _ in range(decimals):
+        out[:, pos] = 48 + scaled % 10
+        scaled //= 10
+        pos -= 1
+    if decimals:
+        out[:, pos] = ord(".")
+        pos -= 1
+    leading = np.ones(len(scaled), dtype=bool)
+    while pos >= 0:
+        out[:, pos] = np.where(leading | (scaled > 0), 48 + scaled % 10, 32)
+        leading[:] = False
+        scaled //= 10
+        pos -= 1
+    return out
+
+
+def _ascii_timestamps(stamps):
+    """ISO timestamps (YYYY-MM-DDTHH:MM:SS.mmm) as a (n, 23) uint8 matrix"""
+    ms = stamps.astype("datetime64[ms]").astype(np.int64)
+    days, ms_of_day = np.divmod(ms, 86400000)
+    # Only the few distinct dates go through numpy's string conversion
+    unique_days, day_index = np.unique(days, return_inverse=True)
+    dates = np.datetime_as_string(unique_days.astype("datetime64[D]")).astype("S10")
+    out = np.empty((len(ms), 23), dtype=np.uint8)
+    out[:, :10] = dates.view(np.uint8).reshape(-1, 10)[day_index]
+    out[:, 10] = ord("T")
+    out[:, 13] = out[:, 16] = ord(":")
+    out[:, 19] = ord(".")
+    for column, value in ((11, ms_of_day // 3600000), (14, ms_of_day // 60000 % 60), (17, ms_of_day // 1000 % 60)):
+        out[:, column] = 48 + value // 10
+        out[:, column + 1] = 48 + value % 10
+    millis = ms_of_day % 1000
+    out[:, 20] = 48 + millis // 100
+    out[:, 21] = 48 + millis // 10 % 10
+    out[:, 22] = 48 + millis % 10
+    return out
+
+
+def to_ndjson(device_id, columns):
+    """NDJSON bytes in the sensor_data shape, rendered column-wise with numpy"""
+    n = len(columns["status"])
+
+    def literal(text):
+        return np.broadcast_to(np.frombuffer(text.encode(), dtype=np.uint8), (n, len(text)))
+
+    parts = [literal('{"device_id": ' + json.dumps(device_id) + ', "timestamp": "'),
+             _ascii_timestamps(columns["timestamp"]), literal('", "data": {')]
+    for name, digits, decimals in NDJSON_LAYOUT:
+        parts.append(literal(f'"{name}": '))
+        parts.append(_ascii_column(columns[name], digits, decimals))
+        parts.append(literal(", "))
+    parts.append(literal('"status": '))
+    parts.append(_STATUS_BYTES.astype("S13")[columns["status"]].view(np.uint8).reshape(n, 13))
+    parts.append(literal("}}\n"))
+    return np.concatenate(parts, axis=1).tobytes()
+
+
+def _map(func, tasks, jobs, ordered=True):
+    """Run func over tasks in this process or a pool of `jobs` processes"""
+    if jobs <= 1:
+        return map(func, tasks)
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    results = pool.imap(func, tasks) if ordered else pool.imap_unordered(func, tasks)
+    pool.close()
+    return results
+
+
+def _render_device(task):
+    return b"".join(to_ndjson(device_id, columns) for device_id, columns in device_chunks(task))
+
+
+# Per-process MongoDB collection, opened by the first _insert_device call
+_mongo_target = None
+
+
+def _insert_device(task):
+    global _mongo_target
+    uri, collection, batch_size, task = task
+    if _mongo_target is None:
+        from pymongo import MongoClient
+        _mongo_target = MongoClient(uri).get_default_database()[collection]
+    written = 0
+    for device_id, columns in device_chunks(task):
+        docs = to_documents(device_id, columns)
+        for begin in range(0, len(docs), batch_size):
+            _mongo_target.insert_many(docs[begin:begin + batch_size], ordered=False)
+        written += len(docs)
+    return written
+
+
+def write_mongo(tasks, uri, collection="sensor_data", batch_size=10000, jobs=1):
+    """Insert every planned device, one device per worker at a time"""
+    global _mongo_target
+    _mongo_target = None
+    return sum(_map(_insert_device, [(uri, collection, batch_size, task) for task in tasks], jobs, ordered=False))
+
+
+def write_ndjson(tasks, output, jobs=1):
+    """Write NDJSON in device order; workers render, this process writes"""
+    written = 0
+    out = sys.stdout.buffer if output == "-" else open(output, "wb")
+    try:
+        for task, body in zip(tasks, _map(_render_device, tasks, jobs)):
+            out.write(body)
+            written += task[3]
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+    return written
+
+
+def write_file(tasks, output):
+    """The app's JSON fallback format: a list of records with ISO timestamps"""
+    records = []
+    for device_id, columns in (chunk for task in tasks for chunk in device_chunks(task)):
+        for doc in to_documents(device_id, columns):
+            doc["timestamp"] = doc["timestamp"].isoformat()
+            records.append(doc)
+    with open(output, "w") as f:
+        json.dump(records, f)
+    return len(records)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Generate synthetic SmartX sensor history")
+    parser.add_argument("target", choices=("mongo", "ndjson", "file"))
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--days", type=float, default=1.0)
+    parser.add_argument("--interval", type=float, default=60.0, help="seconds between readings")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--start", help="ISO start time (default: --days before now, UTC)")
+    parser.add_argument("--prefix", default="smartx_device_", help="device id prefix")
+    parser.add_argument("--output", default="-", help="output path for ndjson/file ('-' is stdout for ndjson)")
+    parser.add_argument("--uri", default="mongodb://localhost:27017/smartx_iot")
+    parser.add_argument("--collection", default="sensor_data")
+    parser.add_argument("--batch-size", type=int, default=10000, help="documents per insert_many")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes (mongo and ndjson)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    start = datetime.fromisoformat(args.start) if args.start else None
+    tasks = fleet_plan(args.devices, args.days, args.interval, args.seed, start, args.prefix)
+    began = time.perf_counter()
+    if args.target == "mongo":
+        written = write_mongo(tasks, args.uri, args.collection, args.batch_size, args.jobs)
+    elif args.target == "ndjson":
+        written = write_ndjson(tasks, args.output, args.jobs)
+    else:
+        if args.output == "-":
+            args.output = "sensor_data.json"
+        written = write_file(tasks, args.output)
+    elapsed = time.perf_counter() - began
+    print(json.dumps({
+        "target": args.target,
+        "devices": args.devices,
+        "rows": written,
+        "seconds": round(elapsed, 2),
+        "rows_per_second": round(written / elapsed) if elapsed else None
+    }), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,38 @@
+"""
+SmartX load generator
 
-import requests
+Simulates many devices sending readings to the platform and reports
+throughput, error rate and latency percentiles as JSON.
+
+Examples:
+    # 200 devices, ramping to 2000 readings/s over 10 s, 60 s measured
+    python test_iot_sender.py http --url http://localhost:5000 --devices 200 \\
+        --rate 2000 --ramp linear:10 --warmup 5 --duration 60
+
+    # Same load over MQTT, 10 readings per message, QoS 1
+    python test_iot_sender.py mqtt --broker localhost:1883 --devices 200 \\
+        --rate 2000 --batch 10 --qos 1
+
+    # Minimal local MQTT broker stand-in for the app and the load tool
+    python test_iot_sender.py broker --port 1883
+"""
+import argparse
+import asyncio
+import itertools
 import json
-import time
 import random
-from datetime import datetime
+import struct
+import sys
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+from reading_codec import CONTENT_TYPE as BINARY_CONTENT_TYPE, encode_readings
 
 # Configuration
 BASE_URL = "http://localhost:5000"  # Change this to your actual URL when deployed
-DEVICE_DATA_ENDPOINT = f"{BASE_URL}/api/device-data"
+DEVICE_DATA_PATH = "/api/device-data"
+
 
 def generate_sample_data():
     """Generate realistic sample sensor data"""
@@ -20,57 +45,447 @@ def generate_sample_data():
         "efficiency": random.randint(70, 98)
     }
 
-def send_data():
-    """Send sample data to the IoT endpoint"""
-    try:
-        data = generate_sample_data()
-        print(f"Sending data: {json.dumps(data, indent=2)}")
-        
-        response = requests.post(
-            DEVICE_DATA_ENDPOINT,
-            json=data,
-            headers={'Content-Type': 'application/json'}
-        )
-        
-        if response.status_code == 200:
-            print(f"✅ Data sent successfully: {response.json()}")
-        else:
-            print(f"❌ Failed to send data: {response.status_code} - {response.text}")
-            
-    except requests.exceptions.ConnectionError:
-        print("❌ Connection error: Make sure your Flask app is running")
-    except Exception as e:
-        print(f"❌ Error: {str(e)}")
-
-def main():
-    """Main function to send test data"""
-    print("🚀 SmartX IoT Data Sender")
-    print(f"📡 Sending data to: {DEVICE_DATA_ENDPOINT}")
-    print("-" * 50)
-    
-    # Send one batch of data
-    send_data()
-    
-    # Ask if user wants to send continuous data
+
+def encode_payload(device_id, batch, binary):
+    """Build (body, content_type) for one message of `batch` readings"""
+    readings = [generate_sample_data() for _ in range(batch)]
+    if binary:
+        return encode_readings(readings), BINARY_CONTENT_TYPE
+    if batch == 1:
+        return json.dumps(readings[0]).encode(), "application/json"
+    for reading in readings:
+        reading["device_id"] = device_id
+    return json.dumps(readings).encode(), "application/json"
+
+
+# Ramp-up profiles: map elapsed seconds to a fraction of the target rate
+def parse_ramp(spec):
+    """Parse 'constant', 'linear:SECONDS' or 'step:STEPSxSECONDS'"""
+    kind, _, arg = spec.partition(":")
+    if kind == "constant":
+        return lambda elapsed: 1.0
+    if kind == "linear":
+        seconds = float(arg or 10)
+        return lambda elapsed: min(1.0, max(elapsed / seconds, 0.01))
+    if kind == "step":
+        steps, _, seconds = arg.partition("x")
+        steps, seconds = int(steps or 5), float(seconds or 10)
+        return lambda elapsed: min(1.0, (int(elapsed // seconds) + 1) / steps)
+    raise argparse.ArgumentTypeError(f"Unknown ramp profile: {spec}")
+
+
+class Stats:
+    """Latency and outcome bookkeeping for the measured window"""
+
+    def __init__(self):
+        self.latencies = []
+        self.outcomes = Counter()
+        self.readings = 0
+        self.recording = False
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        self.recording = True
+        self.started = time.perf_counter()
+
+    def stop(self):
+        self.recording = False
+        self.finished = time.perf_counter()
+
+    def record(self, latency, outcome, readings):
+        if not self.recording:
+            return
+        self.outcomes[outcome] += 1
+        if outcome == "ok":
+            self.latencies.append(latency)
+            self.readings += readings
+
+    def report(self, **settings):
+        elapsed = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        sent = sum(self.outcomes.values())
+        ok = self.outcomes.get("ok", 0)
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000, 3)
+
+        return {
+            **settings,
+            "elapsed_s": round(elapsed, 3),
+            "requests": sent,
+            "ok": ok,
+            "errors": sent - ok,
+            "error_rate": round((sent - ok) / sent, 4) if sent else 0.0,
+            "outcomes": dict(self.outcomes),
+            "throughput_rps": round(ok / elapsed, 1) if elapsed else 0.0,
+            "readings_per_s": round(self.readings / elapsed, 1) if elapsed else 0.0,
+            "latency_ms": {
+                "p50": percentile(50),
+                "p95": percentile(95),
+                "p99": percentile(99),
+                "max": round(latencies[-1] * 1000, 3) if latencies else None,
+                "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None
+            }
+        }
+
+
+async def run_schedule(args, send, stats):
+    """Open-loop scheduler: fire sends at the target rate, bounded by --concurrency
+
+    Latency is measured from each send's scheduled time, so queueing behind a
+    saturated server shows up in the percentiles instead of being hidden.
+    """
+    ramp = parse_ramp(args.ramp)
+    device_ids = [f"{args.prefix}{i:05d}" for i in range(args.devices)]
+    devices = itertools.cycle(device_ids)
+    slots = asyncio.Semaphore(args.concurrency)
+    pending = set()
+    message_rate = args.rate / args.batch
+
+    async def fire(device_id, scheduled):
+        try:
+            outcome = await send(device_id)
+        except Exception as e:
+            outcome = type(e).__name__
+        finally:
+            slots.release()
+        stats.record(time.perf_counter() - scheduled, outcome, args.batch)
+
+    loop_start = time.perf_counter()
+    warmup_end = loop_start + args.warmup
+    end = warmup_end + args.duration
+    next_send = loop_start
+    while True:
+        now = time.perf_counter()
+        if not stats.recording and now >= warmup_end and stats.started is None:
+            stats.start()
+        if now >= end:
+            break
+        if next_send > now:
+            await asyncio.sleep(next_send - now)
+            continue
+        await slots.acquire()
+        task = asyncio.ensure_future(fire(next(devices), next_send))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        current_rate = max(message_rate * ramp(now - loop_start), 0.1)
+        next_send += 1.0 / current_rate
+
+    stats.stop()
+    if pending:
+        await asyncio.wait(pending, timeout=10)
+
+
+# HTTP/1.1 client with a keep-alive connection pool
+class HttpPool:
+    def __init__(self, url, size):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.ssl = parts.scheme == "https"
+        self.base_path = parts.path.rstrip("/")
+        self.idle = asyncio.Queue()
+        for _ in range(size):
+            self.idle.put_nowait(None)
+
+    async def post(self, path, body, headers):
+        conn = await self.idle.get()
+        try:
+            if conn is None:
+                conn = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+            reader, writer = conn
+            head = [f"POST {self.base_path}{path} HTTP/1.1", f"Host: {self.host}:{self.port}",
+                    f"Content-Length: {len(body)}", "Connection: keep-alive"]
+            head += [f"{k}: {v}" for k, v in headers.items()]
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError("Connection closed by server")
+            version, status = status_line.split(b" ", 2)[:2]
+            length, keep_alive = None, version == b"HTTP/1.1"
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.partition(b":")
+                name, value = name.strip().lower(), value.strip().lower()
+                if name == b"content-length":
+                    length = int(value)
+                elif name == b"connection":
+                    keep_alive = value == b"keep-alive"
+            if length is None:
+                await reader.read()
+                keep_alive = False
+            else:
+                await reader.readexactly(length)
+            if not keep_alive:
+                writer.close()
+                conn = None
+            return int(status)
+        except Exception:
+            if conn is not None:
+                conn[1].close()
+            conn = None
+            raise
+        finally:
+            self.idle.put_nowait(conn)
+
+
+async def run_http(args):
+    pool = HttpPool(args.url, args.concurrency)
+    stats = Stats()
+
+    async def send(device_id):
+        body, content_type = encode_payload(device_id, args.batch, args.binary)
+        status = await pool.post(DEVICE_DATA_PATH, body,
+                                 {"Content-Type": content_type, "Device-ID": device_id})
+        return "ok" if status == 200 else f"http_{status}"
+
+    await run_schedule(args, send, stats)
+    return stats.report(transport="http", target=args.url, **_settings(args))
+
+
+# Minimal MQTT 3.1.1 packet helpers shared by the publisher and broker stand-in
+def _mqtt_string(value):
+    data = value.encode()
+    return struct.pack("!H", len(data)) + data
+
+
+def _mqtt_packet(packet_type, flags, body):
+    length = len(body)
+    encoded = bytearray()
     while True:
-        choice = input("\nSend another batch? (y/n/continuous): ").lower().strip()
-        
-        if choice == 'y':
-            send_data()
-        elif choice == 'n':
-            print("👋 Goodbye!")
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
             break
-        elif choice == 'continuous':
-            print("📊 Sending continuous data every 10 seconds. Press Ctrl+C to stop...")
-            try:
-                while True:
-                    send_data()
-                    time.sleep(10)
-            except KeyboardInterrupt:
-                print("\n🛑 Stopped sending data")
-                break
-        else:
-            print("Please enter 'y', 'n', or 'continuous'")
+    return bytes([(packet_type << 4) | flags]) + bytes(encoded) + body
+
+
+async def _mqtt_read(reader):
+    header = (await reader.readexactly(1))[0]
+    multiplier, length = 1, 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+    body = await reader.readexactly(length) if length else b""
+    return header >> 4, header & 0x0F, body
+
+
+def _mqtt_connect_packet(client_id, keepalive=60):
+    body = _mqtt_string("MQTT") + bytes([4, 0x02]) + struct.pack("!H", keepalive) + _mqtt_string(client_id)
+    return _mqtt_packet(1, 0, body)
+
+
+def _mqtt_publish_packet(topic, payload, qos=0, packet_id=0):
+    body = _mqtt_string(topic)
+    if qos:
+        body += struct.pack("!H", packet_id)
+    return _mqtt_packet(3, qos << 1, body + payload)
+
+
+class MqttPublisher:
+    """One broker connection; QoS 1 publishes resolve on PUBACK"""
+
+    def __init__(self, host, port, client_id):
+        self.host, self.port, self.client_id = host, port, client_id
+        self.inflight = {}
+        self.packet_ids = itertools.cycle(range(1, 65536))
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(_mqtt_connect_packet(self.client_id))
+        packet_type, _, body = await _mqtt_read(self.reader)
+        if packet_type != 2 or body[1] != 0:
+            raise ConnectionError(f"MQTT CONNACK refused: {body!r}")
+        self.reader_task = asyncio.ensure_future(self._read_acks())
+
+    async def _read_acks(self):
+        try:
+            while True:
+                packet_type, _, body = await _mqtt_read(self.reader)
+                if packet_type == 4:  # PUBACK
+                    future = self.inflight.pop(struct.unpack("!H", body[:2])[0], None)
+                    if future and not future.done():
+                        future.set_result(True)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            for future in self.inflight.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError("Broker connection lost"))
+
+    async def publish(self, topic, payload, qos):
+        if qos == 0:
+            self.writer.write(_mqtt_publish_packet(topic, payload))
+            await self.writer.drain()
+            return
+        packet_id = next(self.packet_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[packet_id] = future
+        self.writer.write(_mqtt_publish_packet(topic, payload, qos, packet_id))
+        await self.writer.drain()
+        await future
+
+    async def close(self):
+        self.writer.write(_mqtt_packet(14, 0, b""))
+        self.reader_task.cancel()
+        self.writer.close()
+
+
+async def run_mqtt(args):
+    host, _, port = args.broker.partition(":")
+    publishers = [MqttPublisher(host, int(port or 1883), f"{args.prefix}load_{i}")
+                  for i in range(args.connections)]
+    await asyncio.gather(*(publisher.connect() for publisher in publishers))
+    stats = Stats()
+
+    async def send(device_id):
+        publisher = publishers[hash(device_id) % len(publishers)]
+        body, _ = encode_payload(device_id, args.batch, args.binary)
+        await publisher.publish(f"smartx/sensors/{device_id}", body, args.qos)
+        return "ok"
+
+    try:
+        await run_schedule(args, send, stats)
+    finally:
+        await asyncio.gather(*(publisher.close() for publisher in publishers), return_exceptions=True)
+    return stats.report(transport="mqtt", target=args.broker, qos=args.qos,
+                        connections=args.connections, **_settings(args))
+
+
+# Broker stand-in: enough MQTT 3.1.1 for the app's subscriber and the load tool
+class BrokerStandIn:
+    def __init__(self):
+        self.subscriptions = {}
+        self.received = 0
+        self.delivered = 0
+
+    @staticmethod
+    def matches(topic_filter, topic):
+        filter_parts, topic_parts = topic_filter.split("/"), topic.split("/")
+        for i, part in enumerate(filter_parts):
+            if part == "#":
+                return True
+            if i >= len(topic_parts) or (part != "+" and part != topic_parts[i]):
+                return False
+        return len(filter_parts) == len(topic_parts)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                packet_type, flags, body = await _mqtt_read(reader)
+                if packet_type == 1:  # CONNECT
+                    writer.write(_mqtt_packet(2, 0, b"\x00\x00"))
+                elif packet_type == 3:  # PUBLISH
+                    qos = (flags >> 1) & 0x03
+                    topic_len = struct.unpack("!H", body[:2])[0]
+                    topic = body[2:2 + topic_len].decode()
+                    offset = 2 + topic_len
+                    if qos:
+                        writer.write(_mqtt_packet(4, 0, body[offset:offset + 2]))
+                        offset += 2
+                    self.received += 1
+                    packet = _mqtt_publish_packet(topic, body[offset:])
+                    for subscriber, filters in list(self.subscriptions.items()):
+                        if any(self.matches(f, topic) for f in filters):
+                            subscriber.write(packet)
+                            self.delivered += 1
+                elif packet_type == 8:  # SUBSCRIBE
+                    packet_id, offset, granted = body[:2], 2, bytearray()
+                    while offset < len(body):
+                        length = struct.unpack("!H", body[offset:offset + 2])[0]
+                        self.subscriptions.setdefault(writer, set()).add(
+                            body[offset + 2:offset + 2 + length].decode())
+                        offset += 2 + length + 1
+                        granted.append(0)
+                    writer.write(_mqtt_packet(9, 0, packet_id + bytes(granted)))
+                elif packet_type == 12:  # PINGREQ
+                    writer.write(_mqtt_packet(13, 0, b""))
+                elif packet_type == 14:  # DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.subscriptions.pop(writer, None)
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"MQTT broker stand-in listening on {host}:{port}", file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+
+def _settings(args):
+    return {
+        "devices": args.devices,
+        "target_rate": args.rate,
+        "batch": args.batch,
+        "binary": args.binary,
+        "ramp": args.ramp,
+        "warmup_s": args.warmup,
+        "duration_s": args.duration,
+        "concurrency": args.concurrency
+    }
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="SmartX multi-device load generator")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_load_options(sub):
+        sub.add_argument("--devices", type=int, default=100, help="number of simulated devices")
+        sub.add_argument("--rate", type=float, default=100.0, help="target readings per second (all devices)")
+        sub.add_argument("--duration", type=float, default=30.0, help="measured seconds after warm-up")
+        sub.add_argument("--warmup", type=float, default=5.0, help="seconds sent but not measured")
+        sub.add_argument("--ramp", default="constant", help="constant | linear:SECONDS | step:STEPSxSECONDS")
+        sub.add_argument("--batch", type=int, default=1, help="readings per request/message")
+        sub.add_argument("--binary", action="store_true", help="send packed binary readings instead of JSON")
+        sub.add_argument("--concurrency", type=int, default=64, help="max in-flight sends (HTTP pool size)")
+        sub.add_argument("--prefix", default="load_device_", help="device id prefix")
+        sub.add_argument("--output", help="also write the JSON report to this file")
+
+    http = commands.add_parser("http", help="POST readings to /api/device-data")
+    http.add_argument("--url", default=BASE_URL)
+    add_load_options(http)
+
+    mqtt = commands.add_parser("mqtt", help="publish readings to smartx/sensors/<device>")
+    mqtt.add_argument("--broker", default="localhost:1883")
+    mqtt.add_argument("--qos", type=int, choices=(0, 1), default=0)
+    mqtt.add_argument("--connections", type=int, default=4, help="broker connections shared by all devices")
+    add_load_options(mqtt)
+
+    broker = commands.add_parser("broker", help="run a minimal local MQTT broker stand-in")
+    broker.add_argument("--host", default="127.0.0.1")
+    broker.add_argument("--port", type=int, default=1883)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == "broker":
+        try:
+            asyncio.run(BrokerStandIn().serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    runner = run_http if args.command == "http" else run_mqtt
+    report = asyncio.run(runner(args))
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
 
 if __name__ == "__main__":
     main()